@@ -1,16 +1,68 @@
 from flask import Flask
 from flask_cors import CORS
-from flask_socketio import SocketIO
-from flask_sqlalchemy import SQLAlchemy
+from models import db
+from config import get_config
+from storage import init_storage, upgrade_schema
+from sockets import socketio
+from message_pipeline import pipeline
+from presence import presence
+from typing_indicators import typing_tracker
+from message_cache import message_cache
+from cluster import socketio_options
+from search import install_search_index, rebuild_search_index
+from metrics import metrics
+from passwords import password_hasher
+from member_lists import member_lists
+from uploads import blob_store
+from read_state import read_states
+from archive import archive
+from voice_state import voice_rosters
+from session_resume import session_resume
+from flow_control import rate_limiter, outbound_guard
+from wire import FastJSONProvider, SocketJSON
+import membership
+import click
+import os
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key'  # Change in production
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///commi8.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.json = FastJSONProvider(app)
+app.config.from_object(get_config())
+app.config.from_envvar('COMMI8_SETTINGS', silent=True)
 
 CORS(app, resources={r"/api/*": {"origins": "http://localhost:8000"}})
-db = SQLAlchemy(app)
-socketio = SocketIO(app, cors_allowed_origins="http://localhost:8000")
+db.init_app(app)
+init_storage(app, db)
+socketio.init_app(app, cors_allowed_origins="http://localhost:8000", json=SocketJSON,
+                  **socketio_options(app))
+membership.init_app(app)
+pipeline.init_app(app, socketio)
+presence.init_app(app, socketio)
+typing_tracker.init_app(app, socketio)
+message_cache.init_app(app)
+password_hasher.init_app(app, socketio)
+member_lists.init_app(app, socketio)
+blob_store.init_app(app)
+read_states.init_app(app, socketio)
+archive.init_app(app, socketio)
+voice_rosters.init_app(app, socketio)
+session_resume.init_app(app, socketio)
+metrics.init_app(app, socketio, db)
+rate_limiter.init_app(app, socketio)
+outbound_guard.init_app(app, socketio)
+metrics.register('message_pipeline', lambda: pipeline.stats)
+metrics.register('typing', lambda: typing_tracker.stats)
+metrics.register('message_cache', message_cache.metrics)
+metrics.register('passwords', lambda: password_hasher.stats)
+metrics.register('member_lists', lambda: member_lists.stats)
+metrics.register('uploads', lambda: blob_store.stats)
+metrics.register('archive', lambda: archive.stats)
+metrics.register('session_resume', lambda: dict(session_resume.stats, sessions=len(session_resume.by_id),
+                                                          suspended=len(session_resume.by_id) - len(session_resume.by_sid)))
+metrics.register('voice', lambda: dict(voice_rosters.stats, members=len(voice_rosters.by_sid)))
+metrics.register('read_states', lambda: dict(read_states.stats, pending=len(read_states.pending)))
+metrics.register('socket_rate_limits', rate_limiter.metrics)
+metrics.register('socket_outbound', lambda: outbound_guard.stats)
+metrics.register('presence', lambda: {'connected_users': len(presence.connections)})
 
 # Initialize models with the app context
 with app.app_context():
@@ -20,17 +72,51 @@ with app.app_context():
     from routes.auth import auth_bp
     from routes.servers import servers_bp
     from routes.channels import channels_bp
+    from routes.search import search_bp
+    from routes.threads import threads_bp
+    from routes.uploads import uploads_bp
+    from routes.attachments import attachments_bp
+    from routes.read_states import read_states_bp
+    from routes.metrics import metrics_bp
     
     # Register blueprints
     app.register_blueprint(auth_bp)
     app.register_blueprint(servers_bp)
     app.register_blueprint(channels_bp)
+    app.register_blueprint(search_bp)
+    app.register_blueprint(threads_bp)
+    app.register_blueprint(uploads_bp)
+    app.register_blueprint(attachments_bp)
+    app.register_blueprint(read_states_bp)
+    app.register_blueprint(metrics_bp)
     
     # Create all tables
     db.create_all()
+    upgrade_schema(db.engine, db.metadata)
+    if install_search_index(db.engine) and db.session.query(Message.id).first():
+        app.logger.warning('Search index created over existing messages; '
+                           'run `flask --app app rebuild-search-index` to fill it')
 
-# Import socket handlers
-from sockets import socketio as socket_handlers
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the full-text search index from the messages table and the archive."""
+    rebuild_search_index(db.engine)
+    archived = archive.reindex()
+    print(f'Search index rebuilt ({archived} archived messages)')
+
+@app.cli.command('archive-messages')
+@click.option('--days', type=float, default=None, help='Archive messages older than this (default ARCHIVE_AFTER_DAYS).')
+@click.option('--vacuum', is_flag=True, help='VACUUM the database afterwards to return the space.')
+def archive_messages_command(days, vacuum):
+    """Move old messages from the database into the archive segments."""
+    if days is None and archive.after_days is None:
+        raise click.UsageError('Pass --days or set ARCHIVE_AFTER_DAYS')
+    moved = archive.run(after_days=days)
+    print(f'Archived {moved} messages')
+    if vacuum:
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql('VACUUM')
+        print('Database vacuumed')
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, port=5000, host='0.0.0.0')
+    socketio.run(app, debug=app.debug, port=int(os.environ.get('PORT', 5000)), host='0.0.0.0')
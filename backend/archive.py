@@ -0,0 +1,513 @@
+import mmap
+import os
+import shutil
+import struct
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy.dialects.sqlite import insert
+from models import db, ArchiveEntry, Channel, Message
+from wire import dumps, loads
+import search
+
+# Cold tier for channel history. Old messages move out of the messages
+# table into per-channel, append-only segment files:
+#
+#   <ARCHIVE_FOLDER>/<channel_id>/index       one fixed-size record per block
+#   <ARCHIVE_FOLDER>/<channel_id>/000001.seg  zlib-compressed blocks of messages
+#
+# A block holds ARCHIVE_BLOCK_SIZE consecutive messages in (created_at, id)
+# order. The index is sparse: it records where each block starts and ends,
+# so a read bisects the index, maps the segment and inflates only the blocks
+# it needs. Segments and index are only ever appended to, data first, so a
+# crash part-way through leaves unindexed bytes that nothing reads.
+#
+# Every archived message is older than every hot message of its channel
+# that could have been archived with it. Messages with replies or
+# attachments, and replies themselves, stay in the table, since threads and
+# downloads look them up there. History reads merge the two tiers (see
+# routes/channels.py), so clients cannot tell which tier a page came from.
+#
+# Each archived message keeps a row in archive_entries and its row in the
+# search index, so search still finds it (see search.py) and it can be
+# found by id alone. The first reply to an archived message restores it to
+# the table, where its reply count is kept; its segment copy stays, and
+# history reads prefer the table's.
+#
+# Config:
+#   ARCHIVE_AFTER_DAYS       archive messages older than this; None (default)
+#                            leaves everything in the database
+#   ARCHIVE_INTERVAL         seconds between background archive runs
+#                            (default 3600); None runs it only from the CLI.
+#                            The runs start with the app, however it is
+#                            launched, once ARCHIVE_AFTER_DAYS is set
+#   ARCHIVE_FOLDER           default <instance>/archive
+#   ARCHIVE_BLOCK_SIZE       messages per compressed block (default 256)
+#   ARCHIVE_SEGMENT_MAX_BYTES  start a new segment file past this size
+#                            (default 64 MiB)
+
+# segment, offset, length, count, first (us, id), last (us, id), min id, max id
+INDEX_RECORD = struct.Struct('<IQIIqqqqqq')
+EPOCH = datetime(1970, 1, 1)
+MAX_OPEN_SEGMENTS = 256
+MAX_CACHED_BLOCKS = 512
+DELETE_CHUNK = 500
+
+IndexEntry = namedtuple('IndexEntry', ['segment', 'offset', 'length', 'count',
+                                       'first', 'last', 'min_id', 'max_id'])
+
+ArchivedMessage = namedtuple('ArchivedMessage', [
+    'id', 'channel_id', 'user_id', 'content', 'created_at', 'edited_at',
+    'parent_id', 'reply_count', 'last_reply_at'
+], defaults=(None, 0, None))
+
+def _micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+def _datetime(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+def _key(key):
+    # (created_at, id) -> (microseconds, id), the order blocks are kept in
+    return (_micros(key[0]), key[1])
+
+# The blocking halves of reads and writes, run off the hub under eventlet
+
+def _inflate(segment, offset, length):
+    # Slicing the map may fault the pages in from disk
+    return loads(zlib.decompress(segment[offset:offset + length]))
+
+def _write_blocks(path, index_path, segment, blocks):
+    """Compress and append blocks of message rows, then their index records; returns the block count."""
+    records = []
+    with open(path, 'ab') as f:
+        offset = f.tell()
+        for block in blocks:
+            data = zlib.compress(dumps(block).encode('utf-8'))
+            f.write(data)
+            first, last = block[0], block[-1]
+            ids = [row[0] for row in block]
+            records.append(INDEX_RECORD.pack(
+                segment, offset, len(data), len(block),
+                first[2], first[0], last[2], last[0], min(ids), max(ids)
+            ))
+            offset += len(data)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(index_path, 'ab') as f:
+        f.write(b''.join(records))
+        f.flush()
+        os.fsync(f.fileno())
+    return len(records)
+
+class ChannelIndex:
+    __slots__ = ('entries', 'firsts', 'lasts', 'size', 'count')
+
+    def __init__(self):
+        self.entries = []
+        self.firsts = []
+        self.lasts = []
+        self.size = 0  # bytes of the index file read so far
+        self.count = 0
+
+    def extend(self, data):
+        for fields in INDEX_RECORD.iter_unpack(data):
+            segment, offset, length, count, first_us, first_id, last_us, last_id, min_id, max_id = fields
+            entry = IndexEntry(segment, offset, length, count, (first_us, first_id),
+                               (last_us, last_id), min_id, max_id)
+            self.entries.append(entry)
+            self.firsts.append(entry.first)
+            self.lasts.append(entry.last)
+            self.count += count
+        self.size += len(data)
+
+class MessageArchive:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.root = None
+        self.after_days = None
+        self.interval = 3600
+        self.block_size = 256
+        self.segment_max_bytes = 64 * 1024 * 1024
+        self._indexes = {}  # channel_id -> ChannelIndex
+        self._maps = OrderedDict()  # (channel_id, segment) -> (file, mmap)
+        self._blocks = OrderedDict()  # (channel_id, segment, offset) -> [ArchivedMessage]
+        self._worker = None
+        self.green = False
+        self.stats = {'blocks_read': 0, 'block_hits': 0, 'messages_archived': 0,
+                      'blocks_written': 0, 'runs': 0}
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.root = app.config.get('ARCHIVE_FOLDER') or os.path.join(app.instance_path, 'archive')
+        self.after_days = app.config.get('ARCHIVE_AFTER_DAYS')
+        self.interval = app.config.get('ARCHIVE_INTERVAL', 3600)
+        self.block_size = app.config.get('ARCHIVE_BLOCK_SIZE', 256)
+        self.segment_max_bytes = app.config.get('ARCHIVE_SEGMENT_MAX_BYTES', 64 * 1024 * 1024)
+        self.green = socketio.server is not None and socketio.server.async_mode == 'eventlet'
+        self.start()
+
+    def _offload(self, fn, *args):
+        # zlib and file I/O would stall every other greenlet; tpool runs
+        # them on a native thread, as passwords.py does for bcrypt
+        if self.green:
+            from eventlet import tpool
+            return tpool.execute(fn, *args)
+        return fn(*args)
+
+    def _dir(self, channel_id):
+        return os.path.join(self.root, str(channel_id))
+
+    def _segment_path(self, channel_id, segment):
+        return os.path.join(self._dir(channel_id), f'{segment:06d}.seg')
+
+    def _index(self, channel_id):
+        # Picks up blocks appended since the last look, by this process or
+        # another one. Channels that were never archived cost one stat().
+        path = os.path.join(self._dir(channel_id), 'index')
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+        index = self._indexes.get(channel_id)
+        if index is None:
+            index = self._indexes[channel_id] = ChannelIndex()
+        usable = size - size % INDEX_RECORD.size
+        if usable > index.size:
+            with open(path, 'rb') as f:
+                f.seek(index.size)
+                index.extend(f.read(usable - index.size))
+        return index if index.entries else None
+
+    def _map(self, channel_id, segment):
+        key = (channel_id, segment)
+        mapped = self._maps.get(key)
+        if mapped is not None:
+            self._maps.move_to_end(key)
+            return mapped[1]
+        f = open(self._segment_path(channel_id, segment), 'rb')
+        mapped = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        self._maps[key] = mapped
+        while len(self._maps) > MAX_OPEN_SEGMENTS:
+            _, (old_file, old_map) = self._maps.popitem(last=False)
+            old_map.close()
+            old_file.close()
+        return mapped[1]
+
+    def _block(self, channel_id, entry, cache=True):
+        key = (channel_id, entry.segment, entry.offset)
+        messages = self._blocks.get(key)
+        if messages is not None:
+            self._blocks.move_to_end(key)
+            self.stats['block_hits'] += 1
+            return messages
+
+        segment = self._map(channel_id, entry.segment)
+        if entry.offset + entry.length > len(segment):
+            # Appended after this segment was mapped
+            self._close_map(channel_id, entry.segment)
+            segment = self._map(channel_id, entry.segment)
+        rows = self._offload(_inflate, segment, entry.offset, entry.length)
+        messages = [ArchivedMessage(
+            id=message_id,
+            channel_id=channel_id,
+            user_id=user_id,
+            content=content,
+            created_at=_datetime(created_us),
+            edited_at=_datetime(edited_us) if edited_us is not None else None
+        ) for message_id, user_id, created_us, edited_us, content in rows]
+        self.stats['blocks_read'] += 1
+        if not cache:
+            return messages
+        self._blocks[key] = messages
+        while len(self._blocks) > MAX_CACHED_BLOCKS:
+            self._blocks.popitem(last=False)
+        return messages
+
+    def _close_map(self, channel_id, segment):
+        mapped = self._maps.pop((channel_id, segment), None)
+        if mapped is not None:
+            mapped[1].close()
+            mapped[0].close()
+
+    # Reads
+
+    def max_key(self, channel_id):
+        """(created_at, id) of the newest archived message of a channel, or None."""
+        index = self._index(channel_id)
+        if index is None:
+            return None
+        last_us, last_id = index.lasts[-1]
+        return (_datetime(last_us), last_id)
+
+    def count(self, channel_id):
+        index = self._index(channel_id)
+        return index.count if index is not None else 0
+
+    def id_range(self, channel_id):
+        """(lowest, highest) archived message id of a channel, or None."""
+        index = self._index(channel_id)
+        if index is None:
+            return None
+        return (min(entry.min_id for entry in index.entries),
+                max(entry.max_id for entry in index.entries))
+
+    def scan(self, channel_id):
+        """Every archived message of a channel, oldest first, one block in memory at a time."""
+        index = self._index(channel_id)
+        if index is None:
+            return
+        for entry in index.entries:
+            # A full walk would only evict the blocks readers are using
+            yield from self._block(channel_id, entry, cache=False)
+
+    def channel_ids(self):
+        """Ids of the channels with an archive directory."""
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def find_by_id(self, message_id):
+        """An archived message by id alone, or None."""
+        entry = db.session.get(ArchiveEntry, message_id)
+        return self.find(entry.channel_id, message_id) if entry is not None else None
+
+    def find(self, channel_id, message_id):
+        index = self._index(channel_id)
+        if index is None:
+            return None
+        for entry in index.entries:
+            if entry.min_id <= message_id <= entry.max_id:
+                for message in self._block(channel_id, entry):
+                    if message.id == message_id:
+                        return message
+        return None
+
+    def older(self, channel_id, key, limit):
+        """Up to ``limit`` archived messages before ``key`` (None: the newest), newest first."""
+        index = self._index(channel_id)
+        if index is None:
+            return []
+        position = _key(key) if key is not None else None
+        block = bisect_left(index.firsts, position) - 1 if position is not None else len(index.entries) - 1
+        found = []
+        while block >= 0 and len(found) < limit:
+            for message in reversed(self._block(channel_id, index.entries[block])):
+                if position is None or (_micros(message.created_at), message.id) < position:
+                    found.append(message)
+                    if len(found) == limit:
+                        break
+            block -= 1
+        return found
+
+    def newer(self, channel_id, key, limit):
+        """Up to ``limit`` archived messages after ``key``, oldest first."""
+        index = self._index(channel_id)
+        if index is None:
+            return []
+        position = _key(key)
+        block = bisect_right(index.lasts, position)
+        found = []
+        while block < len(index.entries) and len(found) < limit:
+            for message in self._block(channel_id, index.entries[block]):
+                if (_micros(message.created_at), message.id) > position:
+                    found.append(message)
+                    if len(found) == limit:
+                        break
+            block += 1
+        return found
+
+    # Writes
+
+    def drop(self, channel_id):
+        # For deleted channels
+        if self._index(channel_id) is not None:
+            connection = db.session.connection()
+            restored = self._restored(channel_id)
+            batch = []
+            for message in self.scan(channel_id):
+                if message.id not in restored:
+                    batch.append((message.id, message.content))
+                if len(batch) == DELETE_CHUNK:
+                    search.unindex_rows(connection, batch)
+                    batch = []
+            search.unindex_rows(connection, batch)
+        db.session.execute(db.delete(ArchiveEntry).where(ArchiveEntry.channel_id == channel_id))
+        db.session.commit()
+        for key in [key for key in self._maps if key[0] == channel_id]:
+            self._close_map(*key)
+        for key in [key for key in self._blocks if key[0] == channel_id]:
+            del self._blocks[key]
+        self._indexes.pop(channel_id, None)
+        shutil.rmtree(self._dir(channel_id), ignore_errors=True)
+
+    def _append(self, channel_id, messages):
+        """Append messages, in (created_at, id) order, as new blocks; returns their ids."""
+        os.makedirs(self._dir(channel_id), exist_ok=True)
+        index = self._index(channel_id)
+        segment = index.entries[-1].segment if index is not None else 1
+        path = self._segment_path(channel_id, segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_max_bytes:
+            segment += 1
+            path = self._segment_path(channel_id, segment)
+
+        blocks = [[[
+            message.id,
+            message.user_id,
+            _micros(message.created_at),
+            _micros(message.edited_at) if message.edited_at else None,
+            message.content
+        ] for message in messages[start:start + self.block_size]]
+            for start in range(0, len(messages), self.block_size)]
+        written = self._offload(_write_blocks, path, os.path.join(self._dir(channel_id), 'index'),
+                                segment, blocks)
+        self.stats['blocks_written'] += written
+        return [message.id for message in messages]
+
+    def _restored(self, channel_id):
+        # Archived messages of a channel that are back in the table
+        return {row.id for row in db.session.query(Message.id)
+                .join(ArchiveEntry, ArchiveEntry.id == Message.id)
+                .filter(ArchiveEntry.channel_id == channel_id)}
+
+    def restore(self, channel_id, message_id):
+        """Put an archived message back in the table, in the current transaction.
+
+        Returns False when it is not archived. Its index row is replaced by
+        the one the insert trigger writes.
+        """
+        message = self.find(channel_id, message_id)
+        if message is None:
+            return False
+        connection = db.session.connection()
+        search.unindex_rows(connection, [(message.id, message.content)])
+        db.session.execute(db.insert(Message).values(
+            id=message.id, channel_id=channel_id, user_id=message.user_id, content=message.content,
+            created_at=message.created_at, edited_at=message.edited_at))
+        return True
+
+    def reindex(self):
+        """Record every archived message in archive_entries and the search index.
+
+        For archives written before either was kept, and after the search
+        index is rebuilt from the messages table, which leaves archived
+        messages out. Returns the number of messages indexed.
+        """
+        indexed = 0
+        connection = db.session.connection()
+        for channel_id in self.channel_ids():
+            restored = self._restored(channel_id)
+            batch = []
+            for message in self.scan(channel_id):
+                if message.id not in restored:
+                    batch.append(message)
+                if len(batch) == DELETE_CHUNK:
+                    self._record(channel_id, batch)
+                    search.index_rows(connection, [(m.id, m.content) for m in batch])
+                    indexed += len(batch)
+                    batch = []
+            self._record(channel_id, batch)
+            search.index_rows(connection, [(m.id, m.content) for m in batch])
+            indexed += len(batch)
+        db.session.commit()
+        return indexed
+
+    def _record(self, channel_id, messages):
+        if messages:
+            db.session.execute(insert(ArchiveEntry).on_conflict_do_nothing(), [
+                {'id': message.id, 'channel_id': channel_id, 'user_id': message.user_id,
+                 'created_at': message.created_at}
+                for message in messages
+            ])
+
+    def _candidates(self, channel_id, cutoff, limit):
+        return Message.query\
+            .filter(Message.channel_id == channel_id,
+                    Message.created_at < cutoff,
+                    Message.parent_id.is_(None),
+                    Message.reply_count == 0,
+                    ~Message.attachments.any())\
+            .order_by(Message.created_at.asc(), Message.id.asc())\
+            .limit(limit)\
+            .all()
+
+    def archive_channel(self, channel_id, cutoff, batch_size=10000):
+        """Move a channel's archivable messages older than ``cutoff`` to its segments."""
+        moved = 0
+        while True:
+            rows = self._candidates(channel_id, cutoff, batch_size)
+            if not rows:
+                return moved
+            boundary = self.max_key(channel_id)
+            # Rows at or below the boundary were archived by a run that
+            # stopped before deleting them
+            done = [row.id for row in rows
+                    if boundary is not None and (row.created_at, row.id) <= boundary]
+            fresh = [row for row in rows
+                     if boundary is None or (row.created_at, row.id) > boundary]
+            if fresh:
+                done += self._append(channel_id, fresh)
+            moving = set(done)
+            self._record(channel_id, [row for row in rows if row.id in moving])
+            db.session.expunge_all()
+            # Deleted from the table but not from the search index
+            connection = db.session.connection()
+            reindex = search.enabled and search.pause_delete_indexing(connection)
+            for start in range(0, len(done), DELETE_CHUNK):
+                db.session.execute(
+                    db.delete(Message).where(Message.id.in_(done[start:start + DELETE_CHUNK]))
+                    .execution_options(synchronize_session=False)
+                )
+            if reindex:
+                search.resume_delete_indexing(connection)
+            db.session.commit()
+            moved += len(fresh)
+            self.stats['messages_archived'] += len(fresh)
+            if len(rows) < batch_size:
+                return moved
+
+    def run(self, now=None, after_days=None):
+        """Archive every channel; returns the number of messages moved."""
+        after_days = after_days if after_days is not None else self.after_days
+        if after_days is None:
+            return 0
+        cutoff = (now or datetime.utcnow()) - timedelta(days=after_days)
+        moved = 0
+        for (channel_id,) in db.session.query(Channel.id).filter(Channel.type == 'text').order_by(Channel.id).all():
+            has_old = db.session.query(Message.id)\
+                .filter(Message.channel_id == channel_id, Message.created_at < cutoff)\
+                .first()
+            if has_old:
+                moved += self.archive_channel(channel_id, cutoff)
+        self.stats['runs'] += 1
+        return moved
+
+    def start(self):
+        if self._worker is not None or self.after_days is None or not self.interval \
+                or self.socketio is None or self.socketio.server is None:
+            return
+        self._worker = self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            started = time.monotonic()
+            try:
+                with self.app.app_context():
+                    moved = self.run()
+                    if moved:
+                        self.app.logger.info('Archived %d messages in %.1fs', moved,
+                                             time.monotonic() - started)
+            except Exception:
+                self.app.logger.exception('Message archive run failed')
+            finally:
+                with self.app.app_context():
+                    db.session.remove()
+
+archive = MessageArchive()
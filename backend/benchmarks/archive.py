@@ -0,0 +1,136 @@
+"""Database size and deep-history read latency, before and after archiving.
+
+Seeds a database (or copies --database), then reads random history pages of
+the busiest channel through the Flask app, in-process: "recent" cursors fall
+in the newest quarter of the channel, "deep" ones in the oldest half. Then
+it archives everything older than --days, VACUUMs, and reads the same pages
+again, once with a cold block cache and once warm. Sizes are reported after
+VACUUM on both sides.
+
+    python benchmarks/archive.py --messages 2000000 --days 30
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.harness import compare, print_results, summarize, write_results
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+def read_pages(client, headers, channel_id, cursors, limit):
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for cursor in cursors:
+        t = time.perf_counter()
+        response = client.get(f'/api/channels/{channel_id}', headers=headers,
+                              query_string={'before': cursor, 'limit': limit, 'count': 'false'})
+        latencies.append(time.perf_counter() - t)
+        if response.status_code != 200:
+            errors += 1
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=None, help='seeded database to copy instead of seeding')
+    parser.add_argument('--messages', type=int, default=500000, help='messages to seed')
+    parser.add_argument('--days', type=float, default=None,
+                        help='archive messages older than this (default: the older half of the history)')
+    parser.add_argument('--reads', type=int, default=500, help='pages read per case')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help='result file, JSON')
+    parser.add_argument('--baseline', default=None, help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='commi8-archive-')
+    try:
+        database = os.path.join(workdir, 'archive.db')
+        if args.database:
+            shutil.copy(args.database, database)
+        else:
+            subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed.py'),
+                            '--output', database, '--users', '200', '--servers', '5',
+                            '--messages', str(args.messages)],
+                           check=True, stdout=subprocess.DEVNULL)
+        settings = os.path.join(workdir, 'settings.py')
+        with open(settings, 'w') as f:
+            f.write(f'SQLALCHEMY_DATABASE_URI = {"sqlite:///" + database!r}\n'
+                    f'ARCHIVE_FOLDER = {os.path.join(workdir, "segments")!r}\n'
+                    f'MESSAGE_CACHE_ENABLED = False\n')
+        os.environ['COMMI8_SETTINGS'] = settings
+        os.environ.setdefault('COMMI8_ENV', 'production')
+
+        from app import app
+        from archive import archive
+        from models import db
+        from routes.auth import generate_token
+
+        rng = random.Random(args.seed)
+        client = app.test_client()
+        headers = {'Authorization': f'Bearer {generate_token(1)}'}
+        results = {}
+        with app.app_context():
+            channel_id = db.session.execute(db.text(
+                'SELECT channel_id FROM messages JOIN channels ON channels.id = messages.channel_id '
+                'WHERE channels.server_id = 1 GROUP BY channel_id ORDER BY count(*) DESC LIMIT 1'
+            )).scalar()
+            ids = [row[0] for row in db.session.execute(db.text(
+                'SELECT id FROM messages WHERE channel_id = :channel ORDER BY created_at, id'
+            ), {'channel': channel_id})]
+            oldest, newest = db.session.execute(db.text(
+                'SELECT min(created_at), max(created_at) FROM messages')).one()
+            cases = {
+                'deep': [rng.choice(ids[:len(ids) // 2]) for _ in range(args.reads)],
+                'recent': [rng.choice(ids[-len(ids) // 4:]) for _ in range(args.reads)]
+            }
+
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('VACUUM')
+            db_before = os.path.getsize(database)
+            for name, cursors in cases.items():
+                results[f'db_only_{name}'] = read_pages(client, headers, channel_id, cursors, args.limit)
+
+            days = args.days
+            if days is None:
+                span = datetime.fromisoformat(str(newest)) - datetime.fromisoformat(str(oldest))
+                days = span.total_seconds() / 86400 / 2
+            started = time.perf_counter()
+            moved = archive.run(after_days=days)
+            archive_seconds = time.perf_counter() - started
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('VACUUM')
+            db_after = os.path.getsize(database)
+            segments = directory_size(archive.root)
+
+            for name, cursors in cases.items():
+                archive._blocks.clear()
+                results[f'archived_{name}_cold'] = read_pages(client, headers, channel_id, cursors, args.limit)
+                results[f'archived_{name}_warm'] = read_pages(client, headers, channel_id, cursors, args.limit)
+
+        print_results(results)
+        print(f'archived {moved} messages older than {days:.1f} days in {archive_seconds:.1f}s')
+        print(f'database: {db_before / 2**20:.1f} MiB -> {db_after / 2**20:.1f} MiB, '
+              f'segments: {segments / 2**20:.1f} MiB')
+        params = dict(vars(args), days=days, moved=moved, db_bytes_before=db_before,
+                      db_bytes_after=db_after, segment_bytes=segments)
+        if args.output:
+            write_results(args.output, results, params)
+            print(f'results written to {args.output}')
+        if args.baseline:
+            compare(args.baseline, results)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
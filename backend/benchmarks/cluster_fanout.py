@@ -0,0 +1,107 @@
+"""Cross-worker Socket.IO fanout through the cluster backends.
+
+Starts two Socket.IO workers (A and B) on localhost ports, sharing one
+pub/sub backend. A client connected to B joins a room, a client connected to
+A broadcasts to it, and the script checks each broadcast reaches B and
+reports the delivery latency. Needs benchmarks/requirements.txt.
+
+    python benchmarks/cluster_fanout.py --backend memory --messages 1000
+    python benchmarks/cluster_fanout.py --backend local
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socketio as socketio_client
+from flask import Flask
+from flask_socketio import SocketIO, join_room
+
+from cluster import create_client_manager, make_relay
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def start_worker(name, url, port):
+    app = Flask(name)
+    socketio = SocketIO(app, async_mode='threading',
+                        client_manager=create_client_manager(url, 'bench'))
+
+    @socketio.on('join')
+    def handle_join(room):
+        join_room(room)
+        return True
+
+    @socketio.on('say')
+    def handle_say(data):
+        socketio.emit('said', data, room=data['room'])
+
+    threading.Thread(target=socketio.run, args=(app,), daemon=True,
+                     kwargs={'port': port, 'allow_unsafe_werkzeug': True}).start()
+    return socketio
+
+def connect(port):
+    client = socketio_client.Client()
+    for _ in range(50):
+        try:
+            client.connect(f'http://127.0.0.1:{port}')
+            return client
+        except socketio_client.exceptions.ConnectionError:
+            time.sleep(0.1)
+    raise SystemExit(f'worker on port {port} did not start')
+
+def run(url, messages, port):
+    start_worker('worker_a', url, port)
+    start_worker('worker_b', url, port + 1)
+    client_a = connect(port)
+    client_b = connect(port + 1)
+
+    received = {}
+    arrived = threading.Event()
+
+    @client_b.on('said')
+    def on_said(data):
+        received[data['seq']] = time.perf_counter()
+        arrived.set()
+
+    client_b.call('join', 'channel_1')
+
+    latencies = []
+    for i in range(messages):
+        arrived.clear()
+        sent = time.perf_counter()
+        client_a.emit('say', {'room': 'channel_1', 'seq': i})
+        if not arrived.wait(5) or i not in received:
+            raise SystemExit(f'message {i} sent on worker A never reached worker B')
+        latencies.append(received[i] - sent)
+
+    client_a.disconnect()
+    client_b.disconnect()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=('memory', 'local'), default='memory')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=5101, help='worker A port, B uses the next one')
+    parser.add_argument('--relay-port', type=int, default=6391)
+    args = parser.parse_args()
+
+    if args.backend == 'local':
+        url = f'local://127.0.0.1:{args.relay_port}'
+        relay = make_relay(url)
+        threading.Thread(target=relay.serve_forever, daemon=True).start()
+    else:
+        url = 'memory://bench'
+
+    latencies = run(url, args.messages, args.port)
+    print(f'{args.backend}: {len(latencies)} messages from worker A delivered on worker B')
+    print(f'  p50 {percentile(latencies, 50) * 1000:.2f} ms  '
+          f'p99 {percentile(latencies, 99) * 1000:.2f} ms')
+
+if __name__ == '__main__':
+    main()
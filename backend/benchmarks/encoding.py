@@ -0,0 +1,109 @@
+"""Encode throughput of message pages and room broadcasts, before and after wire.py.
+
+REST: one history page (50 messages with authors and some attachments)
+through Flask's default JSON provider, FastJSONProvider (orjson) and
+MessagePack. Socket.IO: one new_message broadcast to a room, encoded per
+recipient with the stdlib json module as python-socketio's own manager does,
+and encoded once with orjson as EncodeOnceManager does.
+
+    python benchmarks/encoding.py --seconds 2 --room 500
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from socketio import packet
+
+from benchmarks.harness import compare, print_results, summarize, write_results
+import wire
+
+def message_page(size=50):
+    start = datetime(2024, 5, 1, 12, 0, 0, 123456)
+    return {
+        'channel': {
+            'id': 7,
+            'name': 'general',
+            'type': 'text',
+            'messages': [{
+                'id': 100000 + i,
+                'content': 'deploy went out, can someone check the build logs for the review app? ' * (1 + i % 3),
+                'channel_id': 7,
+                'created_at': (start + timedelta(seconds=i * 37)).isoformat(),
+                'edited_at': None,
+                'author': {'id': i % 12 + 1, 'username': f'user{i % 12 + 1}', 'avatar_url': None},
+                'attachments': [{
+                    'id': i,
+                    'filename': 'screenshot.png',
+                    'file_url': f'/uploads/{i}/screenshot.png'
+                }] if i % 10 == 0 else []
+            } for i in range(size)],
+            'pagination': {'per_page': size, 'has_more': True, 'before': 100000, 'after': 100000 + size - 1}
+        }
+    }
+
+def measure(fn, seconds):
+    samples = []
+    deadline = time.perf_counter() + seconds
+    started = time.perf_counter()
+    while time.perf_counter() < deadline:
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return summarize(samples, time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=2, help='seconds per case')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--room', type=int, default=200, help='recipients per broadcast')
+    parser.add_argument('--output', default=None, help='result file, JSON')
+    parser.add_argument('--baseline', default=None, help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    page = message_page(args.page_size)
+    broadcast = {'message': page['channel']['messages'][0]}
+    default = DefaultJSONProvider(app)
+    fast = wire.FastJSONProvider(app)
+
+    class StdlibPacket(packet.Packet):
+        json = json
+
+    class FastPacket(packet.Packet):
+        json = wire.SocketJSON
+
+    def per_recipient():
+        for _ in range(args.room):
+            StdlibPacket(packet.EVENT, namespace='/', data=['new_message', broadcast]).encode()
+
+    def once():
+        FastPacket(packet.EVENT, namespace='/', data=['new_message', broadcast]).encode()
+
+    cases = {
+        'page_flask_json': lambda: default.dumps(page),
+        'page_orjson': lambda: fast.dumps(page),
+        'broadcast_per_recipient': per_recipient,
+        'broadcast_encode_once': once
+    }
+    if wire.msgpack is not None:
+        cases['page_msgpack'] = lambda: wire.packb(page)
+
+    results = {name: measure(fn, args.seconds) for name, fn in cases.items()}
+    print_results(results)
+    print(f"page: {len(default.dumps(page))} bytes JSON"
+          + (f", {len(wire.packb(page))} bytes MessagePack" if wire.msgpack is not None else ''))
+    if args.output:
+        write_results(args.output, results, vars(args))
+        print(f'results written to {args.output}')
+    if args.baseline:
+        compare(args.baseline, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Shared helpers for the benchmark scripts: latency summaries, the
+# machine-readable result file and comparison between two runs.
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def summarize(latencies, seconds, errors=0):
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'per_sec': len(latencies) / seconds if seconds else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0
+    }
+
+def start_server(database, port, log, settings=None, profile='production', environ=None):
+    """Run app.py with a config profile on a localhost port; returns (process, base_url)."""
+    import requests
+
+    env = dict(os.environ,
+               COMMI8_ENV=profile,
+               DATABASE_URL=f'sqlite:///{database}',
+               PORT=str(port),
+               **(environ or {}))
+    if settings:
+        env['COMMI8_SETTINGS'] = settings
+    process = subprocess.Popen([sys.executable, 'app.py'], cwd=BACKEND_DIR, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(300):
+        if process.poll() is not None:
+            raise SystemExit(f'app.py exited with {process.returncode}, see {log.name}')
+        try:
+            requests.get(f'{base_url}/api/servers/', timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise SystemExit(f'app.py did not start, see {log.name}')
+
+def connect_client(base_url, token, **handlers):
+    """A python-socketio client authenticated as the token's user."""
+    import socketio
+
+    # app.py only accepts this origin; websocket-client would add its own
+    client = socketio.Client(reconnection=False, websocket_extra_options={'suppress_origin': True})
+    for event, handler in handlers.items():
+        client.on(event, handler)
+    client.connect(f'{base_url}?token={token}', headers={'Origin': 'http://localhost:8000'},
+                   transports=['websocket'])
+    return client
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(path, results, params):
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'params': params
+        },
+        'results': results
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+def print_results(results):
+    for name, stats in results.items():
+        print(f"{name:24} n={stats['count']:<7} {stats['per_sec']:9.1f}/s  "
+              f"p50 {stats['p50_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms  "
+              f"errors {stats['errors']}")
+
+def compare(baseline_path, results):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print(f'compared with {baseline_path}:')
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ('per_sec', 'p50_ms', 'p99_ms'):
+            if before[key]:
+                changes.append(f'{key} {100 * (stats[key] - before[key]) / before[key]:+.1f}%')
+        print(f"{name:24} {'  '.join(changes)}")
@@ -0,0 +1,223 @@
+"""Load test the REST API and Socket.IO events against a seeded database.
+
+Starts app.py on a localhost port against a database made by seed.py, then
+runs each scenario for a fixed time with many concurrent clients:
+
+  rest_servers       GET /api/servers/
+  rest_history       GET /api/channels/<id>, the first page
+  rest_history_deep  GET /api/channels/<id>?before=<id>, an older page
+  rest_send          POST /api/channels/<id>/messages
+  socket_send        message events, until the sender sees new_message
+  socket_fanout      the same messages, until every other client in the
+                     channel sees them
+
+Each scenario reports throughput and p50/p99 latency. The results are
+written as JSON with the run parameters, and --baseline prints the change
+against an earlier result file. Sends add messages to the database, so
+re-seed for exactly repeatable runs. Needs benchmarks/requirements.txt.
+
+    python benchmarks/seed.py
+    python benchmarks/load_test.py --output before.json
+    python benchmarks/load_test.py --output after.json --baseline before.json
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from benchmarks.harness import compare, connect_client, print_results, start_server, summarize, write_results
+from benchmarks.seed import DEFAULT_OUTPUT
+from routes.auth import generate_token
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def load_dataset(path, server_id, samples=1000):
+    """Return the members of a server and, per text channel, a sample of its message ids."""
+    connection = sqlite3.connect(path)
+    rng = random.Random(0)
+    try:
+        users = [row[0] for row in connection.execute(
+            'SELECT user_id FROM server_members WHERE server_id = ? ORDER BY user_id', (server_id,))]
+        channels = {}
+        for (channel_id,) in connection.execute(
+                "SELECT id FROM channels WHERE server_id = ? AND type = 'text'", (server_id,)).fetchall():
+            ids = [row[0] for row in connection.execute(
+                'SELECT id FROM messages WHERE channel_id = ?', (channel_id,))]
+            channels[channel_id] = rng.sample(ids, min(samples, len(ids)))
+    finally:
+        connection.close()
+    if not users or not channels:
+        raise SystemExit(f'server {server_id} has no members or text channels in {path}')
+    return users, channels
+
+def run_rest(base_url, tokens, make_request, concurrency, duration):
+    deadline = time.perf_counter() + duration
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+
+    def worker(index):
+        session = requests.Session()
+        session.headers['Authorization'] = f'Bearer {tokens[index % len(tokens)]}'
+        rng = random.Random(index)
+        while time.perf_counter() < deadline:
+            method, path, body = make_request(rng)
+            started = time.perf_counter()
+            try:
+                ok = session.request(method, base_url + path, json=body, timeout=30).status_code < 400
+            except requests.RequestException:
+                ok = False
+            if ok:
+                latencies[index].append(time.perf_counter() - started)
+            else:
+                errors[index] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return summarize([s for samples in latencies for s in samples],
+                     time.perf_counter() - started, sum(errors))
+
+def run_sockets(base_url, tokens, channel_ids, clients, senders, rate, duration):
+    """Time message events from emit to new_message, at the sender and at the rest of the room."""
+    send_latencies = []
+    fanout_latencies = []
+    sent = {}  # (sender, sequence) -> perf_counter at emit
+    lock = threading.Lock()
+    connected = []
+
+    def connect(index):
+        def on_new_message(data):
+            received = time.perf_counter()
+            parts = data['message']['content'].split()
+            if len(parts) != 3 or parts[0] != 'bench':
+                return
+            key = (int(parts[1]), int(parts[2]))
+            with lock:
+                emitted = sent.get(key)
+                if emitted is None:
+                    return
+                if key[0] == index:
+                    send_latencies.append(received - emitted)
+                else:
+                    fanout_latencies.append(received - emitted)
+
+        client = connect_client(base_url, tokens[index % len(tokens)], new_message=on_new_message)
+        client.call('join_channel', {'channel_id': channel_ids[index % len(channel_ids)]}, timeout=30)
+        return client
+
+    with ThreadPoolExecutor(16) as executor:
+        connected.extend(executor.map(connect, range(clients)))
+
+    deadline = time.perf_counter() + duration
+    interval = senders / rate
+
+    def sender(index):
+        client = connected[index]
+        channel_id = channel_ids[index % len(channel_ids)]
+        sequence = 0
+        next_send = time.perf_counter() + random.random() * interval
+        while next_send < deadline:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sequence += 1
+            with lock:
+                sent[(index, sequence)] = time.perf_counter()
+            client.emit('message', {'channel_id': channel_id, 'content': f'bench {index} {sequence}'})
+            next_send += interval
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(senders) as executor:
+        list(executor.map(sender, range(min(senders, clients))))
+    seconds = time.perf_counter() - started
+
+    # Give the last broadcasts time to arrive before counting losses
+    time.sleep(2)
+    for client in connected:
+        client.disconnect()
+
+    room_size = sum(1 for i in range(clients) if i % len(channel_ids) == 0)
+    expected_fanout = len(sent) * (room_size - 1)
+    return {
+        'socket_send': summarize(send_latencies, seconds, len(sent) - len(send_latencies)),
+        'socket_fanout': summarize(fanout_latencies, seconds, max(0, expected_fanout - len(fanout_latencies)))
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default=DEFAULT_OUTPUT)
+    parser.add_argument('--server-id', type=int, default=1, help='server whose channels are loaded')
+    parser.add_argument('--port', type=int, default=5200)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent REST clients')
+    parser.add_argument('--clients', type=int, default=48, help='connected Socket.IO clients')
+    parser.add_argument('--senders', type=int, default=8, help='clients that send messages')
+    parser.add_argument('--rate', type=float, default=100, help='socket messages per second, all senders')
+    parser.add_argument('--socket-channels', type=int, default=4, help='channels the socket clients spread over')
+    parser.add_argument('--scenarios', default='rest_servers,rest_history,rest_history_deep,rest_send,socket')
+    parser.add_argument('--output', default=None, help='result file, JSON')
+    parser.add_argument('--baseline', default=None, help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    database = os.path.abspath(args.database)
+    if not os.path.exists(database):
+        raise SystemExit(f'{database} does not exist, run benchmarks/seed.py first')
+    users, channels = load_dataset(database, args.server_id)
+    tokens = [generate_token(user_id) for user_id in users]
+    channel_ids = sorted(channels)
+    scenarios = args.scenarios.split(',')
+
+    def history(rng):
+        return 'GET', f'/api/channels/{rng.choice(channel_ids)}?count=false', None
+
+    def history_deep(rng):
+        channel_id = rng.choice([channel_id for channel_id in channel_ids if channels[channel_id]])
+        return 'GET', f'/api/channels/{channel_id}?count=false&before={rng.choice(channels[channel_id])}', None
+
+    def send(rng):
+        return 'POST', f'/api/channels/{rng.choice(channel_ids)}/messages', {'content': 'load test'}
+
+    rest = {
+        'rest_servers': lambda rng: ('GET', '/api/servers/', None),
+        'rest_history': history,
+        'rest_history_deep': history_deep,
+        'rest_send': send
+    }
+
+    log = tempfile.NamedTemporaryFile('w', prefix='commi8-load-', suffix='.log', delete=False)
+    process, base_url = start_server(database, args.port, log)
+    results = {}
+    try:
+        for name in scenarios:
+            if name in rest:
+                results[name] = run_rest(base_url, tokens, rest[name], args.concurrency, args.duration)
+            elif name == 'socket':
+                results.update(run_sockets(base_url, tokens, channel_ids[:args.socket_channels],
+                                           args.clients, args.senders, args.rate, args.duration))
+            else:
+                raise SystemExit(f'unknown scenario {name}')
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+
+    print_results(results)
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime('load-%Y%m%d-%H%M%S.json'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    params = dict(vars(args), database=database, members=len(users), channels=len(channel_ids))
+    write_results(output, results, params)
+    print(f'results written to {output}, server log {log.name}')
+    if args.baseline:
+        compare(args.baseline, results)
+
+if __name__ == '__main__':
+    main()
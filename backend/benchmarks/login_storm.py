@@ -0,0 +1,125 @@
+"""Socket latency during a login storm, with bcrypt inline and offloaded.
+
+Seeds a small database whose users have BCRYPT_ROUNDS-cost password hashes,
+then, for each mode, starts app.py and keeps one Socket.IO client doing
+join_channel round trips while many clients log in at once. With hashing on
+the eventlet hub ("inline") every login stalls the probe; offloaded to
+eventlet.tpool the probe latency should stay close to the idle figure.
+Needs benchmarks/requirements.txt.
+
+    python benchmarks/login_storm.py --rounds 12 --logins 32
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from benchmarks.harness import connect_client, compare, print_results, start_server, summarize, write_results
+from routes.auth import generate_token
+
+def probe(client, channel_id, stop, interval=0.02):
+    latencies = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        client.call('join_channel', {'channel_id': channel_id}, timeout=60)
+        latencies.append(time.perf_counter() - started)
+        time.sleep(interval)
+    return latencies
+
+def run_mode(database, workdir, port, offload, args):
+    settings = os.path.join(workdir, f'settings-{port}.py')
+    with open(settings, 'w') as f:
+        f.write(f'BCRYPT_ROUNDS = {args.rounds}\n'
+                f'PASSWORD_HASH_OFFLOAD = {offload}\n'
+                f'PASSWORD_HASH_CONCURRENCY = {args.concurrency}\n'
+                f'PASSWORD_HASH_QUEUE_TIMEOUT = 600\n')
+    log = open(os.path.join(workdir, f'server-{port}.log'), 'w')
+    process, base_url = start_server(database, port, log, settings=settings)
+    try:
+        client = connect_client(base_url, generate_token(1))
+        results = {}
+
+        stop = threading.Event()
+        with ThreadPoolExecutor(1) as executor:
+            idle = executor.submit(probe, client, 1, stop)
+            time.sleep(args.idle)
+            stop.set()
+        results['probe_idle'] = summarize(idle.result(), args.idle)
+
+        login_latencies = []
+        errors = [0]
+
+        def login(index):
+            session = requests.Session()
+            for attempt in range(args.logins_per_client):
+                started = time.perf_counter()
+                response = session.post(f'{base_url}/api/auth/login', json={
+                    'username': f'user{(index * args.logins_per_client + attempt) % args.users + 1}',
+                    'password': 'password'
+                }, timeout=600)
+                if response.status_code == 200:
+                    login_latencies.append(time.perf_counter() - started)
+                else:
+                    errors[0] += 1
+
+        stop = threading.Event()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.logins + 1) as executor:
+            storm = executor.submit(probe, client, 1, stop)
+            list(executor.map(login, range(args.logins)))
+            seconds = time.perf_counter() - started
+            stop.set()
+        results['probe_storm'] = summarize(storm.result(), seconds)
+        results['login'] = summarize(login_latencies, seconds, errors[0])
+        client.disconnect()
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt work factor')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--logins', type=int, default=32, help='concurrent login clients')
+    parser.add_argument('--logins-per-client', type=int, default=4, help='logins per client')
+    parser.add_argument('--concurrency', type=int, default=4, help='PASSWORD_HASH_CONCURRENCY')
+    parser.add_argument('--idle', type=float, default=3, help='seconds of probing before the storm')
+    parser.add_argument('--modes', default='inline,offload')
+    parser.add_argument('--port', type=int, default=5300)
+    parser.add_argument('--output', default=None, help='result file, JSON')
+    parser.add_argument('--baseline', default=None, help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='commi8-login-') as workdir:
+        database = os.path.join(workdir, 'login.db')
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed.py'),
+                        '--output', database, '--users', str(args.users), '--servers', '1',
+                        '--messages', '1000', '--bcrypt-rounds', str(args.rounds)],
+                       check=True, stdout=subprocess.DEVNULL)
+
+        results = {}
+        for index, mode in enumerate(args.modes.split(',')):
+            if mode not in ('inline', 'offload'):
+                raise SystemExit(f'unknown mode {mode}')
+            for name, stats in run_mode(database, workdir, args.port + index, mode == 'offload', args).items():
+                results[f'{mode}_{name}'] = stats
+
+    print_results(results)
+    if args.output:
+        write_results(args.output, results, vars(args))
+        print(f'results written to {args.output}')
+    if args.baseline:
+        compare(args.baseline, results)
+
+if __name__ == '__main__':
+    main()
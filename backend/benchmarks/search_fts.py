@@ -0,0 +1,142 @@
+"""Full-text search latency: FTS5 index against a LIKE scan.
+
+Builds a synthetic corpus in a temporary SQLite file, fills the index with
+the bulk rebuild path used by `flask rebuild-search-index`, then times
+searches through search.search_messages and the equivalent LIKE query.
+
+    python benchmarks/search_fts.py --messages 3000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import text
+
+from config import ProductionConfig
+from models import db
+from storage import init_storage
+from search import install_search_index, rebuild_search_index, search_messages
+
+VOCABULARY = 50000
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'pa', 'do', 'gu')
+
+def make_word(rank):
+    word = ''
+    while True:
+        rank, digit = divmod(rank, len(SYLLABLES))
+        word += SYLLABLES[digit]
+        if not rank:
+            return word
+
+# Word frequencies follow Zipf's law, as in real chat, so queries range from
+# very common terms to rare ones
+WORDS = [make_word(rank) for rank in range(VOCABULARY)]
+CUM_WEIGHTS = []
+_total = 0.0
+for _rank in range(VOCABULARY):
+    _total += 1.0 / (_rank + 1)
+    CUM_WEIGHTS.append(_total)
+QUERIES = (WORDS[5], WORDS[200], WORDS[5000], f'{WORDS[40]} {WORDS[300]}', WORDS[30][:3] + '*', 'zzzznothing')
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def seed(messages, channels, batch=50000):
+    rng = random.Random(42)
+    start = datetime(2023, 1, 1)
+    db.session.execute(text(
+        "INSERT INTO users (id, username, email, password_hash) VALUES (1, 'bench', 'b@example.com', 'x')"
+    ))
+    db.session.execute(text("INSERT INTO servers (id, name, owner_id) VALUES (1, 'bench', 1)"))
+    for channel_id in range(1, channels + 1):
+        db.session.execute(text(
+            "INSERT INTO channels (id, name, type, server_id) VALUES (:id, 'c', 'text', 1)"
+        ), {'id': channel_id})
+    insert = text('INSERT INTO messages (content, user_id, channel_id, created_at) '
+                  'VALUES (:content, 1, :channel_id, :created_at)')
+    for offset in range(0, messages, batch):
+        rows = []
+        for i in range(offset, min(offset + batch, messages)):
+            rows.append({
+                'content': ' '.join(rng.choices(WORDS, cum_weights=CUM_WEIGHTS, k=rng.randint(4, 16))),
+                'channel_id': i % channels + 1,
+                'created_at': start + timedelta(seconds=i * 10)
+            })
+        db.session.execute(insert, rows)
+        db.session.commit()
+
+def time_queries(fn, repeat):
+    results = {}
+    for query in QUERIES:
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn(query)
+            samples.append(time.perf_counter() - started)
+        results[query] = (percentile(samples, 50) * 1000, percentile(samples, 99) * 1000)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=3000000)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    app = Flask(__name__)
+    app.config.from_object(ProductionConfig)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    db.init_app(app)
+    init_storage(app, db)
+
+    try:
+        with app.app_context():
+            db.create_all()
+            started = time.perf_counter()
+            seed(args.messages, args.channels)
+            print(f'seeded {args.messages} messages in {time.perf_counter() - started:.1f}s')
+
+            install_search_index(db.engine)
+            started = time.perf_counter()
+            rebuild_search_index(db.engine)
+            print(f'built FTS5 index in {time.perf_counter() - started:.1f}s')
+            print(f'database size {os.path.getsize(path) / 1024 / 1024:.0f} MiB')
+
+            channel_ids = list(range(1, args.channels + 1))
+
+            def fts(query):
+                search_messages(query, channel_ids, limit=25)
+
+            def fts_recent(query):
+                search_messages(query, channel_ids, sort='recent', limit=25)
+
+            def like(query):
+                pattern = '%' + query.split()[0].rstrip('*') + '%'
+                db.session.execute(text(
+                    'SELECT id FROM messages WHERE content LIKE :pattern '
+                    'ORDER BY id DESC LIMIT 25'
+                ), {'pattern': pattern}).fetchall()
+
+            for name, fn, repeat in (('fts5 relevance', fts, args.repeat),
+                                     ('fts5 recent', fts_recent, args.repeat),
+                                     ('LIKE scan', like, max(1, args.repeat // 10))):
+                print(name)
+                for query, (p50, p99) in time_queries(fn, repeat).items():
+                    print(f'  {query!r:16} p50 {p50:9.2f} ms  p99 {p99:9.2f} ms')
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Seed a synthetic Commit8 database for load testing.
+
+Creates users, servers (each with text and voice channels), memberships and
+a message history in an SQLite file using the application's schema. Every
+user is a member of server 1, the busy server the load tests aim at, and of
+a few random others. Message traffic is skewed towards a handful of busy
+channels. All users share the password `password`.
+
+    python benchmarks/seed.py --messages 2000000
+    python benchmarks/seed.py --users 200 --messages 50000 --output /tmp/small.db
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt
+from flask import Flask
+from sqlalchemy import text
+
+from config import ProductionConfig
+from models import db
+from storage import init_storage
+from search import install_search_index, rebuild_search_index
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bench.db')
+PASSWORD = 'password'
+WORDS = ('hey', 'deploy', 'build', 'lunch', 'meeting', 'broken', 'fixed', 'ship', 'review',
+         'merge', 'coffee', 'tomorrow', 'again', 'works', 'thanks', 'why', 'test', 'server')
+
+def seed_users(users, rounds=4):
+    # A low bcrypt cost keeps seeding fast; logins still verify normally.
+    # app.py upgrades each hash to BCRYPT_ROUNDS on that user's first login.
+    password_hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+    db.session.execute(text(
+        'INSERT INTO users (id, username, email, password_hash, status) '
+        "VALUES (:id, :username, :email, :password_hash, 'offline')"
+    ), [{
+        'id': user_id,
+        'username': f'user{user_id}',
+        'email': f'user{user_id}@example.com',
+        'password_hash': password_hash
+    } for user_id in range(1, users + 1)])
+
+def seed_servers(rng, users, servers, text_channels, voice_channels, memberships):
+    channel_rows = []
+    member_rows = set()
+    for server_id in range(1, servers + 1):
+        owner_id = (server_id - 1) % users + 1
+        db.session.execute(text(
+            'INSERT INTO servers (id, name, owner_id) VALUES (:id, :name, :owner_id)'
+        ), {'id': server_id, 'name': f'server{server_id}', 'owner_id': owner_id})
+        member_rows.add((owner_id, server_id, 'admin'))
+        for index in range(text_channels + voice_channels):
+            channel_rows.append({
+                'id': len(channel_rows) + 1,
+                'name': f'channel{index}',
+                'type': 'text' if index < text_channels else 'voice',
+                'server_id': server_id
+            })
+
+    for user_id in range(1, users + 1):
+        joined = {1} | set(rng.sample(range(1, servers + 1), min(memberships, servers)))
+        for server_id in joined:
+            if (user_id, server_id, 'admin') not in member_rows:
+                member_rows.add((user_id, server_id, 'member'))
+
+    db.session.execute(text(
+        'INSERT INTO channels (id, name, type, server_id) VALUES (:id, :name, :type, :server_id)'
+    ), channel_rows)
+    db.session.execute(text(
+        'INSERT INTO server_members (user_id, server_id, role) VALUES (:user_id, :server_id, :role)'
+    ), [{'user_id': u, 'server_id': s, 'role': r} for u, s, r in member_rows])
+    return [row['id'] for row in channel_rows if row['type'] == 'text']
+
+def seed_messages(rng, users, channel_ids, messages, batch=50000):
+    # Channel i gets traffic in proportion to 1/i, so a few channels hold
+    # most of the history, as on a real deployment
+    weights = []
+    total = 0.0
+    for rank in range(len(channel_ids)):
+        total += 1.0 / (rank + 1)
+        weights.append(total)
+    start = datetime.utcnow() - timedelta(seconds=messages * 5)
+    insert = text('INSERT INTO messages (content, user_id, channel_id, created_at) '
+                  'VALUES (:content, :user_id, :channel_id, :created_at)')
+    for offset in range(0, messages, batch):
+        count = min(batch, messages - offset)
+        channels = rng.choices(channel_ids, cum_weights=weights, k=count)
+        db.session.execute(insert, [{
+            'content': ' '.join(rng.choices(WORDS, k=rng.randint(2, 20))),
+            'user_id': rng.randint(1, users),
+            'channel_id': channel_id,
+            'created_at': start + timedelta(seconds=(offset + i) * 5)
+        } for i, channel_id in enumerate(channels)])
+        db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--servers', type=int, default=50)
+    parser.add_argument('--text-channels', type=int, default=10)
+    parser.add_argument('--voice-channels', type=int, default=2)
+    parser.add_argument('--memberships', type=int, default=3, help='extra servers joined per user')
+    parser.add_argument('--messages', type=int, default=2000000)
+    parser.add_argument('--bcrypt-rounds', type=int, default=4, help='cost of the shared password hash')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.output)
+    if os.path.exists(path):
+        raise SystemExit(f'{path} already exists')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    app = Flask(__name__)
+    app.config.from_object(ProductionConfig)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    db.init_app(app)
+    init_storage(app, db)
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        seed_users(args.users, args.bcrypt_rounds)
+        channel_ids = seed_servers(rng, args.users, args.servers, args.text_channels,
+                                   args.voice_channels, args.memberships)
+        db.session.commit()
+        seed_messages(rng, args.users, channel_ids, args.messages)
+        print(f'seeded {args.users} users, {args.servers} servers, {args.messages} messages '
+              f'in {time.perf_counter() - started:.1f}s')
+
+        # Building the search index once is much faster than letting the
+        # triggers index every insert
+        if install_search_index(db.engine):
+            started = time.perf_counter()
+            rebuild_search_index(db.engine)
+            print(f'built search index in {time.perf_counter() - started:.1f}s')
+        db.session.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+
+    print(f'{path}: {os.path.getsize(path) / 1024 / 1024:.0f} MiB')
+
+if __name__ == '__main__':
+    main()
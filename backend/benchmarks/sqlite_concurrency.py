@@ -0,0 +1,161 @@
+"""Read/write concurrency of the SQLite storage profiles.
+
+Runs reader threads paging channel history while writer threads insert
+messages, once per profile, and prints throughput, latency and lock errors.
+
+    python benchmarks/sqlite_concurrency.py --seconds 5 --readers 8 --writers 2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from config import Config, ProductionConfig
+from models import db
+from storage import install_pragmas, describe_storage
+
+PROFILES = {
+    'default': Config,
+    'production': ProductionConfig
+}
+
+PAGE_QUERY = text(
+    'SELECT id, content, user_id, created_at FROM messages '
+    'WHERE channel_id = :channel_id ORDER BY created_at DESC, id DESC LIMIT 50'
+)
+INSERT_QUERY = text(
+    'INSERT INTO messages (content, user_id, channel_id, created_at) '
+    'VALUES (:content, 1, :channel_id, :created_at)'
+)
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def make_engine(path, profile):
+    engine = create_engine(f'sqlite:///{path}', **profile.SQLALCHEMY_ENGINE_OPTIONS)
+    install_pragmas(engine, profile.SQLITE_PRAGMAS)
+    return engine
+
+def seed(engine, channels, messages):
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO users (id, username, email, password_hash) "
+            "VALUES (1, 'bench', 'bench@example.com', 'x')"
+        ))
+        connection.execute(text(
+            "INSERT INTO servers (id, name, owner_id) VALUES (1, 'bench', 1)"
+        ))
+        for channel_id in range(1, channels + 1):
+            connection.execute(text(
+                "INSERT INTO channels (id, name, type, server_id) VALUES (:id, 'c', 'text', 1)"
+            ), {'id': channel_id})
+        now = datetime.utcnow()
+        connection.execute(INSERT_QUERY, [
+            {'content': f'seed {i}', 'channel_id': i % channels + 1, 'created_at': now}
+            for i in range(messages)
+        ])
+
+def run_profile(name, profile, args):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    engine = make_engine(path, profile)
+    try:
+        seed(engine, args.channels, args.seed_messages)
+        stop = threading.Event()
+        lock = threading.Lock()
+        results = {'reads': [], 'writes': [], 'locked': 0}
+
+        def reader(index):
+            latencies = []
+            channel_id = index % args.channels + 1
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    with engine.connect() as connection:
+                        connection.execute(PAGE_QUERY, {'channel_id': channel_id}).fetchall()
+                    latencies.append(time.perf_counter() - started)
+                except OperationalError:
+                    with lock:
+                        results['locked'] += 1
+            with lock:
+                results['reads'].extend(latencies)
+
+        def writer(index):
+            latencies = []
+            count = 0
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    with engine.begin() as connection:
+                        connection.execute(INSERT_QUERY, {
+                            'content': f'writer {index} {count}',
+                            'channel_id': count % args.channels + 1,
+                            'created_at': datetime.utcnow()
+                        })
+                    latencies.append(time.perf_counter() - started)
+                    count += 1
+                except OperationalError:
+                    with lock:
+                        results['locked'] += 1
+            with lock:
+                results['writes'].extend(latencies)
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+        threads += [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        return {
+            'profile': name,
+            'storage': describe_storage(engine),
+            'reads_per_sec': len(results['reads']) / args.seconds,
+            'writes_per_sec': len(results['writes']) / args.seconds,
+            'read_p50_ms': percentile(results['reads'], 50) * 1000,
+            'read_p99_ms': percentile(results['reads'], 99) * 1000,
+            'write_p50_ms': percentile(results['writes'], 50) * 1000,
+            'write_p99_ms': percentile(results['writes'], 99) * 1000,
+            'locked_errors': results['locked']
+        }
+    finally:
+        engine.dispose()
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--seed-messages', type=int, default=50000)
+    parser.add_argument('--profile', choices=sorted(PROFILES), action='append')
+    args = parser.parse_args()
+
+    for name in args.profile or sorted(PROFILES):
+        result = run_profile(name, PROFILES[name], args)
+        print(f"[{result['profile']}] {result['storage']}")
+        print(f"  reads/s {result['reads_per_sec']:.0f}  "
+              f"p50 {result['read_p50_ms']:.2f} ms  p99 {result['read_p99_ms']:.2f} ms")
+        print(f"  writes/s {result['writes_per_sec']:.0f}  "
+              f"p50 {result['write_p50_ms']:.2f} ms  p99 {result['write_p99_ms']:.2f} ms")
+        print(f"  'database is locked' errors: {result['locked_errors']}")
+
+if __name__ == '__main__':
+    main()
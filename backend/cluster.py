@@ -0,0 +1,265 @@
+"""Clustered Socket.IO: several worker processes sharing room broadcasts.
+
+Each worker keeps its own clients; every emit is published on a pub/sub
+backend and each worker delivers it to the clients it holds. The backend is
+chosen by SOCKETIO_MESSAGE_QUEUE:
+
+    memory://<name>          workers in one process (tests, benchmarks)
+    local://127.0.0.1:6390   TCP relay on this machine, see ``relay`` below
+    local:///tmp/commi8.sock Unix socket relay
+    redis://... amqp://...   python-socketio's Redis and Kombu managers
+    kafka://... zmq+tcp://   handled by Flask-SocketIO, without encode-once
+                             or session resume
+
+Run a relay for local:// with
+
+    python cluster.py relay local://127.0.0.1:6390
+
+Messages between workers are JSON, so emitted payloads must be JSON
+serializable, and a frame from anything that can reach the relay is only
+ever parsed, never executed.
+"""
+import socket
+import socketserver
+import struct
+import sys
+import threading
+from urllib.parse import urlparse
+
+from socketio import KombuManager, PubSubManager, RedisManager
+
+from wire import EncodeOnceManager, dumps, loads
+
+_FRAME_HEADER = struct.Struct('!I')
+
+# Seconds the relay waits on a subscriber that stopped reading before it
+# drops that subscriber, so one stuck worker cannot stall the others
+RELAY_WRITE_TIMEOUT = 5
+
+class InProcessManager(PubSubManager, EncodeOnceManager):
+    # Named hubs shared by every manager in this process
+    hubs = {}
+    name = 'memory'
+
+    def __init__(self, url='memory://default', channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.hub = f'{urlparse(url).netloc or "default"}:{channel}'
+        self.queue = None
+
+    def initialize(self):
+        if not self.write_only:
+            self.queue = self.server.eio.create_queue()
+            self.hubs.setdefault(self.hub, []).append(self.queue)
+        super().initialize()
+
+    def _publish(self, data):
+        # Encoded so receivers never share objects with the sender, the same
+        # as they would across processes
+        message = dumps(data)
+        for queue in list(self.hubs.get(self.hub, ())):
+            queue.put(message)
+
+    def _listen(self):
+        while True:
+            yield loads(self.queue.get())
+
+def _read_exactly(sock, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('relay connection closed')
+        buf += chunk
+    return buf
+
+def read_frame(sock):
+    (size,) = _FRAME_HEADER.unpack(_read_exactly(sock, _FRAME_HEADER.size))
+    return _read_exactly(sock, size)
+
+def write_frame(sock, payload):
+    sock.sendall(_FRAME_HEADER.pack(len(payload)) + payload)
+
+def parse_local_url(url):
+    parsed = urlparse(url)
+    if parsed.path and not parsed.netloc:
+        return socket.AF_UNIX, parsed.path
+    return socket.AF_INET, (parsed.hostname or '127.0.0.1', parsed.port or 6390)
+
+class LocalSocketManager(PubSubManager, EncodeOnceManager):
+    name = 'local'
+
+    def __init__(self, url='local://127.0.0.1:6390', channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.family, self.address = parse_local_url(url)
+        self._publisher = None
+        self._publish_lock = None
+
+    def _green(self):
+        return self.server is not None and self.server.async_mode == 'eventlet'
+
+    def _socket_module(self):
+        if self._green():
+            from eventlet.green import socket as green_socket
+            return green_socket
+        return socket
+
+    def _make_lock(self):
+        # A greenlet can yield inside sendall, so under eventlet the lock
+        # has to be a green one or a second publisher would block the hub
+        if self._green():
+            from eventlet.semaphore import Semaphore
+            return Semaphore()
+        return threading.Lock()
+
+    def _connect(self, subscribe):
+        # The relay only forwards to subscribing connections; the publishing
+        # one is never read from, so it must not be sent anything
+        sock = self._socket_module().socket(self.family, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        write_frame(sock, dumps({'channel': self.channel, 'subscribe': subscribe}).encode('utf-8'))
+        return sock
+
+    def _publish(self, data):
+        if self._publish_lock is None:
+            self._publish_lock = self._make_lock()
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect(subscribe=False)
+                    write_frame(self._publisher, dumps(data).encode('utf-8'))
+                    return
+                except OSError:
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect(subscribe=True)
+                while True:
+                    frame = read_frame(sock)
+                    try:
+                        yield loads(frame)
+                    except ValueError:
+                        self._get_logger().warning('Dropped a malformed cluster relay frame')
+            except (OSError, ConnectionError):
+                self._get_logger().warning('Lost the cluster relay, reconnecting')
+                self.server.sleep(1)
+
+class _RelayHandler(socketserver.BaseRequestHandler):
+    # A connection says in its first frame whether it subscribes to the
+    # channel or publishes to it. Frames from publishers are written to
+    # every subscriber; each subscriber has a lock, since every publisher's
+    # handler thread writes to it.
+
+    def handle(self):
+        try:
+            hello = loads(read_frame(self.request))
+            channel, subscribe = hello['channel'], hello['subscribe']
+        except (OSError, ConnectionError, ValueError, KeyError, TypeError):
+            return
+        if subscribe:
+            self._subscribe(channel)
+        else:
+            self._publish(channel)
+
+    def _subscribe(self, channel):
+        relay = self.server
+        self.request.settimeout(relay.write_timeout)
+        with relay.lock:
+            relay.channels.setdefault(channel, {})[self.request] = threading.Lock()
+        try:
+            # Nothing is expected from a subscriber; this only waits for it
+            # to hang up
+            while True:
+                try:
+                    if not self.request.recv(4096):
+                        break
+                except socket.timeout:
+                    continue
+        except OSError:
+            pass
+        finally:
+            relay.drop(channel, self.request)
+
+    def _publish(self, channel):
+        relay = self.server
+        try:
+            while True:
+                frame = read_frame(self.request)
+                with relay.lock:
+                    targets = list(relay.channels.get(channel, {}).items())
+                for peer, lock in targets:
+                    try:
+                        with lock:
+                            write_frame(peer, frame)
+                    except OSError:
+                        # Timed out or gone; a partly written frame leaves
+                        # the stream unusable either way
+                        relay.drop(channel, peer)
+        except (OSError, ConnectionError):
+            pass
+
+class _RelayServer:
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def drop(self, channel, peer):
+        with self.lock:
+            self.channels.get(channel, {}).pop(peer, None)
+        try:
+            peer.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def make_relay(url, write_timeout=RELAY_WRITE_TIMEOUT):
+    family, address = parse_local_url(url)
+    base = socketserver.ThreadingUnixStreamServer if family == socket.AF_UNIX \
+        else socketserver.ThreadingTCPServer
+    relay = type('Relay', (_RelayServer, base), {})(address, _RelayHandler)
+    relay.channels = {}  # channel -> {subscriber socket: write lock}
+    relay.lock = threading.Lock()
+    relay.write_timeout = write_timeout
+    return relay
+
+# The Redis and Kombu managers, on EncodeOnceManager like the two above, so
+# their broadcasts are also encoded once and numbered for session resume
+
+class SequencedRedisManager(RedisManager, EncodeOnceManager):
+    name = 'redis'
+
+class SequencedKombuManager(KombuManager, EncodeOnceManager):
+    name = 'kombu'
+
+def create_client_manager(url, channel, write_only=False):
+    scheme = urlparse(url).scheme
+    if scheme == 'memory':
+        return InProcessManager(url, channel=channel, write_only=write_only)
+    if scheme == 'local':
+        return LocalSocketManager(url, channel=channel, write_only=write_only)
+    if scheme in ('redis', 'rediss'):
+        return SequencedRedisManager(url, channel=channel, write_only=write_only)
+    if scheme == 'kafka' or scheme.startswith('zmq'):
+        return None
+    # Flask-SocketIO hands every other URL to Kombu too
+    return SequencedKombuManager(url, channel=channel, write_only=write_only)
+
+def socketio_options(app):
+    # Extra SocketIO.init_app arguments for SOCKETIO_MESSAGE_QUEUE
+    url = app.config.get('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return {'client_manager': EncodeOnceManager()}
+    channel = app.config.get('SOCKETIO_CHANNEL', 'commi8')
+    manager = create_client_manager(url, channel)
+    if manager is not None:
+        return {'client_manager': manager}
+    return {'message_queue': url, 'channel': channel}
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'relay':
+        sys.exit('usage: python cluster.py relay local://HOST:PORT|local:///PATH')
+    relay = make_relay(sys.argv[2])
+    print(f'cluster relay listening on {sys.argv[2]}')
+    relay.serve_forever()
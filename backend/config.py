@@ -0,0 +1,90 @@
+import os
+from sqlalchemy.pool import StaticPool
+
+# Settings per environment. app.py loads the class named by COMMI8_ENV
+# (development by default), then applies the optional file named by
+# COMMI8_SETTINGS on top of it.
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key')  # Change in production
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///commi8.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # PRAGMAs run on every new SQLite connection (see storage.py). Empty
+    # means the SQLite defaults: rollback journal, synchronous=FULL.
+    SQLITE_PRAGMAS = {}
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+
+    # Pub/sub backend shared by Socket.IO workers (see cluster.py). None
+    # keeps rooms inside this process.
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+    # bcrypt work factor (see passwords.py). Stored hashes with another
+    # cost are upgraded on the next login.
+    BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000
+    }
+
+class ProductionConfig(Config):
+    # WAL lets readers run alongside the writer. synchronous=NORMAL is
+    # durable across application crashes and only risks the last commits on
+    # power loss, which is what lets group commit pay off.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # negative means KiB, so 64 MiB
+        'temp_store': 'MEMORY',
+        'wal_autocheckpoint': 1000
+    }
+    # Greenlets share one OS thread, so connections are handed between
+    # them and check_same_thread must be off. The pool is sized for the
+    # number of greenlets expected to hold a connection at once, not for
+    # cores. pool_timeout fails fast instead of queueing forever.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 16,
+        'max_overflow': 16,
+        'pool_timeout': 10,
+        'pool_recycle': 3600,
+        'connect_args': {'check_same_thread': False, 'timeout': 5}
+    }
+
+class ClusterConfig(ProductionConfig):
+    # Several workers behind a sticky load balancer, sharing broadcasts
+    # through the relay started with `python cluster.py relay ...`
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE', 'local://127.0.0.1:6390')
+    MEMBERSHIP_CACHE_TTL = 5
+    # Each worker only sees its own sends, so its windows would miss messages
+    MESSAGE_CACHE_ENABLED = False
+    # Every worker would run it; archive from one cron job instead
+    ARCHIVE_INTERVAL = None
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'poolclass': StaticPool,
+        'connect_args': {'check_same_thread': False}
+    }
+    MESSAGE_PIPELINE_MODE = 'sync'
+    BCRYPT_ROUNDS = 4
+
+configs = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'cluster': ClusterConfig,
+    'testing': TestingConfig
+}
+
+def get_config(name=None):
+    name = name or os.environ.get('COMMI8_ENV', 'development')
+    if name not in configs:
+        raise ValueError(f'Unknown COMMI8_ENV: {name}')
+    return configs[name]
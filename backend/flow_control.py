@@ -0,0 +1,226 @@
+import time
+from socket_sessions import get_session
+
+# Inbound rate limits and outbound backpressure for Socket.IO.
+#
+# Inbound: every client event passes a token bucket for its socket and one
+# for its user, shared by all of that user's sockets. A bucket holds up to
+# `burst` tokens and refills at `rate` per second; an event takes one token
+# from each, and is dropped before its handler runs when either is empty.
+# The first event dropped in a row gets a rate_limited reply saying when to
+# retry. Events without quotas of their own share the '*' buckets.
+#
+# Outbound: engine.io queues packets for a socket without limit, so a
+# client that stops reading would make its queue grow for as long as it
+# stays connected. Once a socket has SOCKET_OUTBOUND_QUEUE_LIMIT packets
+# waiting, further packets are either dropped or the socket is disconnected,
+# per SOCKET_SLOW_CONSUMER_POLICY. A client that is dropped packets, or
+# reconnects, fetches history to catch up. The limit should stay well above
+# MESSAGE_BATCH_MAX_SIZE: a committed batch is broadcast without yielding,
+# so even a healthy socket briefly holds all of it.
+#
+# Config:
+#   SOCKET_RATE_LIMITS          {event: {'socket': (rate, burst), 'user': (rate, burst)}},
+#                               merged over DEFAULT_RATE_LIMITS; None turns a limit off
+#   SOCKET_OUTBOUND_QUEUE_LIMIT packets queued for one socket before the policy applies (default 1000)
+#   SOCKET_SLOW_CONSUMER_POLICY 'disconnect' (default) or 'drop'
+
+DEFAULT_RATE_LIMITS = {
+    'message': {'socket': (5, 10), 'user': (10, 20)},
+    'typing': {'socket': (2, 5), 'user': (4, 10)},
+    'voice_signal': {'socket': (20, 50), 'user': (40, 100)},
+    'ack': {'socket': (5, 20), 'user': (10, 40)},
+    '*': {'socket': (10, 30), 'user': (20, 60)}
+}
+
+# connect and disconnect come from the server, not from the client
+UNLIMITED_EVENTS = ('connect', 'disconnect')
+
+# Idle buckets are forgotten every this many checks, once full again
+SWEEP_EVERY = 10000
+
+class RateLimiter:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.limits = {}
+        self.socket_buckets = {}  # (sid, event) -> [tokens, refilled_at]
+        self.user_buckets = {}    # (user_id, event) -> [tokens, refilled_at]
+        self.notified = set()     # (sid, event) told to back off since their last accepted event
+        self._checks = 0
+        self.stats = {'events_allowed': 0, 'events_throttled': 0}
+        self.throttled = {}  # event -> events dropped
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.limits = {event: dict(quotas) for event, quotas in DEFAULT_RATE_LIMITS.items()}
+        for event, quotas in app.config.get('SOCKET_RATE_LIMITS', {}).items():
+            self.limits.setdefault(event, {}).update(quotas)
+
+        # Flask-SocketIO sends every event through _handle_event (see
+        # metrics.py), so the limits apply to all @socketio.on handlers
+        handle_event = socketio._handle_event
+
+        def limited_handle_event(handler, message, namespace, sid, *args):
+            if message in UNLIMITED_EVENTS:
+                try:
+                    return handle_event(handler, message, namespace, sid, *args)
+                finally:
+                    if message == 'disconnect':
+                        self.forget(sid)
+            session = get_session(sid)
+            retry_after = self.check(sid, session.user_id if session else None, message)
+            if retry_after:
+                self._notify(sid, message, retry_after)
+                return
+            return handle_event(handler, message, namespace, sid, *args)
+
+        socketio._handle_event = limited_handle_event
+
+    def _take(self, buckets, key, quota, now):
+        rate, burst = quota
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket, rate
+
+    def check(self, sid, user_id, event, now=None):
+        """Take a token for the event; 0 when allowed, else seconds until it would be."""
+        now = now or time.monotonic()
+        self._checks += 1
+        if self._checks % SWEEP_EVERY == 0:
+            self._sweep(now)
+
+        key = event if event in self.limits else '*'
+        quotas = self.limits[key]
+        buckets = []
+        if quotas.get('socket'):
+            buckets.append(self._take(self.socket_buckets, (sid, key), quotas['socket'], now))
+        if user_id is not None and quotas.get('user'):
+            buckets.append(self._take(self.user_buckets, (user_id, key), quotas['user'], now))
+
+        # Both buckets must have a token, or neither is charged
+        wait = max([(1 - bucket[0]) / rate for bucket, rate in buckets if bucket[0] < 1], default=0)
+        if wait:
+            self.stats['events_throttled'] += 1
+            self.throttled[key] = self.throttled.get(key, 0) + 1
+            return wait
+        for bucket, rate in buckets:
+            bucket[0] -= 1
+        self.stats['events_allowed'] += 1
+        self.notified.discard((sid, key))
+        return 0
+
+    def _notify(self, sid, event, retry_after):
+        # Once per run of dropped events, so a flood is not echoed back
+        key = (sid, event if event in self.limits else '*')
+        if key in self.notified:
+            return
+        self.notified.add(key)
+        self.socketio.emit('rate_limited', {'event': event, 'retry_after': round(retry_after, 3)}, to=sid)
+
+    def forget(self, sid):
+        for key in [key for key in self.socket_buckets if key[0] == sid]:
+            del self.socket_buckets[key]
+        self.notified = {key for key in self.notified if key[0] != sid}
+
+    def _sweep(self, now):
+        # A bucket that has refilled to its burst is the same as no bucket
+        for buckets, scope in ((self.socket_buckets, 'socket'), (self.user_buckets, 'user')):
+            for key, (tokens, refilled_at) in list(buckets.items()):
+                rate, burst = self.limits[key[1]][scope]
+                if tokens + (now - refilled_at) * rate >= burst:
+                    del buckets[key]
+
+    def metrics(self):
+        stats = dict(self.stats, socket_buckets=len(self.socket_buckets),
+                     user_buckets=len(self.user_buckets))
+        for event, count in self.throttled.items():
+            stats[f'throttled_{"other" if event == "*" else event}'] = count
+        return stats
+
+class OutboundGuard:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.queue_limit = 1000
+        self.policy = 'disconnect'
+        self.dropping = set()  # eio sids whose last packet was dropped
+        self.evicting = set()
+        self.stats = {'packets_dropped': 0, 'connections_evicted': 0, 'max_queue_seen': 0}
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.queue_limit = app.config.get('SOCKET_OUTBOUND_QUEUE_LIMIT', 1000)
+        self.policy = app.config.get('SOCKET_SLOW_CONSUMER_POLICY', 'disconnect')
+        if self.policy not in ('disconnect', 'drop'):
+            raise ValueError(f'Unknown SOCKET_SLOW_CONSUMER_POLICY {self.policy!r}')
+
+        # Every Socket.IO packet, whether emitted to one sid or encoded once
+        # for a room by EncodeOnceManager, reaches the client through
+        # eio.send. Flask-SocketIO's test client replaces _send_packet above
+        # it, so it is not guarded.
+        eio = socketio.server.eio
+        send = eio.send
+
+        def guarded_send(eio_sid, data):
+            if self.admit(eio_sid, data):
+                send(eio_sid, data)
+
+        eio.send = guarded_send
+
+    def admit(self, eio_sid, data):
+        if eio_sid in self.evicting:
+            return False
+        socket = self.socketio.server.eio.sockets.get(eio_sid)
+        if socket is None:
+            return True
+        if socket.closing or socket.closed:
+            return False
+
+        # The binary attachments of a packet follow its text header, and go
+        # or stay with it, or the client could not decode what it got
+        if isinstance(data, bytes):
+            if eio_sid in self.dropping:
+                self.stats['packets_dropped'] += 1
+                return False
+            return True
+
+        queued = socket.queue.qsize()
+        if queued > self.stats['max_queue_seen']:
+            self.stats['max_queue_seen'] = queued
+        if queued < self.queue_limit:
+            self.dropping.discard(eio_sid)
+            return True
+
+        if self.policy == 'drop':
+            self.dropping.add(eio_sid)
+            self.stats['packets_dropped'] += 1
+            return False
+
+        # Closing runs the disconnect handlers, which should not happen in
+        # the middle of whatever broadcast found the queue full
+        self.evicting.add(eio_sid)
+        self.stats['connections_evicted'] += 1
+        self.app.logger.warning('Disconnecting slow socket %s with %d packets queued', eio_sid, queued)
+        self.socketio.start_background_task(self._evict, eio_sid)
+        return False
+
+    def _evict(self, eio_sid):
+        try:
+            socket = self.socketio.server.eio.sockets.get(eio_sid)
+            if socket is not None:
+                socket.close(wait=False, abort=True)
+        except Exception:
+            self.app.logger.exception('Disconnecting slow socket failed')
+        finally:
+            self.evicting.discard(eio_sid)
+            self.dropping.discard(eio_sid)
+
+rate_limiter = RateLimiter()
+outbound_guard = OutboundGuard()
@@ -0,0 +1,196 @@
+from flask_socketio import join_room
+from sqlalchemy import case, func, tuple_
+from models import db, User, server_members
+from presence import presence
+from search import encode_cursor, decode_cursor
+
+# Member lists read a page at a time. REST callers walk a server's members
+# with a keyset cursor, ordered by username or by status (online, idle, dnd,
+# offline, then username). Socket clients subscribe to the fixed-size ranges
+# of the list they have on screen. After a presence flush, only the ranges
+# that changed are read again and pushed, each to a room holding just the
+# clients viewing it.
+#
+# Config:
+#   MEMBER_LIST_RANGE_SIZE   members per subscribed range (default 100)
+#   MEMBER_LIST_MAX_RANGES   ranges one socket may view at once (default 3)
+
+ORDERS = ('username', 'status')
+
+status_rank = case(
+    (User.status == 'online', 0),
+    (User.status == 'idle', 1),
+    (User.status == 'dnd', 2),
+    else_=3
+)
+
+def _order_columns(order):
+    if order == 'username':
+        return (User.username, User.id)
+    if order == 'status':
+        return (status_rank, User.username, User.id)
+    raise ValueError(f'Unknown order: {order}')
+
+# What a cursor holds for each order: the values of its order columns
+CURSOR_KINDS = {
+    'username': (str, int),
+    'status': (int, str, int)
+}
+
+def _members_query(server_id):
+    return db.session.query(User, server_members.c.role, status_rank.label('rank'))\
+        .join(server_members, server_members.c.user_id == User.id)\
+        .filter(server_members.c.server_id == server_id)
+
+def serialize_member(user, role):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'status': presence.status_of(user.id, user.status),
+        'avatar_url': user.avatar_url,
+        'role': role
+    }
+
+def member_count(server_id):
+    return db.session.query(func.count(server_members.c.user_id))\
+        .filter(server_members.c.server_id == server_id)\
+        .scalar()
+
+def online_count(server_id):
+    return db.session.query(func.count(server_members.c.user_id))\
+        .join(User, User.id == server_members.c.user_id)\
+        .filter(server_members.c.server_id == server_id, User.status != 'offline')\
+        .scalar()
+
+def member_page(server_id, order='username', limit=100, cursor=None):
+    """Return (members, next_cursor) for one page of a server's member list."""
+    columns = _order_columns(order)
+    query = _members_query(server_id)
+    if cursor:
+        after = decode_cursor(cursor, *CURSOR_KINDS[order])
+        query = query.filter(tuple_(*columns) > tuple_(*after))
+    rows = query.order_by(*columns).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        user, _, rank = rows[-1]
+        key = [user.username, user.id]
+        next_cursor = encode_cursor([rank] + key if order == 'status' else key)
+    return [serialize_member(user, role) for user, role, _ in rows], next_cursor
+
+def read_member_range(server_id, order, offset, limit):
+    rows = _members_query(server_id)\
+        .order_by(*_order_columns(order))\
+        .offset(offset)\
+        .limit(limit)\
+        .all()
+    return [serialize_member(user, role) for user, role, _ in rows]
+
+class MemberListRange:
+    __slots__ = ('server_id', 'order', 'offset', 'sids', 'members', 'user_ids')
+
+    def __init__(self, server_id, order, offset):
+        self.server_id = server_id
+        self.order = order
+        self.offset = offset
+        self.sids = set()
+        self.members = []
+        self.user_ids = set()
+
+    @property
+    def room(self):
+        return f'members_{self.server_id}_{self.order}_{self.offset}'
+
+class MemberListSubscriptions:
+    def __init__(self):
+        self.socketio = None
+        self.range_size = 100
+        self.max_ranges = 3
+        self.ranges = {}  # (server_id, order, offset) -> MemberListRange
+        self.by_sid = {}  # sid -> set of range keys
+        self.stats = {'ranges_read': 0, 'updates_sent': 0}
+
+    def init_app(self, app, socketio):
+        self.socketio = socketio
+        self.range_size = app.config.get('MEMBER_LIST_RANGE_SIZE', 100)
+        self.max_ranges = app.config.get('MEMBER_LIST_MAX_RANGES', 3)
+
+    def _payload(self, view, total):
+        return {
+            'server_id': view.server_id,
+            'order': view.order,
+            'offset': view.offset,
+            'total': total,
+            'members': view.members
+        }
+
+    def _read(self, view):
+        self.stats['ranges_read'] += 1
+        members = read_member_range(view.server_id, view.order,
+                                    view.offset, self.range_size)
+        changed = members != view.members
+        view.members = members
+        view.user_ids = {member['id'] for member in members}
+        return changed
+
+    def subscribe(self, sid, server_id, order, offsets):
+        """Replace the ranges a socket views; returns the member_list payloads to send it.
+
+        Must run in the socket's request context, since it joins rooms.
+        """
+        if order not in ORDERS:
+            raise ValueError(f'Unknown order: {order}')
+        keys = {(server_id, order, offset - offset % self.range_size)
+                for offset in offsets[:self.max_ranges] if offset >= 0}
+        self.unsubscribe(sid, keep=keys)
+
+        total = member_count(server_id)
+        payloads = []
+        for key in sorted(keys):
+            view = self.ranges.get(key)
+            if view is None:
+                view = self.ranges[key] = MemberListRange(*key)
+                self._read(view)
+            if sid not in view.sids:
+                view.sids.add(sid)
+                join_room(view.room)
+            payloads.append(self._payload(view, total))
+        self.by_sid[sid] = keys
+        return payloads
+
+    def unsubscribe(self, sid, keep=()):
+        for key in self.by_sid.pop(sid, set()) - set(keep):
+            view = self.ranges.get(key)
+            if view is None:
+                continue
+            view.sids.discard(sid)
+            self.socketio.server.leave_room(sid, view.room, namespace='/')
+            if not view.sids:
+                del self.ranges[key]
+
+    def leave_server(self, sid, server_id):
+        # A socket only ever views one server's list
+        if any(key[0] == server_id for key in self.by_sid.get(sid, ())):
+            self.unsubscribe(sid)
+
+    def refresh(self, server_id, user_ids=None):
+        """Re-read a server's subscribed ranges and push the ones that changed.
+
+        ``user_ids`` are members whose status changed; None means membership
+        itself changed. Ordered by status, a change anywhere can shift a
+        range; ordered by username, only ranges showing a changed user can.
+        """
+        total = None
+        for key in [key for key in self.ranges if key[0] == server_id]:
+            view = self.ranges[key]
+            if user_ids is not None and view.order == 'username' and view.user_ids.isdisjoint(user_ids):
+                continue
+            if not self._read(view):
+                continue
+            if total is None:
+                total = member_count(server_id)
+            self.stats['updates_sent'] += 1
+            self.socketio.emit('member_list_update', self._payload(view, total), room=view.room)
+
+member_lists = MemberListSubscriptions()
@@ -0,0 +1,91 @@
+import time
+from collections import OrderedDict, namedtuple
+from models import db, Channel, server_members
+
+# Access checks answer "is this user in this server?" with an indexed
+# existence query on server_members instead of loading server.members.
+# Positive answers and channel -> server lookups are cached in-process and
+# invalidated by whatever changes membership or deletes a channel. Changes
+# that bypass those calls (direct database edits, imports, another worker)
+# are picked up once an entry is MEMBERSHIP_CACHE_TTL seconds old. "Not a
+# member" is never cached, so a user added behind the cache's back gets in
+# straight away.
+#
+# Config:
+#   MEMBERSHIP_CACHE_TTL  seconds a cached answer is trusted (default 60)
+
+MAX_CACHED_MEMBERSHIPS = 100000
+MAX_CACHED_CHANNELS = 20000
+
+ChannelInfo = namedtuple('ChannelInfo', ['id', 'server_id', 'type', 'name'])
+
+cache_ttl = 60
+
+_memberships = OrderedDict()  # (user_id, server_id) -> cached_at, for members only
+_channels = OrderedDict()  # channel_id -> (ChannelInfo, cached_at)
+
+def _remember(cache, key, value, limit):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+def init_app(app):
+    global cache_ttl
+    cache_ttl = app.config.get('MEMBERSHIP_CACHE_TTL', 60)
+
+def _fresh(cached_at, now):
+    return cache_ttl is None or now - cached_at < cache_ttl
+
+def is_member(user_id, server_id):
+    key = (user_id, server_id)
+    now = time.monotonic()
+    cached_at = _memberships.get(key)
+    if cached_at is not None and _fresh(cached_at, now):
+        _memberships.move_to_end(key)
+        return True
+
+    found = db.session.query(server_members.c.user_id)\
+        .filter(server_members.c.user_id == user_id,
+                server_members.c.server_id == server_id)\
+        .first() is not None
+    if found:
+        _remember(_memberships, key, now, MAX_CACHED_MEMBERSHIPS)
+    else:
+        _memberships.pop(key, None)
+    return found
+
+def get_channel_info(channel_id):
+    now = time.monotonic()
+    cached = _channels.get(channel_id)
+    if cached is not None and _fresh(cached[1], now):
+        _channels.move_to_end(channel_id)
+        return cached[0]
+
+    row = db.session.query(Channel.id, Channel.server_id, Channel.type, Channel.name)\
+        .filter(Channel.id == channel_id)\
+        .first()
+    if row is None:
+        _channels.pop(channel_id, None)
+        return None
+    info = ChannelInfo(row.id, row.server_id, row.type, row.name)
+    _remember(_channels, channel_id, (info, now), MAX_CACHED_CHANNELS)
+    return info
+
+def channel_server_id(channel_id):
+    info = get_channel_info(channel_id)
+    return info.server_id if info else None
+
+def can_access_channel(user_id, channel_id):
+    info = get_channel_info(channel_id)
+    return info is not None and is_member(user_id, info.server_id)
+
+def invalidate_membership(user_id, server_id):
+    _memberships.pop((user_id, server_id), None)
+
+def invalidate_channel(channel_id):
+    _channels.pop(channel_id, None)
+
+def clear():
+    _memberships.clear()
+    _channels.clear()
@@ -0,0 +1,166 @@
+from collections import OrderedDict, deque
+from sqlalchemy import event, inspect
+from models import User
+
+# Newest serialized messages per channel, so opening a channel does not run
+# the history query every time. An entry only ever holds the newest
+# messages of its channel, without gaps: it is created from a first-page
+# read and then kept current by the send paths. Channels are evicted least
+# recently used first once the estimated size passes MESSAGE_CACHE_MAX_BYTES.
+#
+# Each worker only sees the messages it commits itself, so the cache is off
+# in clustered deployments (MESSAGE_CACHE_ENABLED).
+
+MESSAGE_OVERHEAD_BYTES = 512  # rough size of a payload besides its content
+MAX_TRACKED_CHANNELS = 10000  # channels whose last append is remembered
+
+def _message_size(message):
+    return len(message['content']) + MESSAGE_OVERHEAD_BYTES
+
+class ChannelWindow:
+    __slots__ = ('messages', 'complete', 'total', 'size')
+
+    def __init__(self, capacity):
+        self.messages = deque(maxlen=capacity)  # oldest first
+        self.complete = False  # True when the window holds the whole channel
+        self.total = None
+        self.size = 0
+
+class RecentMessageCache:
+    def __init__(self):
+        self.enabled = True
+        self.per_channel = 100
+        self.max_bytes = 64 * 1024 * 1024
+        self.channels = OrderedDict()
+        self.size = 0
+        self._sequence = 0
+        # channel_id -> sequence of its last append. Channels forgotten here
+        # fall back to _floor, the newest sequence forgotten, so the worst a
+        # forgotten channel costs is one skipped fill.
+        self._appended = {}
+        self._floor = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def init_app(self, app):
+        self.enabled = app.config.get('MESSAGE_CACHE_ENABLED', True)
+        self.per_channel = app.config.get('MESSAGE_CACHE_PER_CHANNEL', 100)
+        self.max_bytes = app.config.get('MESSAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+    def first_page(self, channel_id, limit, include_total):
+        """Return (messages newest first, has_more, total) or None on a miss."""
+        window = self.channels.get(channel_id) if self.enabled else None
+        if window is None or limit > self.per_channel \
+                or (include_total and window.total is None) \
+                or (len(window.messages) < limit and not window.complete):
+            self.stats['misses'] += 1
+            return None
+
+        self.channels.move_to_end(channel_id)
+        self.stats['hits'] += 1
+        cached = len(window.messages)
+        page = [window.messages[i] for i in range(cached - 1, max(cached - limit, 0) - 1, -1)]
+        has_more = cached > limit or not window.complete
+        return page, has_more, window.total
+
+    def fill_token(self):
+        # Taken before reading a page from the database, so that fill() can
+        # tell whether a message was appended while the read was running
+        return self._sequence
+
+    def fill(self, channel_id, token, messages, has_more, total=None):
+        # messages is a first page, newest first, straight from the database
+        if not self.enabled or self._appended.get(channel_id, self._floor) > token:
+            return
+        self._drop(channel_id)
+        window = ChannelWindow(self.per_channel)
+        for message in reversed(messages[:self.per_channel]):
+            window.messages.append(message)
+            window.size += _message_size(message)
+        window.complete = not has_more and len(messages) <= self.per_channel
+        window.total = total
+        self.channels[channel_id] = window
+        self.size += window.size
+        self._evict()
+
+    def append(self, message):
+        self._sequence += 1
+        self._appended[message['channel_id']] = self._sequence
+        if len(self._appended) > MAX_TRACKED_CHANNELS:
+            self._floor = self._sequence
+            self._appended.clear()
+        if message['parent_id'] is not None:
+            self._count_reply(message)
+            return
+        window = self.channels.get(message['channel_id']) if self.enabled else None
+        if window is None:
+            return
+        if window.messages and window.messages[-1]['id'] >= message['id']:
+            return  # already read back from the database by a fill
+        if len(window.messages) == window.messages.maxlen:
+            dropped = window.messages[0]
+            window.size -= _message_size(dropped)
+            self.size -= _message_size(dropped)
+            window.complete = False
+        window.messages.append(message)
+        window.size += _message_size(message)
+        self.size += _message_size(message)
+        if window.total is not None:
+            window.total += 1
+        self.channels.move_to_end(message['channel_id'])
+        self._evict()
+
+    def _count_reply(self, reply):
+        # Replies are not channel history, but the cached copy of their
+        # parent shows the thread's reply count
+        window = self.channels.get(reply['channel_id']) if self.enabled else None
+        if window is None:
+            return
+        for index, message in enumerate(window.messages):
+            if message['id'] == reply['parent_id']:
+                window.messages[index] = dict(message,
+                                              reply_count=message['reply_count'] + 1,
+                                              last_reply_at=reply['created_at'])
+                return
+
+    def invalidate(self, channel_id):
+        self._drop(channel_id)
+        self._forget(channel_id)
+
+    def clear(self):
+        self.channels.clear()
+        self.size = 0
+        self._appended.clear()
+        self._floor = self._sequence
+
+    def _drop(self, channel_id):
+        window = self.channels.pop(channel_id, None)
+        if window is not None:
+            self.size -= window.size
+
+    def _forget(self, channel_id):
+        sequence = self._appended.pop(channel_id, None)
+        if sequence is not None:
+            self._floor = max(self._floor, sequence)
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.channels:
+            channel_id, window = self.channels.popitem(last=False)
+            self.size -= window.size
+            self._forget(channel_id)
+            self.stats['evictions'] += 1
+
+    def metrics(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return dict(self.stats,
+                    channels=len(self.channels),
+                    bytes=self.size,
+                    hit_ratio=self.stats['hits'] / lookups if lookups else 0.0)
+
+message_cache = RecentMessageCache()
+
+@event.listens_for(User, 'after_update')
+def _drop_cached_authors(mapper, connection, target):
+    # Cached payloads embed the author's name and avatar
+    state = inspect(target)
+    if state.attrs.username.history.has_changes() or state.attrs.avatar_url.history.has_changes():
+        message_cache.clear()
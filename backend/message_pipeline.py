@@ -0,0 +1,254 @@
+import time
+from models import db, Message, Attachment
+from serializers import serialize_message, serialize_attachment
+from threads import record_replies
+from read_state import record_mentions
+from uploads import blob_store
+
+# Group commit for chat messages. Incoming messages are queued and a single
+# background task inserts them in batches, one commit per batch, so the
+# fsync cost is shared by every message in the batch. new_message is only
+# broadcast after the commit, once ids are assigned. Thread replies go out as
+# thread_message to the thread's subscribers instead, followed by one
+# thread_update per thread to the channel with the new reply count.
+#
+# Config:
+#   MESSAGE_PIPELINE_MODE      'batched' (default) or 'sync' (commit inline)
+#   MESSAGE_BATCH_MAX_SIZE     most messages committed together
+#   MESSAGE_BATCH_MAX_DELAY    latency bound: seconds the first message of a
+#                              batch may wait for others to join it
+#   MESSAGE_QUEUE_LIMIT        durability bound: most messages accepted but
+#                              not yet committed; senders block beyond it
+#   MESSAGE_COMMIT_TIMEOUT     seconds a REST sender waits for its commit
+
+class PendingMessage:
+    __slots__ = ('channel_id', 'user_id', 'content', 'author', 'sid', 'parent_id',
+                 'attachments', 'message', 'payload', 'thread', 'error', 'done')
+
+    def __init__(self, channel_id, user_id, content, author, sid=None, parent_id=None,
+                 attachments=None):
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.content = content
+        self.author = author
+        self.sid = sid
+        self.parent_id = parent_id
+        self.attachments = attachments or []  # claimed uploads, from blob_store.claim()
+        self.thread = None  # (reply_count, last_reply_at) of the parent after commit
+        self.message = None
+        self.payload = None
+        self.error = None
+        self.done = None
+
+class MessageCommitTimeout(Exception):
+    pass
+
+def _columns(attachment):
+    # Everything claim() returns but the upload id is an Attachment column
+    return {key: value for key, value in attachment.items() if key != 'upload_id'}
+
+class MessagePipeline:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.mode = 'sync'
+        self.max_batch_size = 64
+        self.max_delay = 0.01
+        self.queue_limit = 1024
+        self.commit_timeout = 5.0
+        self._queue = None
+        self._empty = None
+        self._worker = None
+        self._listeners = []
+        self.stats = {'batches': 0, 'messages': 0, 'failed': 0}
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.mode = app.config.get('MESSAGE_PIPELINE_MODE', 'batched')
+        self.max_batch_size = app.config.get('MESSAGE_BATCH_MAX_SIZE', 64)
+        self.max_delay = app.config.get('MESSAGE_BATCH_MAX_DELAY', 0.01)
+        self.queue_limit = app.config.get('MESSAGE_QUEUE_LIMIT', 1024)
+        self.commit_timeout = app.config.get('MESSAGE_COMMIT_TIMEOUT', 5.0)
+        if self.mode not in ('batched', 'sync'):
+            raise ValueError(f'Unknown MESSAGE_PIPELINE_MODE: {self.mode}')
+
+    def on_commit(self, listener):
+        # listener(payload) runs after a message is committed and before it
+        # is broadcast
+        self._listeners.append(listener)
+        return listener
+
+    def submit(self, channel_id, user_id, content, author, sid=None, wait=False, parent_id=None,
+               attachments=None):
+        """Queue a message for insertion.
+
+        ``parent_id`` makes it a reply in that message's thread; the caller
+        checks that the parent is a top-level message of ``channel_id``.
+        ``attachments`` are inserted with the message, in the same commit.
+
+        With ``wait`` the call returns the serialized message once it is
+        committed (raising the commit error, or MessageCommitTimeout).
+        Without it the call returns straight away and the sender learns the
+        outcome from the new_message broadcast or an error event.
+        """
+        item = PendingMessage(channel_id, user_id, content, author, sid, parent_id, attachments)
+
+        if self.mode == 'sync' or self.socketio is None or self.socketio.server is None:
+            self._commit([item])
+            self._publish([item])
+            if wait and item.error is not None:
+                raise item.error
+            return item.payload
+
+        self._ensure_worker()
+        if wait:
+            item.done = self.socketio.server.eio.create_event()
+        self._queue.put(item)
+        if not wait:
+            return None
+
+        if not item.done.wait(self.commit_timeout):
+            raise MessageCommitTimeout()
+        if item.error is not None:
+            raise item.error
+        return item.payload
+
+    def flush(self):
+        # Commit whatever is queued right now, from the caller's context
+        if self._queue is None:
+            return
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except self._empty:
+                break
+        if batch:
+            self._commit(batch)
+            self._publish(batch)
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        eio = self.socketio.server.eio
+        self._queue = eio.create_queue(self.queue_limit)
+        self._empty = eio.get_queue_empty_exception()
+        self._worker = self.socketio.start_background_task(self._run)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except self._empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with self.app.app_context():
+                try:
+                    self._commit(batch)
+                    self._publish(batch)
+                except Exception as e:
+                    self.app.logger.exception('Message pipeline batch failed')
+                    for item in batch:
+                        if item.error is None and item.payload is None:
+                            item.error = e
+                finally:
+                    db.session.remove()
+            for item in batch:
+                if item.done is not None:
+                    item.done.set()
+
+    def _commit(self, batch):
+        for item in batch:
+            item.message = Message(
+                content=item.content,
+                channel_id=item.channel_id,
+                user_id=item.user_id,
+                parent_id=item.parent_id
+            )
+        attachments = {}
+        for item in batch:
+            attachments[item] = [Attachment(message=item.message, **_columns(fields)) for fields in item.attachments]
+        try:
+            db.session.add_all([item.message for item in batch])
+            db.session.flush()
+            # Serialize while ids and timestamps are loaded; commit expires
+            # them and reading them back would cost a SELECT per message
+            for item in batch:
+                item.payload = serialize_message(item.message, item.author,
+                                                 [serialize_attachment(a) for a in attachments[item]])
+            replies = {}
+            for item in batch:
+                if item.parent_id is not None:
+                    replies.setdefault(item.parent_id, []).append(item.message)
+            if replies:
+                threads = record_replies(replies)
+                for item in batch:
+                    if item.parent_id is not None:
+                        item.thread = threads.get(item.parent_id)
+            record_mentions([item.message for item in batch])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for item in batch:
+                item.payload = None
+                item.thread = None
+            if len(batch) == 1:
+                batch[0].error = e
+                blob_store.unclaim(batch[0].attachments)
+                return
+            # Retry one by one so a single bad row does not take the whole
+            # batch down with it
+            for item in batch:
+                self._commit([item])
+            return
+
+        for item in batch:
+            blob_store.release(item.attachments)
+        self.stats['batches'] += 1
+        self.stats['messages'] += len(batch)
+
+    def _publish(self, batch):
+        broadcast = self.socketio is not None and self.socketio.server is not None
+        threads = {}  # parent id -> its newest reply in this batch
+        for item in batch:
+            if item.error is not None:
+                self.stats['failed'] += 1
+                if broadcast and item.sid is not None:
+                    self.socketio.emit('error', {'message': str(item.error)}, to=item.sid)
+                continue
+            for listener in self._listeners:
+                listener(item.payload)
+            if not broadcast:
+                continue
+            if item.parent_id is None:
+                self.socketio.emit('new_message', {
+                    'message': item.payload
+                }, room=f'channel_{item.channel_id}')
+            else:
+                self.socketio.emit('thread_message', {
+                    'message': item.payload
+                }, room=f'thread_{item.parent_id}')
+                threads[item.parent_id] = item
+
+        for parent_id, item in threads.items():
+            if item.thread is None:
+                continue
+            reply_count, last_reply_at = item.thread
+            self.socketio.emit('thread_update', {
+                'channel_id': item.channel_id,
+                'message_id': parent_id,
+                'reply_count': reply_count,
+                'last_reply_at': last_reply_at.isoformat() if last_reply_at else None
+            }, room=f'channel_{item.channel_id}')
+
+pipeline = MessagePipeline()
@@ -0,0 +1,288 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request
+from sqlalchemy import event
+import socket_sessions
+
+# Request, socket event and SQL instrumentation, exposed in the Prometheus
+# text format on /metrics (routes/metrics.py).
+#
+# Every Flask request and every Socket.IO event is timed, and the SQL it runs
+# is counted through engine events. Queries are charged to the request or
+# event running in the same greenlet; queries outside one (the message
+# pipeline, presence flushes) only show up in the global query metrics.
+#
+# Config:
+#   METRICS_ENABLED                 serve /metrics (default False)
+#   METRICS_TOKEN                   bearer token /metrics requires; None (default)
+#                                   serves it to loopback addresses only
+#   METRICS_SLOW_REQUEST_THRESHOLD  seconds; slower requests and socket events
+#                                   are logged with their query count. None
+#                                   (default) turns the log off
+#   METRICS_SLOW_QUERY_THRESHOLD    the same for single SQL statements
+#   METRICS_TOP_ROOMS               largest rooms reported by name (default 10)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+# Queries and query time of the request or event running in this greenlet
+_scope = contextvars.ContextVar('metrics_scope', default=None)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, labels)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = _format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            inf = _format_labels(self.labels, labels, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{inf} {series[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, labels)} {series[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, labels)} {series[-1]}')
+        return lines
+
+def _statement_kind(statement):
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return kind if kind in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') else 'OTHER'
+
+class Metrics:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.enabled = False
+        self.token = None
+        self.slow_request_threshold = None
+        self.slow_query_threshold = None
+        self.top_rooms = 10
+        self._lock = threading.Lock()
+        self._collectors = {}
+
+        self.http_requests = Counter(
+            'commi8_http_requests_total', 'HTTP requests by route and status.',
+            ('method', 'route', 'status'))
+        self.http_duration = Histogram(
+            'commi8_http_request_duration_seconds', 'HTTP request latency.', ('method', 'route'))
+        self.http_queries = Histogram(
+            'commi8_http_request_queries', 'SQL statements run per HTTP request.',
+            ('method', 'route'), QUERY_COUNT_BUCKETS)
+        self.http_query_time = Histogram(
+            'commi8_http_request_query_seconds', 'Time spent in SQL per HTTP request.', ('method', 'route'))
+        self.socket_events = Counter(
+            'commi8_socket_events_total', 'Socket.IO events handled, by outcome.', ('event', 'outcome'))
+        self.socket_duration = Histogram(
+            'commi8_socket_event_duration_seconds', 'Socket.IO handler latency.', ('event',))
+        self.socket_queries = Histogram(
+            'commi8_socket_event_queries', 'SQL statements run per Socket.IO event.',
+            ('event',), QUERY_COUNT_BUCKETS)
+        self.db_queries = Histogram(
+            'commi8_db_query_duration_seconds', 'SQL statement latency.', ('statement',))
+
+    def init_app(self, app, socketio, db):
+        self.app = app
+        self.socketio = socketio
+        self.enabled = app.config.get('METRICS_ENABLED', False)
+        self.token = app.config.get('METRICS_TOKEN')
+        self.slow_request_threshold = app.config.get('METRICS_SLOW_REQUEST_THRESHOLD')
+        self.slow_query_threshold = app.config.get('METRICS_SLOW_QUERY_THRESHOLD')
+        self.top_rooms = app.config.get('METRICS_TOP_ROOMS', 10)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(db.engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(db.engine, 'handle_error', self._handle_error)
+
+        # Flask-SocketIO sends every event through _handle_event, which makes
+        # it the one place to time all @socketio.on handlers
+        handle_event = socketio._handle_event
+
+        def timed_handle_event(handler, message, namespace, sid, *args):
+            return self._time_event(handle_event, message, handler, message, namespace, sid, *args)
+
+        socketio._handle_event = timed_handle_event
+
+    def register(self, name, collect):
+        """Expose a stats dict, read at scrape time, as commi8_<name>_<key> values."""
+        self._collectors[name] = collect
+
+    # SQL
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+        with self._lock:
+            self.db_queries.observe(elapsed, (_statement_kind(statement),))
+        scope = _scope.get()
+        if scope is not None:
+            scope[0] += 1
+            scope[1] += elapsed
+        if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+            self.app.logger.warning('Slow query (%.1f ms): %s', elapsed * 1000, ' '.join(statement.split())[:500])
+
+    def _handle_error(self, context):
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is not None:
+            started = context.connection.info.get('metrics_started')
+            if started:
+                started.pop()
+
+    # HTTP
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_scope = [0, 0.0]
+        g.metrics_token = _scope.set(g.metrics_scope)
+
+    def _after_request(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        _scope.reset(g.pop('metrics_token'))
+        queries, query_time = g.pop('metrics_scope')
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        labels = (request.method, route)
+        with self._lock:
+            self.http_requests.inc(labels + (str(g.pop('metrics_status', 500)),))
+            self.http_duration.observe(elapsed, labels)
+            self.http_queries.observe(queries, labels)
+            self.http_query_time.observe(query_time, labels)
+        self._log_if_slow(f'{request.method} {route}', elapsed, queries, query_time)
+
+    # Socket.IO
+
+    def _time_event(self, handle_event, name, *args):
+        scope = [0, 0.0]
+        token = _scope.set(scope)
+        outcome = 'ok'
+        started = time.perf_counter()
+        try:
+            return handle_event(*args)
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _scope.reset(token)
+            with self._lock:
+                self.socket_events.inc((name, outcome))
+                self.socket_duration.observe(elapsed, (name,))
+                self.socket_queries.observe(scope[0], (name,))
+            self._log_if_slow(f'socket event {name}', elapsed, scope[0], scope[1])
+
+    def _log_if_slow(self, what, elapsed, queries, query_time):
+        if self.slow_request_threshold is not None and elapsed >= self.slow_request_threshold:
+            self.app.logger.warning('Slow %s: %.1f ms, %d queries (%.1f ms)',
+                                    what, elapsed * 1000, queries, query_time * 1000)
+
+    # Export
+
+    def _socket_lines(self):
+        lines = []
+        rooms = {}
+        server = self.socketio.server if self.socketio is not None else None
+        if server is not None:
+            rooms = server.manager.rooms.get('/', {})
+        connected = len(rooms.get(None, ()))
+        lines += ['# HELP commi8_sockets_connected Socket.IO connections open on this process.',
+                  '# TYPE commi8_sockets_connected gauge',
+                  f'commi8_sockets_connected {connected}',
+                  '# HELP commi8_socket_sessions Authenticated socket sessions on this process.',
+                  '# TYPE commi8_socket_sessions gauge',
+                  f'commi8_socket_sessions {len(socket_sessions.sessions)}']
+
+        # Rooms are summarised by kind (channel_, server_, user_); every
+        # sid also has a room of its own, which is left out
+        kinds = {}
+        sizes = []
+        for room, members in list(rooms.items()):
+            if room is None or room in rooms.get(None, ()):
+                continue
+            kind = room.split('_', 1)[0] if '_' in room else 'other'
+            count, total, largest = kinds.get(kind, (0, 0, 0))
+            kinds[kind] = (count + 1, total + len(members), max(largest, len(members)))
+            sizes.append((len(members), room))
+        for metric, documentation, index in (
+                ('commi8_socket_rooms', 'Rooms with members, by kind.', 0),
+                ('commi8_socket_room_members', 'Room memberships, by room kind.', 1),
+                ('commi8_socket_room_members_max', 'Members of the largest room, by kind.', 2)):
+            lines += [f'# HELP {metric} {documentation}', f'# TYPE {metric} gauge']
+            for kind, values in sorted(kinds.items()):
+                lines.append(f'{metric}{{kind="{_escape(kind)}"}} {values[index]}')
+        lines += ['# HELP commi8_socket_room_size Members of the largest rooms.',
+                  '# TYPE commi8_socket_room_size gauge']
+        for size, room in sorted(sizes, reverse=True)[:self.top_rooms]:
+            lines.append(f'commi8_socket_room_size{{room="{_escape(room)}"}} {size}')
+        return lines
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in (self.http_requests, self.http_duration, self.http_queries,
+                           self.http_query_time, self.socket_events, self.socket_duration,
+                           self.socket_queries, self.db_queries):
+                lines += metric.render()
+        lines += self._socket_lines()
+        for name, collect in self._collectors.items():
+            for key, value in collect().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metric = f'commi8_{name}_{key}'
+                    lines += [f'# TYPE {metric} untyped', f'{metric} {value}']
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
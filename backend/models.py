@@ -23,6 +23,8 @@ class Server(db.Model):
     icon_url = db.Column(db.String(255))
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped with every change to the server or its channels (see server_tree.py)
+    structure_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     channels = db.relationship('Channel', backref='server', lazy=True)
     members = db.relationship('User', secondary='server_members', back_populates='servers')
 
@@ -44,8 +46,31 @@ class Message(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     edited_at = db.Column(db.DateTime)
     parent_id = db.Column(db.Integer, db.ForeignKey('messages.id'))  # For thread replies
+    # Kept by the reply inserts on the thread's parent (see threads.py)
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_reply_at = db.Column(db.DateTime)
     attachments = db.relationship('Attachment', backref='message', lazy=True)
 
+    # Keyset pagination walks history by (created_at, id) within a channel,
+    # and replies by (created_at, id) within a thread. Unread counts walk
+    # the top-level messages of a channel by id. Ids are never reused:
+    # archived messages keep theirs outside the table (see archive.py).
+    __table_args__ = (
+        db.Index('ix_messages_channel_created_id', 'channel_id', 'created_at', 'id'),
+        db.Index('ix_messages_parent_created_id', 'parent_id', 'created_at', 'id'),
+        db.Index('ix_messages_channel_parent_id', 'channel_id', 'parent_id', 'id'),
+        {'sqlite_autoincrement': True},
+    )
+
+class ArchiveEntry(db.Model):
+    # A message moved to the archive segments (see archive.py): enough to
+    # filter search hits on it and to find it by id alone
+    __tablename__ = 'archive_entries'
+    id = db.Column(db.Integer, primary_key=True)
+    channel_id = db.Column(db.Integer, db.ForeignKey('channels.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
 class Attachment(db.Model):
     __tablename__ = 'attachments'
     id = db.Column(db.Integer, primary_key=True)
@@ -53,10 +78,36 @@ class Attachment(db.Model):
     file_url = db.Column(db.String(500), nullable=False)
     message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # SHA-256 of the blob in the upload store (see uploads.py); None for
+    # attachments that only have a URL
+    content_hash = db.Column(db.String(64), index=True)
+    size = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+
+class ReadState(db.Model):
+    # Newest message a user has seen in a channel (see read_state.py)
+    __tablename__ = 'read_states'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    channel_id = db.Column(db.Integer, db.ForeignKey('channels.id'), primary_key=True)
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Mention(db.Model):
+    __tablename__ = 'mentions'
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    channel_id = db.Column(db.Integer, db.ForeignKey('channels.id'), nullable=False)
+
+    # Mention counts walk a user's mentions in a channel past the read position
+    __table_args__ = (
+        db.Index('ix_mentions_user_channel_message', 'user_id', 'channel_id', 'message_id'),
+    )
 
 # Association table for server members
 server_members = db.Table('server_members',
     db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
     db.Column('server_id', db.Integer, db.ForeignKey('servers.id'), primary_key=True),
-    db.Column('role', db.String(20), default='member')  # admin, mod, member
+    db.Column('role', db.String(20), default='member'),  # admin, mod, member
+    # The primary key covers lookups by user; this one covers lookups by server
+    db.Index('ix_server_members_server_id', 'server_id')
 )
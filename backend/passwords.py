@@ -0,0 +1,84 @@
+import threading
+import bcrypt
+
+# bcrypt on a bounded set of native threads. A hash at the default cost takes
+# a few hundred milliseconds of CPU; run inline under eventlet it stops the
+# hub, and every socket on the process, for that long. bcrypt releases the
+# GIL, so eventlet.tpool (or a plain thread in threading mode) lets the hub
+# keep serving while the hash runs.
+#
+# Config:
+#   BCRYPT_ROUNDS                  work factor for new hashes (default 12).
+#                                  Hashes with another cost are replaced on the
+#                                  next successful login
+#   PASSWORD_HASH_CONCURRENCY      most hashes running at once (default 4)
+#   PASSWORD_HASH_QUEUE_TIMEOUT    seconds a login may wait for a free slot
+#                                  before PasswordHasherBusy (default 10)
+#   PASSWORD_HASH_OFFLOAD          False hashes on the calling greenlet, for
+#                                  comparison in benchmarks (default True)
+
+class PasswordHasherBusy(Exception):
+    pass
+
+def hash_cost(password_hash):
+    # '$2b$12$...' -> 12
+    try:
+        return int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _checkpw(password, password_hash):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    except ValueError:
+        return False  # not a bcrypt hash
+
+class PasswordHasher:
+    def __init__(self):
+        self.rounds = 12
+        self.concurrency = 4
+        self.queue_timeout = 10.0
+        self.offload = True
+        self.green = False
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self.stats = {'hashes': 0, 'checks': 0, 'rehashes': 0, 'busy': 0}
+
+    def init_app(self, app, socketio):
+        self.rounds = app.config.get('BCRYPT_ROUNDS', 12)
+        self.concurrency = app.config.get('PASSWORD_HASH_CONCURRENCY', 4)
+        self.queue_timeout = app.config.get('PASSWORD_HASH_QUEUE_TIMEOUT', 10.0)
+        self.offload = app.config.get('PASSWORD_HASH_OFFLOAD', True)
+        self.green = socketio.server is not None and socketio.server.async_mode == 'eventlet'
+        if self.green:
+            from eventlet.semaphore import BoundedSemaphore
+            self._slots = BoundedSemaphore(self.concurrency)
+        else:
+            self._slots = threading.BoundedSemaphore(self.concurrency)
+
+    def hash(self, password):
+        self.stats['hashes'] += 1
+        return self._run(_hashpw, password, self.rounds)
+
+    def check(self, password, password_hash):
+        self.stats['checks'] += 1
+        return self._run(_checkpw, password, password_hash)
+
+    def needs_rehash(self, password_hash):
+        return hash_cost(password_hash) != self.rounds
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.stats['busy'] += 1
+            raise PasswordHasherBusy('Too many logins in progress, try again shortly')
+        try:
+            if self.green and self.offload:
+                from eventlet import tpool
+                return tpool.execute(fn, *args)
+            return fn(*args)
+        finally:
+            self._slots.release()
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,179 @@
+import time
+from sqlalchemy import func, update
+from models import db, User, server_members
+
+# In-memory presence. Connections are refcounted per user, so a second tab
+# closing does not mark the user offline, and a user only goes offline once
+# they have had no connection for PRESENCE_OFFLINE_GRACE seconds. Changes are
+# collected and flushed every PRESENCE_FLUSH_INTERVAL seconds as one
+# presence_update per server room, and written to users.status in the same
+# flush (write-behind).
+#
+# presence_update goes to the whole server room only for servers with at
+# most PRESENCE_BROADCAST_MAX_MEMBERS members. Clients of larger servers
+# learn about status changes through the member-list ranges they subscribe
+# to (member_lists.py), via the on_change listeners.
+
+STATUSES = ('online', 'idle', 'dnd', 'offline')
+SELECTABLE_STATUSES = ('online', 'idle', 'dnd')
+
+class PresenceEngine:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.flush_interval = 1.0
+        self.offline_grace = 5.0
+        self.connections = {}  # user_id -> open socket count
+        self.chosen = {}  # user_id -> status picked while connected
+        self.disconnected_at = {}  # user_id -> when the last socket closed
+        self.published = {}  # user_id -> status last broadcast and stored
+        self.dirty = set()
+        self.broadcast_max_members = 1000
+        self._listeners = []
+        self._worker = None
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.flush_interval = app.config.get('PRESENCE_FLUSH_INTERVAL', 1.0)
+        self.offline_grace = app.config.get('PRESENCE_OFFLINE_GRACE', 5.0)
+        self.broadcast_max_members = app.config.get('PRESENCE_BROADCAST_MAX_MEMBERS', 1000)
+
+    def on_change(self, listener):
+        # listener(server_id, user_ids) runs after a flush for every server
+        # with members whose status changed
+        self._listeners.append(listener)
+        return listener
+
+    def connect(self, user_id, stored_status=None):
+        self.published.setdefault(user_id, stored_status or 'offline')
+        self.connections[user_id] = self.connections.get(user_id, 0) + 1
+        self.disconnected_at.pop(user_id, None)
+        self.dirty.add(user_id)
+        self._ensure_worker()
+
+    def disconnect(self, user_id):
+        count = self.connections.get(user_id, 0) - 1
+        if count > 0:
+            self.connections[user_id] = count
+            return
+        self.connections.pop(user_id, None)
+        self.disconnected_at[user_id] = time.monotonic()
+        self.dirty.add(user_id)
+
+    def logout(self, user_id, stored_status=None):
+        # The client's own socket closes through disconnect(). With no other
+        # socket left, the user goes offline at the next flush, without
+        # waiting out the grace period; other open sockets keep them online.
+        if self.connections.get(user_id):
+            return
+        self.published.setdefault(user_id, stored_status or 'offline')
+        self.disconnected_at.pop(user_id, None)
+        self.dirty.add(user_id)
+        self._ensure_worker()
+
+    def set_status(self, user_id, status):
+        if status not in SELECTABLE_STATUSES:
+            raise ValueError(f'Unknown status: {status}')
+        if status == 'online':
+            self.chosen.pop(user_id, None)
+        else:
+            self.chosen[user_id] = status
+        self.dirty.add(user_id)
+
+    def current_status(self, user_id, now=None):
+        # None while a disconnect is still inside its grace period
+        if self.connections.get(user_id):
+            return self.chosen.get(user_id, 'online')
+        disconnected_at = self.disconnected_at.get(user_id)
+        if disconnected_at is not None and (now or time.monotonic()) - disconnected_at < self.offline_grace:
+            return None
+        return 'offline'
+
+    def status_of(self, user_id, stored_status):
+        # Status to show for a user, preferring what this process knows
+        if user_id in self.published:
+            return self.current_status(user_id) or self.published[user_id]
+        return stored_status
+
+    def _ensure_worker(self):
+        if self._worker is not None or self.socketio is None or self.socketio.server is None:
+            return
+        self._worker = self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.flush_interval)
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                self.app.logger.exception('Presence flush failed')
+
+    def _collect(self, now):
+        changes = {}
+        pending = set()
+        for user_id in self.dirty:
+            status = self.current_status(user_id, now)
+            if status is None:
+                pending.add(user_id)
+            elif status != self.published.get(user_id):
+                changes[user_id] = status
+        self.dirty = pending
+        return changes
+
+    def flush(self, now=None):
+        changes = self._collect(now or time.monotonic())
+        if not changes:
+            return {}
+
+        # Write-behind: one UPDATE per distinct status, one commit per flush
+        by_status = {}
+        for user_id, status in changes.items():
+            by_status.setdefault(status, []).append(user_id)
+        try:
+            for status, user_ids in by_status.items():
+                db.session.execute(update(User).where(User.id.in_(user_ids)).values(status=status))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.dirty.update(changes)
+            raise
+
+        for user_id, status in changes.items():
+            self.published[user_id] = status
+            if status == 'offline':
+                # Forget users who have left so the maps stay bounded
+                self.disconnected_at.pop(user_id, None)
+                self.chosen.pop(user_id, None)
+                self.published.pop(user_id, None)
+
+        rows = db.session.query(server_members.c.server_id, server_members.c.user_id)\
+            .filter(server_members.c.user_id.in_(list(changes)))\
+            .all()
+        updates = {}
+        for server_id, user_id in rows:
+            updates.setdefault(server_id, []).append({
+                'user_id': user_id,
+                'status': changes[user_id]
+            })
+        sizes = dict(
+            db.session.query(server_members.c.server_id, func.count(server_members.c.user_id))
+            .filter(server_members.c.server_id.in_(list(updates)))
+            .group_by(server_members.c.server_id)
+            .all()
+        ) if updates else {}
+        for server_id, server_updates in updates.items():
+            for listener in self._listeners:
+                listener(server_id, [entry['user_id'] for entry in server_updates])
+        if self.socketio is not None and self.socketio.server is not None:
+            for server_id, server_updates in updates.items():
+                if sizes.get(server_id, 0) > self.broadcast_max_members:
+                    continue
+                self.socketio.emit('presence_update', {
+                    'server_id': server_id,
+                    'updates': server_updates
+                }, room=f'server_{server_id}')
+        return changes
+
+presence = PresenceEngine()
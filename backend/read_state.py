@@ -0,0 +1,191 @@
+import re
+from datetime import datetime
+from sqlalchemy import and_, func, literal, select
+from sqlalchemy.dialects.sqlite import insert
+from models import db, Channel, Message, Mention, ReadState, User, server_members
+from membership import channel_server_id
+
+# Read positions and unread/mention counts.
+#
+# A read state is the newest message id a user has seen in a channel. Acks
+# only raise it, and are coalesced in memory: however many arrive for one
+# (user, channel) between flushes, every READ_STATE_FLUSH_INTERVAL seconds
+# one batched upsert writes the newest of each.
+#
+# Counts come from indexes, never from scanning messages. Unread counts walk
+# ix_messages_channel_parent_id past the read position. Mentions of a user
+# are written to their own table when the message is committed, so mention
+# counts walk ix_mentions_user_channel_message. Both stop one past
+# UNREAD_COUNT_CAP, and a count that got there is reported as the cap with
+# its capped flag set (clients show "99+" and the like).
+#
+# Config:
+#   READ_STATE_FLUSH_INTERVAL  seconds between ack writes (default 1)
+#   UNREAD_COUNT_CAP           highest unread or mention count reported
+#                              (default 100)
+
+MENTION = re.compile(r'(?<![\w@])@([\w.\-]+)')
+
+def record_mentions(messages):
+    """Store who is mentioned in just-flushed messages.
+
+    A mention is @username of a member of the channel's server, other than
+    the author. Messages without an @ cost nothing. Thread replies are
+    skipped: they are not counted as unread either, so a channel never
+    shows mentions without unread messages.
+    """
+    names = {}
+    for message in messages:
+        if message.parent_id is not None:
+            continue
+        found = set(MENTION.findall(message.content))
+        if found:
+            names[message] = found
+    if not names:
+        return
+    server_ids = {message: channel_server_id(message.channel_id) for message in names}
+    rows = db.session.query(User.id, User.username, server_members.c.server_id)\
+        .join(server_members, server_members.c.user_id == User.id)\
+        .filter(User.username.in_(set().union(*names.values())),
+                server_members.c.server_id.in_(set(server_ids.values())))\
+        .all()
+    members = {(row.username, row.server_id): row.id for row in rows}
+    mentions = []
+    for message, found in names.items():
+        for name in found:
+            user_id = members.get((name, server_ids[message]))
+            if user_id is not None and user_id != message.user_id:
+                mentions.append({'message_id': message.id, 'user_id': user_id,
+                                 'channel_id': message.channel_id})
+    if mentions:
+        db.session.execute(insert(Mention.__table__), mentions)
+
+class ReadStateTracker:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.flush_interval = 1.0
+        self.unread_cap = 100
+        self.pending = {}  # (user_id, channel_id) -> newest acked message id
+        self._worker = None
+        self.stats = {'acks': 0, 'coalesced': 0, 'flushes': 0, 'rows_written': 0}
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.flush_interval = app.config.get('READ_STATE_FLUSH_INTERVAL', 1.0)
+        self.unread_cap = app.config.get('UNREAD_COUNT_CAP', 100)
+
+    def ack(self, user_id, channel_id, message_id):
+        key = (user_id, channel_id)
+        self.stats['acks'] += 1
+        if key in self.pending:
+            self.stats['coalesced'] += 1
+            message_id = max(message_id, self.pending[key])
+        self.pending[key] = message_id
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._worker is not None or self.socketio is None or self.socketio.server is None:
+            return
+        self._worker = self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.flush_interval)
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                self.app.logger.exception('Read state flush failed')
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, {}
+        now = datetime.utcnow()
+        table = ReadState.__table__
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.channel_id],
+            set_={'last_read_id': func.max(table.c.last_read_id, stmt.excluded.last_read_id),
+                  'updated_at': stmt.excluded.updated_at}
+        )
+        try:
+            db.session.execute(stmt, [{
+                'user_id': user_id,
+                'channel_id': channel_id,
+                'last_read_id': message_id,
+                'updated_at': now
+            } for (user_id, channel_id), message_id in batch.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for key, message_id in batch.items():
+                self.pending[key] = max(message_id, self.pending.get(key, 0))
+            raise
+        self.stats['flushes'] += 1
+        self.stats['rows_written'] += len(batch)
+        return len(batch)
+
+    def _capped_count(self, rows):
+        # Counted over at most unread_cap + 1 index entries, one more than
+        # is reported so a count over the cap can be told from one at it
+        capped = rows.limit(self.unread_cap + 1).subquery()
+        return select(func.count()).select_from(capped).scalar_subquery()
+
+    def _unread(self, channel_id, last_read_id):
+        return self._capped_count(select(literal(1))
+            .where(Message.channel_id == channel_id,
+                   Message.parent_id.is_(None),
+                   Message.id > last_read_id)
+            .correlate_except(Message))
+
+    def _mentions(self, user_id, channel_id, last_read_id):
+        return self._capped_count(select(literal(1))
+            .where(Mention.user_id == user_id,
+                   Mention.channel_id == channel_id,
+                   Mention.message_id > last_read_id)
+            .correlate_except(Mention))
+
+    def _set_counts(self, state, unread, mentions):
+        state['unread_count'] = min(unread, self.unread_cap)
+        state['unread_capped'] = unread > self.unread_cap
+        state['mention_count'] = min(mentions, self.unread_cap)
+        state['mention_capped'] = mentions > self.unread_cap
+
+    def counts(self, user_id, server_id=None):
+        """Read position, unread and mention counts for each of a user's text channels, in one query."""
+        last_read_id = func.coalesce(ReadState.last_read_id, 0)
+        query = db.session.query(
+            Channel.id, Channel.server_id, last_read_id.label('last_read_id'),
+            self._unread(Channel.id, last_read_id).label('unread_count'),
+            self._mentions(user_id, Channel.id, last_read_id).label('mention_count')
+        ).join(server_members, and_(server_members.c.server_id == Channel.server_id,
+                                    server_members.c.user_id == user_id))\
+            .outerjoin(ReadState, and_(ReadState.channel_id == Channel.id,
+                                       ReadState.user_id == user_id))\
+            .filter(Channel.type == 'text')
+        if server_id is not None:
+            query = query.filter(Channel.server_id == server_id)
+
+        states = []
+        for row in query.order_by(Channel.server_id, Channel.id):
+            state = {
+                'channel_id': row.id,
+                'server_id': row.server_id,
+                'last_read_id': row.last_read_id
+            }
+            unread, mentions = row.unread_count, row.mention_count
+            # Acks not flushed yet are newer than what was read
+            pending = self.pending.get((user_id, row.id), 0)
+            if pending > row.last_read_id:
+                state['last_read_id'] = pending
+                unread, mentions = db.session.query(
+                    self._unread(row.id, pending), self._mentions(user_id, row.id, pending)
+                ).one()
+            self._set_counts(state, unread, mentions)
+            states.append(state)
+        return states
+
+read_states = ReadStateTracker()
@@ -0,0 +1,94 @@
+from flask import Blueprint, current_app, jsonify, request, send_file
+from sqlalchemy import and_
+from models import db, Attachment, Message, Channel, server_members
+from routes.channels import token_required
+from uploads import blob_store, is_content_hash, sign_attachment_url, verify_attachment_signature
+from urllib.parse import unquote
+import re
+
+attachments_bp = Blueprint('attachments', __name__, url_prefix='/api/attachments')
+
+# Types a browser may render in place; anything else is sent as a download.
+# SVG is an image that can run script, so it is always a download.
+INLINE_TYPES = ('image/', 'video/', 'audio/', 'application/pdf', 'text/plain')
+DOWNLOAD_ONLY_TYPES = ('image/svg+xml',)
+
+MAX_SIGNED_URLS = 100
+
+_attachment_path = re.compile(r'^/api/attachments/([0-9a-f]{64})/(.+)$')
+
+@attachments_bp.route('/sign', methods=['POST'])
+@token_required
+def sign_urls(current_user):
+    # For places that cannot send the Authorization header, like <img src>.
+    # Signing does not check access; the download does, as this user.
+    data = request.get_json()
+    urls = data.get('urls') if isinstance(data, dict) else None
+    if not isinstance(urls, list) or len(urls) > MAX_SIGNED_URLS:
+        return jsonify({'error': f'urls must be a list of at most {MAX_SIGNED_URLS} attachment URLs'}), 400
+
+    signed = []
+    for url in urls:
+        match = _attachment_path.match(url) if isinstance(url, str) else None
+        if match is None:
+            return jsonify({'error': f'Not an attachment URL: {url}'}), 400
+        signed.append(sign_attachment_url(current_app.config['SECRET_KEY'], blob_store.url_ttl, current_user.id,
+                                          match.group(1), unquote(match.group(2))))
+    return jsonify({'urls': signed}), 200
+
+@attachments_bp.route('/<content_hash>/<path:filename>', methods=['GET'])
+def download_attachment(content_hash, filename):
+    if 'signature' not in request.args:
+        return _download_with_token(content_hash, filename)
+
+    user_id = request.args.get('user', type=int)
+    expires = request.args.get('expires', type=int)
+    if user_id is None or expires is None or not verify_attachment_signature(
+            current_app.config['SECRET_KEY'], user_id, expires, request.args['signature'],
+            content_hash, filename):
+        return jsonify({'error': 'Invalid or expired attachment link'}), 403
+    return _send_attachment(user_id, content_hash, filename)
+
+@token_required
+def _download_with_token(current_user, content_hash, filename):
+    return _send_attachment(current_user.id, content_hash, filename)
+
+def _send_attachment(user_id, content_hash, filename):
+    if not is_content_hash(content_hash):
+        return jsonify({'error': 'Attachment not found'}), 404
+
+    # Readable when it is attached to a message in any server the user is in
+    attachment = db.session.query(Attachment.filename, Attachment.content_type)\
+        .join(Message, Message.id == Attachment.message_id)\
+        .join(Channel, Channel.id == Message.channel_id)\
+        .join(server_members, and_(server_members.c.server_id == Channel.server_id,
+                                   server_members.c.user_id == user_id))\
+        .filter(Attachment.content_hash == content_hash, Attachment.filename == filename)\
+        .first()
+    if attachment is None:
+        return jsonify({'error': 'Attachment not found'}), 404
+
+    # send_file answers Range and If-None-Match itself and streams from the
+    # file; with USE_X_SENDFILE the proxy sends it instead. A blob never
+    # changes, so its hash is a strong ETag and it can be cached for good.
+    content_type = attachment.content_type or 'application/octet-stream'
+    inline = content_type.startswith(INLINE_TYPES) and not content_type.startswith(DOWNLOAD_ONLY_TYPES)
+    try:
+        response = send_file(
+            blob_store.blob_path(content_hash),
+            mimetype=content_type,
+            as_attachment=not inline,
+            download_name=attachment.filename,
+            etag=content_hash,
+            max_age=365 * 24 * 3600
+        )
+    except FileNotFoundError:
+        return jsonify({'error': 'Attachment file is missing'}), 404
+    response.cache_control.public = None
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if not inline:
+        # Even if something renders it anyway, it runs with no origin
+        response.headers['Content-Security-Policy'] = "default-src 'none'; sandbox"
+    return response
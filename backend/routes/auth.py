@@ -1,8 +1,9 @@
 from flask import Blueprint, request, jsonify
-import bcrypt
 import jwt
 from datetime import datetime, timedelta
 from models import db, User
+from passwords import password_hasher, PasswordHasherBusy
+from presence import presence
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/api/auth')
 
@@ -26,14 +27,19 @@ def register():
                         (User.email == data['email'])).first():
         return jsonify({'error': 'Username or email already exists'}), 409
     
-    # Hash password
-    password_hash = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt())
+    # Hash password, off the event loop. The connection goes back to the
+    # pool while the hash runs.
+    db.session.rollback()
+    try:
+        password_hash = password_hasher.hash(data['password'])
+    except PasswordHasherBusy as e:
+        return jsonify({'error': str(e)}), 503
     
     # Create new user
     new_user = User(
         username=data['username'],
         email=data['email'],
-        password_hash=password_hash.decode('utf-8'),
+        password_hash=password_hash,
         status='online'
     )
     
@@ -61,9 +67,21 @@ def login():
         return jsonify({'error': 'Missing username or password'}), 400
     
     user = User.query.filter_by(username=data['username']).first()
+    stored_hash = user.password_hash if user else None
+    db.session.rollback()  # hand the connection back while the hash runs
+    
+    try:
+        valid = user is not None and password_hasher.check(data['password'], stored_hash)
+        
+        # Upgrade hashes made with an older work factor while the password is at hand
+        if valid and password_hasher.needs_rehash(stored_hash):
+            user.password_hash = password_hasher.hash(data['password'])
+            db.session.commit()
+            password_hasher.stats['rehashes'] += 1
+    except PasswordHasherBusy as e:
+        return jsonify({'error': str(e)}), 503
     
-    if user and bcrypt.checkpw(data['password'].encode('utf-8'), 
-                             user.password_hash.encode('utf-8')):
+    if valid:
         token = generate_token(user.id)
         return jsonify({
             'token': token,
@@ -114,8 +132,8 @@ def logout():
         payload = jwt.decode(token, 'your-secret-key', algorithms=['HS256'])
         user = User.query.get(payload['user_id'])
         if user:
-            user.status = 'offline'
-            db.session.commit()
+            # Written and broadcast by the next presence flush
+            presence.logout(user.id, stored_status=user.status)
         return jsonify({'message': 'Successfully logged out'}), 200
     except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
         return jsonify({'error': 'Invalid token'}), 401
@@ -1,10 +1,22 @@
 from flask import Blueprint, request, jsonify
-from models import db, Channel, Server, User, Message
+from models import db, ArchiveEntry, Channel, Server, User, Message
+from serializers import serialize_messages, serialize_author
+from message_pipeline import pipeline, MessageCommitTimeout
+from membership import is_member, get_channel_info, invalidate_channel
+from message_cache import message_cache
+from server_tree import bump_version
+from uploads import blob_store
+from archive import archive
+from voice_state import voice_rosters
 from functools import wraps
+from sqlalchemy import tuple_
 import jwt
+import math
 
 channels_bp = Blueprint('channels', __name__, url_prefix='/api/channels')
 
+MAX_PAGE_SIZE = 100
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -25,6 +37,109 @@ def token_required(f):
             return jsonify({'error': 'Invalid token'}), 401
     return decorated
 
+def _cursor_key(channel_id, message_id):
+    row = db.session.query(Message.created_at)\
+        .filter(Message.id == message_id, Message.channel_id == channel_id)\
+        .first()
+    if row is None:
+        archived = archive.find(channel_id, message_id)
+        if archived is None:
+            raise LookupError(message_id)
+        return (archived.created_at, message_id)
+    return (row.created_at, message_id)
+
+def _position(message):
+    return (message.created_at, message.id)
+
+def _merge(rows, archived, reverse):
+    # Archived messages restored to the table (see threads.py) are in both
+    # tiers; the table's copy has the thread counts
+    hot = {row.id for row in rows}
+    return sorted(rows + [message for message in archived if message.id not in hot],
+                  key=_position, reverse=reverse)
+
+def _older(channel_id, key, limit):
+    # Up to limit messages before key (None: the newest), newest first. The
+    # archive is only read once the hot rows run out or reach back past the
+    # newest archived message.
+    query = Message.query.filter(Message.channel_id == channel_id, Message.parent_id.is_(None))
+    if key is not None:
+        query = query.filter(tuple_(Message.created_at, Message.id) < key)
+    rows = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit).all()
+    boundary = archive.max_key(channel_id)
+    if boundary is not None and (len(rows) < limit or _position(rows[-1]) < boundary):
+        rows = _merge(rows, archive.older(channel_id, key, limit), reverse=True)[:limit]
+    return rows
+
+def _newer(channel_id, key, limit):
+    # Up to limit messages after key, oldest first
+    rows = Message.query.filter(Message.channel_id == channel_id, Message.parent_id.is_(None),
+                                tuple_(Message.created_at, Message.id) > key)\
+        .order_by(Message.created_at.asc(), Message.id.asc())\
+        .limit(limit)\
+        .all()
+    boundary = archive.max_key(channel_id)
+    if boundary is not None and key < boundary:
+        rows = _merge(rows, archive.newer(channel_id, key, limit), reverse=False)[:limit]
+    return rows
+
+def get_message_page(channel_id, limit, before=None, after=None, around=None):
+    """Return (messages newest first, has_more) for one page of channel history.
+
+    Thread replies are read through their thread, not channel history.
+    Pages reach into the message archive (see archive.py) once they pass the
+    oldest message still in the database. Raises LookupError when the
+    cursor message is not in the channel.
+    """
+    if around is not None:
+        created_at, message_id = _cursor_key(channel_id, around)
+        # (created_at, id + 1) is the first position after the cursor message
+        older = _older(channel_id, (created_at, message_id + 1), limit - limit // 2 + 1)
+        newer = _newer(channel_id, (created_at, message_id), limit // 2 + 1)
+        has_more = len(older) > limit - limit // 2 or len(newer) > limit // 2
+        return list(reversed(newer[:limit // 2])) + older[:limit - limit // 2], has_more
+
+    if after is not None:
+        rows = _newer(channel_id, _cursor_key(channel_id, after), limit + 1)
+        return list(reversed(rows[:limit])), len(rows) > limit
+
+    key = _cursor_key(channel_id, before) if before is not None else None
+    rows = _older(channel_id, key, limit + 1)
+    return rows[:limit], len(rows) > limit
+
+def count_messages(channel_id):
+    count = Message.query.filter_by(channel_id=channel_id, parent_id=None).count()
+    if archive.max_key(channel_id) is not None:
+        restored = Message.query.join(ArchiveEntry, ArchiveEntry.id == Message.id)\
+            .filter(ArchiveEntry.channel_id == channel_id).count()
+        count += archive.count(channel_id) - restored
+    return count
+
+def _flag(name, default):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    return value.lower() not in ('0', 'false', 'no')
+
+def _first_page(channel_id, limit, include_total):
+    """(messages newest first, has_more, total) for the newest page of a channel."""
+    cached = message_cache.first_page(channel_id, limit, include_total)
+    if cached is not None:
+        return cached
+    # A miss reads a whole cache window, so the next open of this channel
+    # is a hit whatever limit it asks for
+    fill = message_cache.enabled
+    read_limit = max(limit, message_cache.per_channel) if fill else limit
+    token = message_cache.fill_token()
+    items, has_more = get_message_page(channel_id, read_limit)
+    messages = serialize_messages(items)
+    total = count_messages(channel_id) if include_total else None
+    if fill:
+        message_cache.fill(channel_id, token, messages, has_more, total)
+        has_more = has_more or len(messages) > limit
+        messages = messages[:limit]
+    return messages, has_more, total
+
 @channels_bp.route('/<int:server_id>/create', methods=['POST'])
 @token_required
 def create_channel(current_user, server_id):
@@ -49,6 +164,7 @@ def create_channel(current_user, server_id):
             server_id=server_id
         )
         db.session.add(new_channel)
+        bump_version(server_id)
         db.session.commit()
         
         return jsonify({
@@ -66,50 +182,73 @@ def create_channel(current_user, server_id):
 @channels_bp.route('/<int:channel_id>', methods=['GET'])
 @token_required
 def get_channel(current_user, channel_id):
-    channel = Channel.query.get(channel_id)
+    channel = get_channel_info(channel_id)
     if not channel:
         return jsonify({'error': 'Channel not found'}), 404
     
-    server = Server.query.get(channel.server_id)
-    if current_user not in server.members:
+    if not is_member(current_user.id, channel.server_id):
         return jsonify({'error': 'Access denied'}), 403
     
-    # Get messages with pagination
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 50, type=int)
-    
-    messages = Message.query.filter_by(channel_id=channel_id)\
-        .order_by(Message.created_at.desc())\
-        .paginate(page=page, per_page=per_page)
-    
+    # Offset pages (page/per_page) are the default and keep the original
+    # response shape; they only cover messages still in the database. Passing
+    # before, after or around (a message id), or cursor=true for the newest
+    # page, switches to cursor pagination, which walks the
+    # (channel_id, created_at, id) index, so deep pages cost the same as
+    # page 1, and reaches into the archive.
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    around = request.args.get('around', type=int)
+    limit = request.args.get('limit', request.args.get('per_page', 50, type=int), type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    include_total = _flag('count', True)
+
+    if sum(cursor is not None for cursor in (before, after, around)) > 1:
+        return jsonify({'error': 'Only one of before, after or around may be given'}), 400
+
+    if before is None and after is None and around is None and not _flag('cursor', False):
+        page = max(request.args.get('page', 1, type=int), 1)
+        if page == 1 and archive.max_key(channel_id) is None:
+            # With nothing archived the first offset page is the newest
+            # cursor page, so it is served from the message cache too
+            messages, _, total = _first_page(channel_id, limit, include_total)
+        else:
+            paginated = Message.query.filter_by(channel_id=channel_id, parent_id=None)\
+                .order_by(Message.created_at.desc(), Message.id.desc())\
+                .paginate(page=page, per_page=limit, count=include_total)
+            messages = serialize_messages(paginated.items)
+            total = paginated.total
+        pagination = {
+            'total': total,
+            'pages': math.ceil(total / limit) if include_total else None,
+            'current_page': page,
+            'per_page': limit
+        }
+    else:
+        if before is None and after is None and around is None:
+            messages, has_more, total = _first_page(channel_id, limit, include_total)
+        else:
+            try:
+                items, has_more = get_message_page(channel_id, limit, before=before, after=after, around=around)
+            except LookupError:
+                return jsonify({'error': 'Cursor message not found'}), 404
+            messages = serialize_messages(items)
+            total = count_messages(channel_id) if include_total else None
+        pagination = {
+            'per_page': limit,
+            'has_more': has_more,
+            'before': messages[-1]['id'] if messages else None,
+            'after': messages[0]['id'] if messages else None,
+            'total': total
+        }
+
     return jsonify({
         'channel': {
             'id': channel.id,
             'name': channel.name,
             'type': channel.type,
             'server_id': channel.server_id,
-            'messages': [{
-                'id': msg.id,
-                'content': msg.content,
-                'created_at': msg.created_at.isoformat(),
-                'edited_at': msg.edited_at.isoformat() if msg.edited_at else None,
-                'author': {
-                    'id': msg.author.id,
-                    'username': msg.author.username,
-                    'avatar_url': msg.author.avatar_url
-                },
-                'attachments': [{
-                    'id': att.id,
-                    'filename': att.filename,
-                    'file_url': att.file_url
-                } for att in msg.attachments]
-            } for msg in messages.items],
-            'pagination': {
-                'total': messages.total,
-                'pages': messages.pages,
-                'current_page': messages.page,
-                'per_page': messages.per_page
-            }
+            'messages': messages,
+            'pagination': pagination
         }
     }), 200
 
@@ -126,7 +265,12 @@ def delete_channel(current_user, channel_id):
     
     try:
         db.session.delete(channel)
+        bump_version(channel.server_id)
         db.session.commit()
+        invalidate_channel(channel_id)
+        message_cache.invalidate(channel_id)
+        archive.drop(channel_id)
+        voice_rosters.drop_channel(channel_id)
         return jsonify({'message': 'Channel deleted successfully'}), 200
     except Exception as e:
         db.session.rollback()
@@ -142,36 +286,30 @@ def send_message(current_user, channel_id):
     if channel.type != 'text':
         return jsonify({'error': 'Can only send messages in text channels'}), 400
     
-    server = Server.query.get(channel.server_id)
-    if current_user not in server.members:
+    if not is_member(current_user.id, channel.server_id):
         return jsonify({'error': 'Access denied'}), 403
     
     data = request.get_json()
-    if 'content' not in data:
+    upload_ids = data.get('attachments') or []
+    if 'content' not in data and not upload_ids:
         return jsonify({'error': 'Message content is required'}), 400
     
+    # Finished uploads (see routes/uploads.py), attached by upload id
+    if not isinstance(upload_ids, list):
+        return jsonify({'error': 'attachments must be a list of upload ids'}), 400
     try:
-        new_message = Message(
-            content=data['content'],
-            channel_id=channel_id,
-            user_id=current_user.id
-        )
-        db.session.add(new_message)
-        db.session.commit()
-        
-        # The actual message broadcast will be handled by SocketIO
+        attachments = blob_store.claim(current_user.id, upload_ids)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        message = pipeline.submit(channel_id, current_user.id, data.get('content', ''),
+                                  serialize_author(current_user), wait=True,
+                                  attachments=attachments)
         return jsonify({
-            'message': {
-                'id': new_message.id,
-                'content': new_message.content,
-                'created_at': new_message.created_at.isoformat(),
-                'author': {
-                    'id': current_user.id,
-                    'username': current_user.username,
-                    'avatar_url': current_user.avatar_url
-                }
-            }
+            'message': message
         }), 201
+    except MessageCommitTimeout:
+        return jsonify({'error': 'Message was not saved in time'}), 503
     except Exception as e:
-        db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,24 @@
+from flask import Blueprint, Response, abort, request
+from metrics import metrics
+import hmac
+
+metrics_bp = Blueprint('metrics', __name__)
+
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+def _authorized():
+    # Room names and connection counts are not for the public. Without a
+    # token only this machine may scrape; a reverse proxy on the same host
+    # makes every request look local, so set METRICS_TOKEN behind one.
+    if metrics.token is None:
+        return request.remote_addr in LOOPBACK_ADDRESSES
+    auth_header = request.headers.get('Authorization', '')
+    return hmac.compare_digest(auth_header.encode('utf-8'), f'Bearer {metrics.token}'.encode('utf-8'))
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def export_metrics():
+    if not metrics.enabled:
+        abort(404)
+    if not _authorized():
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,19 @@
+from flask import Blueprint, request, jsonify
+from membership import is_member
+from routes.channels import token_required
+from read_state import read_states
+
+read_states_bp = Blueprint('read_states', __name__, url_prefix='/api/read-states')
+
+@read_states_bp.route('', methods=['GET'])
+@token_required
+def get_read_states(current_user):
+    # Every text channel of the user's servers, or of one server
+    server_id = request.args.get('server_id', type=int)
+    if server_id is not None and not is_member(current_user.id, server_id):
+        return jsonify({'error': 'Access denied'}), 403
+
+    return jsonify({
+        'read_states': read_states.counts(current_user.id, server_id),
+        'unread_cap': read_states.unread_cap
+    }), 200
@@ -0,0 +1,91 @@
+from flask import Blueprint, request, jsonify
+from datetime import datetime, timezone
+from models import db, Channel, Message
+from serializers import serialize_messages
+from archive import archive
+from membership import is_member, get_channel_info
+from routes.channels import token_required
+import search
+
+search_bp = Blueprint('search', __name__, url_prefix='/api/search')
+
+MAX_RESULTS = 100
+
+def _parse_datetime(value):
+    if value is None:
+        return None
+    # Stored times are naive UTC; an offset is converted, not dropped
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@search_bp.route('', methods=['GET'])
+@token_required
+def search_messages(current_user):
+    if not search.enabled:
+        return jsonify({'error': 'Search is not available on this database'}), 503
+
+    terms = request.args.get('q', '').strip()
+    if not terms:
+        return jsonify({'error': 'Search query is required'}), 400
+
+    server_id = request.args.get('server_id', type=int)
+    channel_id = request.args.get('channel_id', type=int)
+
+    # Scope: one channel, or every channel of one server
+    if channel_id is not None:
+        channel = get_channel_info(channel_id)
+        if not channel:
+            return jsonify({'error': 'Channel not found'}), 404
+        if server_id is not None and channel.server_id != server_id:
+            return jsonify({'error': 'Channel is not in this server'}), 400
+        if not is_member(current_user.id, channel.server_id):
+            return jsonify({'error': 'Access denied'}), 403
+        channel_ids = [channel_id]
+    elif server_id is not None:
+        if not is_member(current_user.id, server_id):
+            return jsonify({'error': 'Access denied'}), 403
+        channel_ids = [row.id for row in db.session.query(Channel.id).filter_by(server_id=server_id, type='text')]
+    else:
+        return jsonify({'error': 'server_id or channel_id is required'}), 400
+
+    try:
+        since = _parse_datetime(request.args.get('after'))
+        until = _parse_datetime(request.args.get('before'))
+    except ValueError:
+        return jsonify({'error': 'Dates must be ISO 8601'}), 400
+
+    limit = max(1, min(request.args.get('limit', 25, type=int), MAX_RESULTS))
+    try:
+        hits, next_cursor = search.search_messages(
+            terms, channel_ids,
+            author_id=request.args.get('author_id', type=int),
+            since=since,
+            until=until,
+            sort=request.args.get('sort', 'relevance'),
+            limit=limit,
+            cursor=request.args.get('cursor')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Load the hits in one query and keep the ranked order; the ones not in
+    # the table are archived
+    by_id = {msg.id: msg for msg in Message.query.filter(Message.id.in_([hit.id for hit in hits]))}
+    for hit in hits:
+        if hit.id not in by_id:
+            archived = archive.find_by_id(hit.id)
+            if archived is not None:
+                by_id[hit.id] = archived
+    hits = [hit for hit in hits if hit.id in by_id]
+    results = serialize_messages([by_id[hit.id] for hit in hits])
+    for result, hit in zip(results, hits):
+        result['rank'] = hit.rank
+        result['snippet'] = hit.snippet if hit.snippet is not None else \
+            search.archived_snippet(by_id[hit.id].content, terms)
+
+    return jsonify({
+        'results': results,
+        'cursor': next_cursor
+    }), 200
@@ -1,10 +1,18 @@
-from flask import Blueprint, request, jsonify
-from models import db, Server, Channel, User
+from flask import Blueprint, request, jsonify, current_app
+from models import db, Server, Channel, User, server_members
+from membership import is_member, invalidate_membership
+from presence import presence
+from server_tree import bump_version, user_tree_versions, tree_etag, get_trees
+from member_lists import member_lists, member_page, member_count, online_count, ORDERS
+from voice_state import voice_rosters
+from sockets import leave_server_rooms
 from functools import wraps
 import jwt
 
 servers_bp = Blueprint('servers', __name__, url_prefix='/api/servers')
 
+MAX_MEMBER_PAGE = 1000
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -63,6 +71,7 @@ def create_server(current_user):
         db.session.add(general_channel)
         db.session.add(voice_channel)
         db.session.commit()
+        invalidate_membership(current_user.id, new_server.id)
         
         return jsonify({
             'server': {
@@ -84,20 +93,17 @@ def create_server(current_user):
 @token_required
 def get_user_servers(current_user):
     try:
-        servers = current_user.servers
-        return jsonify({
-            'servers': [{
-                'id': server.id,
-                'name': server.name,
-                'description': server.description,
-                'icon_url': server.icon_url,
-                'channels': [{
-                    'id': channel.id,
-                    'name': channel.name,
-                    'type': channel.type
-                } for channel in server.channels]
-            } for server in servers]
-        }), 200
+        # The ETag covers the versions of every tree in the list, so an
+        # unchanged list is answered from this one query
+        versions = user_tree_versions(current_user.id)
+        etag = tree_etag(versions)
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = jsonify({'servers': get_trees(versions)})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -108,9 +114,16 @@ def get_server(current_user, server_id):
     if not server:
         return jsonify({'error': 'Server not found'}), 404
     
-    if current_user not in server.members:
+    if not is_member(current_user.id, server_id):
         return jsonify({'error': 'Access denied'}), 403
     
+    # Summary mode leaves the member list to GET /<id>/members
+    if request.args.get('summary', 'false').lower() in ('1', 'true', 'yes'):
+        summary = dict(get_trees([(server.id, server.structure_version)])[0],
+                       member_count=member_count(server_id),
+                       online_count=online_count(server_id))
+        return jsonify({'server': summary}), 200
+    
     return jsonify({
         'server': {
             'id': server.id,
@@ -125,12 +138,75 @@ def get_server(current_user, server_id):
             'members': [{
                 'id': member.id,
                 'username': member.username,
-                'status': member.status,
+                'status': presence.status_of(member.id, member.status),
                 'avatar_url': member.avatar_url
             } for member in server.members]
         }
     }), 200
 
+@servers_bp.route('/<int:server_id>/members', methods=['GET'])
+@token_required
+def get_server_members(current_user, server_id):
+    if not is_member(current_user.id, server_id):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    order = request.args.get('order', 'username')
+    if order not in ORDERS:
+        return jsonify({'error': 'order must be username or status'}), 400
+    
+    limit = max(1, min(request.args.get('limit', 100, type=int), MAX_MEMBER_PAGE))
+    try:
+        members, next_cursor = member_page(server_id, order, limit, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'members': members,
+        'cursor': next_cursor
+    }), 200
+
+@servers_bp.route('/<int:server_id>/voice-states', methods=['GET'])
+@token_required
+def get_voice_states(current_user, server_id):
+    if not is_member(current_user.id, server_id):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    # Voice channels with anyone in them, from this process's rosters
+    return jsonify({'voice_states': voice_rosters.server_rosters(server_id)}), 200
+
+@servers_bp.route('/<int:server_id>', methods=['PATCH'])
+@token_required
+def update_server(current_user, server_id):
+    server = Server.query.get(server_id)
+    if not server:
+        return jsonify({'error': 'Server not found'}), 404
+    
+    if current_user.id != server.owner_id:
+        return jsonify({'error': 'Only server owner can edit the server'}), 403
+    
+    data = request.get_json()
+    if 'name' in data and not data['name']:
+        return jsonify({'error': 'Server name is required'}), 400
+    
+    try:
+        for field in ('name', 'description', 'icon_url'):
+            if field in data:
+                setattr(server, field, data[field])
+        bump_version(server_id)
+        db.session.commit()
+        
+        return jsonify({
+            'server': {
+                'id': server.id,
+                'name': server.name,
+                'description': server.description,
+                'icon_url': server.icon_url
+            }
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 @servers_bp.route('/<int:server_id>/invite', methods=['POST'])
 @token_required
 def invite_to_server(current_user, server_id):
@@ -149,13 +225,45 @@ def invite_to_server(current_user, server_id):
     if not user_to_invite:
         return jsonify({'error': 'User not found'}), 404
     
-    if user_to_invite in server.members:
+    if is_member(user_to_invite.id, server_id):
         return jsonify({'error': 'User is already a member'}), 400
     
     try:
-        server.members.append(user_to_invite)
+        db.session.execute(server_members.insert().values(
+            user_id=user_to_invite.id, server_id=server_id
+        ))
         db.session.commit()
+        invalidate_membership(user_to_invite.id, server_id)
+        member_lists.refresh(server_id)
         return jsonify({'message': f'Successfully invited {user_to_invite.username}'}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+
+@servers_bp.route('/<int:server_id>/leave', methods=['POST'])
+@token_required
+def leave_server(current_user, server_id):
+    server = Server.query.get(server_id)
+    if not server:
+        return jsonify({'error': 'Server not found'}), 404
+    
+    if current_user.id == server.owner_id:
+        return jsonify({'error': 'Server owner cannot leave the server'}), 400
+    
+    if not is_member(current_user.id, server_id):
+        return jsonify({'error': 'User is not a member'}), 400
+    
+    try:
+        db.session.execute(server_members.delete().where(
+            (server_members.c.user_id == current_user.id) &
+            (server_members.c.server_id == server_id)
+        ))
+        db.session.commit()
+        invalidate_membership(current_user.id, server_id)
+        leave_server_rooms(current_user.id, server_id)
+        member_lists.refresh(server_id)
+        voice_rosters.remove_user(current_user.id, server_id)
+        return jsonify({'message': f'Successfully left {server.name}'}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
@@ -0,0 +1,76 @@
+from flask import Blueprint, request, jsonify
+from serializers import serialize_messages, serialize_author
+from message_pipeline import pipeline, MessageCommitTimeout
+from membership import is_member, get_channel_info
+from routes.channels import token_required
+from threads import get_parent, thread_page
+from uploads import blob_store
+
+threads_bp = Blueprint('threads', __name__, url_prefix='/api/threads')
+
+MAX_PAGE_SIZE = 100
+
+def _thread_channel(current_user, message_id):
+    # Returns (parent, channel, error response)
+    parent = get_parent(message_id)
+    if not parent:
+        return None, None, (jsonify({'error': 'Thread not found'}), 404)
+    channel = get_channel_info(parent.channel_id)
+    if not channel or not is_member(current_user.id, channel.server_id):
+        return None, None, (jsonify({'error': 'Access denied'}), 403)
+    return parent, channel, None
+
+@threads_bp.route('/<int:message_id>', methods=['GET'])
+@token_required
+def get_thread(current_user, message_id):
+    parent, channel, error = _thread_channel(current_user, message_id)
+    if error:
+        return error
+
+    limit = max(1, min(request.args.get('limit', 50, type=int), MAX_PAGE_SIZE))
+    try:
+        replies, next_cursor = thread_page(message_id, limit, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # The parent is serialized with the page so authors load once
+    parent, *messages = serialize_messages([parent] + replies)
+    return jsonify({
+        'thread': {
+            'channel_id': channel.id,
+            'parent': parent,
+            'messages': messages,
+            'cursor': next_cursor
+        }
+    }), 200
+
+@threads_bp.route('/<int:message_id>/messages', methods=['POST'])
+@token_required
+def reply(current_user, message_id):
+    _, channel, error = _thread_channel(current_user, message_id)
+    if error:
+        return error
+
+    data = request.get_json()
+    upload_ids = data.get('attachments') or []
+    if 'content' not in data and not upload_ids:
+        return jsonify({'error': 'Message content is required'}), 400
+
+    if not isinstance(upload_ids, list):
+        return jsonify({'error': 'attachments must be a list of upload ids'}), 400
+    try:
+        attachments = blob_store.claim(current_user.id, upload_ids)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        message = pipeline.submit(channel.id, current_user.id, data.get('content', ''),
+                                  serialize_author(current_user), wait=True,
+                                  parent_id=message_id, attachments=attachments)
+        return jsonify({
+            'message': message
+        }), 201
+    except MessageCommitTimeout:
+        return jsonify({'error': 'Message was not saved in time'}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
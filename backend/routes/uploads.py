@@ -0,0 +1,75 @@
+from flask import Blueprint, request, jsonify
+from routes.channels import token_required
+from uploads import blob_store, UploadOffsetMismatch
+
+uploads_bp = Blueprint('uploads', __name__, url_prefix='/api/uploads')
+
+def _upload_state(upload):
+    return {
+        'upload_id': upload['id'],
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'offset': blob_store.offset(upload),
+        'complete': upload['content_hash'] is not None
+    }
+
+def _own_upload(current_user, upload_id):
+    upload = blob_store.load(upload_id)
+    if upload is None or upload['user_id'] != current_user.id:
+        return None
+    return upload
+
+@uploads_bp.route('', methods=['POST'])
+@token_required
+def start_upload(current_user):
+    data = request.get_json()
+    filename = data.get('filename')
+    size = data.get('size')
+    if not filename or not isinstance(size, int) or size < 1:
+        return jsonify({'error': 'filename and a positive size are required'}), 400
+
+    if size > blob_store.max_size:
+        return jsonify({'error': f'Files may be at most {blob_store.max_size} bytes'}), 413
+
+    upload = blob_store.start(current_user.id, filename, size)
+    return jsonify({'upload': _upload_state(upload)}), 201
+
+@uploads_bp.route('/<upload_id>', methods=['GET'])
+@token_required
+def get_upload(current_user, upload_id):
+    # A client resuming after a dropped connection continues from 'offset'
+    upload = _own_upload(current_user, upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'upload': _upload_state(upload)}), 200
+
+@uploads_bp.route('/<upload_id>', methods=['PATCH'])
+@token_required
+def upload_chunk(current_user, upload_id):
+    upload = _own_upload(current_user, upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    # The body is the chunk itself, read from the stream a piece at a time
+    # and never held whole. Upload-Offset says where it starts.
+    offset = request.headers.get('Upload-Offset', type=int)
+    length = request.content_length
+    if offset is None or length is None:
+        return jsonify({'error': 'Upload-Offset and Content-Length are required'}), 400
+
+    try:
+        blob_store.write_chunk(upload, offset, request.stream, length)
+    except UploadOffsetMismatch as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'upload': _upload_state(upload)}), 200
+
+@uploads_bp.route('/<upload_id>', methods=['DELETE'])
+@token_required
+def cancel_upload(current_user, upload_id):
+    upload = _own_upload(current_user, upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    blob_store.discard(upload_id)
+    return jsonify({'message': 'Upload cancelled'}), 200
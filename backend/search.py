@@ -0,0 +1,242 @@
+import base64
+import json
+import re
+from collections import namedtuple
+from sqlalchemy import and_, column, func, literal_column, or_, table
+from models import db, Message, ArchiveEntry
+
+# Full-text search over messages.content with an SQLite FTS5 index. The
+# index is an external-content table over messages, kept in step by
+# triggers on insert, edit and delete. Only ids and ranks are read from it;
+# rows are loaded from messages.
+#
+# Archived messages (see archive.py) keep their index rows: the archive
+# deletes them from messages with the delete trigger paused, and records
+# their channel, author and date in archive_entries for the search filters.
+# FTS5 builds snippets from the messages table, so theirs are built here.
+
+FTS_TABLE = 'messages_fts'
+
+SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END"""
+]
+
+fts = table(FTS_TABLE, column('rowid'))
+fts_ref = literal_column(FTS_TABLE)
+
+SearchHit = namedtuple('SearchHit', ['id', 'rank', 'snippet'])
+
+# Set once the index is installed; False on databases without FTS5
+enabled = False
+
+def search_available(engine):
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.connect() as connection:
+        options = connection.exec_driver_sql('PRAGMA compile_options').scalars().all()
+    return 'ENABLE_FTS5' in options
+
+def install_search_index(engine):
+    # Returns True when the index was created by this call
+    global enabled
+    if not search_available(engine):
+        return False
+    enabled = True
+    with engine.begin() as connection:
+        existed = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)
+        ).first() is not None
+        for statement in SCHEMA:
+            connection.exec_driver_sql(statement)
+    return not existed
+
+def rebuild_search_index(engine):
+    # Re-reads every row of messages; needed once for databases that had
+    # messages before the index existed
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        connection.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+# Bulk inserts can index their rows in one statement instead of one trigger
+# call each. Both halves run in the caller's write transaction, so no other
+# insert can slip past the missing trigger.
+
+def pause_insert_indexing(cursor):
+    """Drop the insert trigger; True when there was one to put back."""
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'messages_fts_insert'"
+    ).fetchone() is not None
+    if exists:
+        cursor.execute('DROP TRIGGER messages_fts_insert')
+    return exists
+
+def resume_insert_indexing(cursor, first_id, last_id):
+    """Index the messages inserted with ids in [first_id, last_id] and restore the trigger."""
+    if first_id is not None:
+        cursor.execute(f'INSERT INTO {FTS_TABLE}(rowid, content) '
+                       'SELECT id, content FROM messages WHERE id BETWEEN ? AND ?', (first_id, last_id))
+    cursor.execute(SCHEMA[1])
+
+# The archive moves messages out of the table without taking them out of
+# the index, and puts them back the same way. These run in the caller's
+# transaction, on a SQLAlchemy connection.
+
+def pause_delete_indexing(connection):
+    """Drop the delete trigger; True when there was one to put back."""
+    exists = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'messages_fts_delete'"
+    ).first() is not None
+    if exists:
+        connection.exec_driver_sql('DROP TRIGGER messages_fts_delete')
+    return exists
+
+def resume_delete_indexing(connection):
+    connection.exec_driver_sql(SCHEMA[2])
+
+def index_rows(connection, rows):
+    """Index (id, content) rows that are not in the messages table."""
+    if enabled and rows:
+        connection.exec_driver_sql(f'INSERT INTO {FTS_TABLE}(rowid, content) VALUES (?, ?)', rows)
+
+def unindex_rows(connection, rows):
+    """Take (id, content) rows out of the index; content must be what was indexed."""
+    if enabled and rows:
+        connection.exec_driver_sql(
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', ?, ?)", rows)
+
+def build_match(terms):
+    # Quote every term so user input can never be read as FTS5 syntax; a
+    # trailing * is kept as a prefix search
+    tokens = []
+    for term in terms.split():
+        prefix = term.endswith('*')
+        term = term.rstrip('*').replace('"', '""')
+        if term:
+            tokens.append(f'"{term}"' + ('*' if prefix else ''))
+    return ' '.join(tokens)
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, *kinds):
+    """Decode a cursor made by encode_cursor.
+
+    With ``kinds``, it must be a list of one value of each, in order (a
+    kind may be a tuple of types); anything else raises ValueError, as a
+    client can send any cursor it likes.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if kinds and not (isinstance(values, list) and len(values) == len(kinds) and all(
+            isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(values, kinds))):
+        raise ValueError('Invalid cursor')
+    return values
+
+def search_messages(terms, channel_ids, author_id=None, since=None, until=None,
+                    sort='relevance', limit=25, cursor=None):
+    """Return (rows, next_cursor) for one page of search results.
+
+    Each row is a SearchHit with id, rank and snippet. ``sort`` is 'relevance' (bm25, best
+    first) or 'recent' (newest first).
+    """
+    match = build_match(terms)
+    if not match or not channel_ids:
+        return [], None
+
+    # A hit is a message in the table or, failing that, an archived one
+    rank = func.bm25(fts_ref)
+    channel_id = func.coalesce(Message.channel_id, ArchiveEntry.channel_id)
+    query = db.session.query(fts.c.rowid.label('id'), rank.label('rank'), Message.id.label('hot_id'))\
+        .select_from(fts)\
+        .outerjoin(Message, Message.id == fts.c.rowid)\
+        .outerjoin(ArchiveEntry, ArchiveEntry.id == fts.c.rowid)\
+        .filter(fts_ref.op('MATCH')(match))\
+        .filter(channel_id.in_(channel_ids))
+
+    if author_id is not None:
+        query = query.filter(func.coalesce(Message.user_id, ArchiveEntry.user_id) == author_id)
+    created_at = func.coalesce(Message.created_at, ArchiveEntry.created_at)
+    if since is not None:
+        query = query.filter(created_at >= since)
+    if until is not None:
+        query = query.filter(created_at < until)
+
+    if sort not in ('recent', 'relevance'):
+        raise ValueError(f'Unknown sort: {sort}')
+    after = None
+    if cursor:
+        # recent: [rowid]; relevance: [rank, rowid]
+        kinds = (int,) if sort == 'recent' else ((int, float), int)
+        after = decode_cursor(cursor, *kinds)
+    if sort == 'recent':
+        # Ordering on the index rowid lets FTS5 walk its doclists backwards
+        # instead of sorting every match
+        if after is not None:
+            query = query.filter(fts.c.rowid < after[0])
+        query = query.order_by(fts.c.rowid.desc())
+    else:
+        if after is not None:
+            query = query.filter(or_(
+                rank > after[0],
+                and_(rank == after[0], fts.c.rowid > after[1])
+            ))
+        query = query.order_by(rank, fts.c.rowid)
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([last.id] if sort == 'recent' else [last.rank, last.id])
+
+    # Snippets are only built for the page, not for every match, and
+    # archived hits are left for archived_snippet()
+    hot_ids = [row.id for row in rows if row.hot_id is not None]
+    snippets = dict(
+        db.session.query(fts.c.rowid, func.snippet(fts_ref, 0, '[', ']', '...', 12))
+        .filter(fts_ref.op('MATCH')(match))
+        .filter(fts.c.rowid.in_(hot_ids))
+        .all()
+    ) if hot_ids else {}
+    return [
+        SearchHit(row.id, row.rank, snippets.get(row.id))
+        for row in rows
+    ], next_cursor
+
+_word = re.compile(r'\w+')
+
+def archived_snippet(content, terms, tokens=12):
+    """A snippet of an archived message, shaped like the ones FTS5 builds."""
+    wanted = [(term.rstrip('*').lower(), term.endswith('*')) for term in terms.split() if term.rstrip('*')]
+
+    def matches(word):
+        word = word.lower()
+        return any(word.startswith(term) if prefix else word == term for term, prefix in wanted)
+
+    words = list(_word.finditer(content))
+    first = next((i for i, word in enumerate(words) if matches(word.group())), 0)
+    start = max(0, min(first, len(words) - tokens))
+    window = words[start:start + tokens]
+    if not window:
+        return content
+    parts = []
+    position = window[0].start()
+    for word in window:
+        parts.append(content[position:word.start()])
+        parts.append(f'[{word.group()}]' if matches(word.group()) else word.group())
+        position = word.end()
+    return ('...' if start else '') + ''.join(parts) + ('...' if start + tokens < len(words) else '')
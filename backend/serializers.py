@@ -0,0 +1,71 @@
+from models import db, User, Attachment
+
+# Message payloads are built from id -> row lookup maps so that a page of
+# messages costs a fixed number of queries (one for authors, one for
+# attachments) instead of two lazy loads per message.
+
+def serialize_author(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'avatar_url': user.avatar_url
+    }
+
+def serialize_attachment(attachment):
+    return {
+        'id': attachment.id,
+        'filename': attachment.filename,
+        'file_url': attachment.file_url,
+        'size': attachment.size,
+        'content_type': attachment.content_type
+    }
+
+def load_authors(user_ids):
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    rows = db.session.query(User.id, User.username, User.avatar_url)\
+        .filter(User.id.in_(user_ids))\
+        .all()
+    return {row.id: serialize_author(row) for row in rows}
+
+def load_attachments(message_ids):
+    message_ids = set(message_ids)
+    attachments = {message_id: [] for message_id in message_ids}
+    if not message_ids:
+        return attachments
+    rows = Attachment.query.filter(Attachment.message_id.in_(message_ids))\
+        .order_by(Attachment.id)\
+        .all()
+    for att in rows:
+        attachments[att.message_id].append(serialize_attachment(att))
+    return attachments
+
+def serialize_message(msg, author, attachments):
+    return {
+        'id': msg.id,
+        'content': msg.content,
+        'channel_id': msg.channel_id,
+        'created_at': msg.created_at.isoformat(),
+        'edited_at': msg.edited_at.isoformat() if msg.edited_at else None,
+        'author': author,
+        'attachments': attachments,
+        'parent_id': msg.parent_id,
+        'reply_count': msg.reply_count,
+        'last_reply_at': msg.last_reply_at.isoformat() if msg.last_reply_at else None
+    }
+
+def serialize_messages(messages, authors=None):
+    """Serialize a list of messages, preserving order.
+
+    ``authors`` may hold already-serialized authors keyed by user id; only
+    the missing ones are loaded.
+    """
+    authors = dict(authors or {})
+    missing = {msg.user_id for msg in messages} - set(authors)
+    authors.update(load_authors(missing))
+    attachments = load_attachments(msg.id for msg in messages)
+    return [
+        serialize_message(msg, authors.get(msg.user_id), attachments[msg.id])
+        for msg in messages
+    ]
@@ -0,0 +1,70 @@
+import hashlib
+from collections import OrderedDict
+from models import db, Server, Channel, server_members
+
+# Serialized server trees (a server and its channels) for GET /api/servers/.
+# servers.structure_version goes up in the same transaction as every change
+# to a tree: channel create and delete, server edits. A cached tree is used
+# while its version matches the one in the database, so caches in several
+# workers never need to be told about changes.
+
+MAX_CACHED_TREES = 10000
+
+_trees = OrderedDict()  # server_id -> (structure_version, payload)
+
+def bump_version(server_id):
+    # Call inside the transaction that changes the tree
+    db.session.execute(
+        db.update(Server)
+        .where(Server.id == server_id)
+        .values(structure_version=Server.structure_version + 1)
+    )
+
+def user_tree_versions(user_id):
+    """[(server_id, structure_version)] for the servers a user belongs to, in one query."""
+    return db.session.query(Server.id, Server.structure_version)\
+        .join(server_members, server_members.c.server_id == Server.id)\
+        .filter(server_members.c.user_id == user_id)\
+        .order_by(Server.id)\
+        .all()
+
+def tree_etag(versions):
+    digest = hashlib.sha1(','.join(f'{sid}:{version}' for sid, version in versions).encode('ascii'))
+    return digest.hexdigest()
+
+def _serialize(server, channels):
+    return {
+        'id': server.id,
+        'name': server.name,
+        'description': server.description,
+        'icon_url': server.icon_url,
+        'channels': [{
+            'id': channel.id,
+            'name': channel.name,
+            'type': channel.type
+        } for channel in channels]
+    }
+
+def get_trees(versions):
+    # Stale or missing trees are loaded together: one query for the servers
+    # and one for their channels, however many there are
+    stale = [sid for sid, version in versions if _trees.get(sid, (None,))[0] != version]
+    if stale:
+        servers = Server.query.filter(Server.id.in_(stale)).all()
+        channels = {sid: [] for sid in stale}
+        for channel in Channel.query.filter(Channel.server_id.in_(stale)).order_by(Channel.id):
+            channels[channel.server_id].append(channel)
+        for server in servers:
+            _trees[server.id] = (server.structure_version, _serialize(server, channels[server.id]))
+
+    trees = []
+    for sid, _ in versions:
+        if sid in _trees:
+            _trees.move_to_end(sid)
+            trees.append(_trees[sid][1])
+    while len(_trees) > MAX_CACHED_TREES:
+        _trees.popitem(last=False)
+    return trees
+
+def clear():
+    _trees.clear()
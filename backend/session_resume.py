@@ -0,0 +1,217 @@
+import secrets
+import time
+from collections import deque
+from wire import EncodeOnceManager
+
+# Resumable socket sessions. Every event the server emits gets the next
+# number of one process-wide sequence, as a 'seq' key in its payload; a
+# broadcast carries the same number to every recipient, so it is still
+# encoded once (see wire.EncodeOnceManager). Each session keeps its last
+# RESUME_BUFFER_SIZE events.
+#
+# On connect a socket is sent ready {session_id, seq}. When it drops, its
+# session is kept for RESUME_WINDOW seconds with the rooms it was in, and
+# events sent to those rooms keep going into its buffer. A client that
+# reconnects sends resume {session_id, seq} with the highest seq it saw:
+# the new socket rejoins the old rooms and gets every buffered event after
+# seq, in order, then resumed {session_id, replayed}. If the session is
+# gone or the buffer no longer reaches back to seq, it gets
+# resync_required {reason} and refetches over REST instead. A client often
+# reconnects before the server has noticed its old socket is gone; resuming
+# then takes the session over and disconnects the old socket.
+#
+# Sessions live in the process that held the socket, so with several
+# workers a resume only succeeds on the same one (sticky sessions).
+#
+# Only an EncodeOnceManager numbers events. Under any other client manager
+# (the Kafka and ZeroMQ queues) resume is off: ready carries no session_id
+# and every resume is answered with resync_required.
+#
+# Config:
+#   RESUME_BUFFER_SIZE  events kept per session (default 500)
+#   RESUME_WINDOW       seconds a dropped session can be resumed (default 60)
+
+# Replies that only make sense to the socket that caused them, and stale
+# WebRTC signals, are neither numbered nor replayed
+UNSEQUENCED_EVENTS = ('ready', 'resumed', 'resync_required', 'error', 'rate_limited',
+                      'voice_signal', 'voice_signals')
+
+class ResyncRequired(Exception):
+    pass
+
+class ReplayBuffer:
+    __slots__ = ('session_id', 'user_id', 'sid', 'events', 'lost_through', 'rooms', 'suspended_at')
+
+    def __init__(self, session_id, user_id, sid, size):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.sid = sid
+        self.events = deque(maxlen=size)  # (seq, event, payload)
+        self.lost_through = 0  # newest seq pushed out of the buffer
+        self.rooms = ()
+        self.suspended_at = None
+
+    def append(self, entry):
+        if len(self.events) == self.events.maxlen:
+            self.lost_through = self.events[0][0]
+        self.events.append(entry)
+
+class SessionResume:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.buffer_size = 500
+        self.window = 60.0
+        self.enabled = False
+        self.seq = 0
+        self.by_sid = {}  # sid -> ReplayBuffer of a connected socket
+        self.by_id = {}  # session_id -> ReplayBuffer, connected or suspended
+        self.suspended_rooms = {}  # room -> {session_id} of suspended sessions that were in it
+        self._replaying = False
+        self.stats = {
+            'events_sequenced': 0,
+            'sessions_suspended': 0,
+            'resumes': 0,
+            'events_replayed': 0,
+            'resyncs': 0
+        }
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.buffer_size = app.config.get('RESUME_BUFFER_SIZE', 500)
+        self.window = app.config.get('RESUME_WINDOW', 60.0)
+        # The manager numbers and records every emit through this
+        manager = socketio.server.manager
+        self.enabled = isinstance(manager, EncodeOnceManager)
+        if self.enabled:
+            manager.sequencer = self
+        else:
+            app.logger.info('Session resume is off: %s does not number events', type(manager).__name__)
+
+    # Numbering, called by the client manager for every emit
+
+    def stamp(self, event, data):
+        """(seq, event, payload) for an event to number, or None."""
+        if self._replaying or event in UNSEQUENCED_EVENTS or not isinstance(data, dict):
+            return None
+        self.seq += 1
+        self.stats['events_sequenced'] += 1
+        return (self.seq, event, dict(data, seq=self.seq))
+
+    def record(self, sid, entry):
+        buffer = self.by_sid.get(sid)
+        if buffer is not None:
+            buffer.append(entry)
+
+    def record_suspended(self, room, entry):
+        # Dropped sockets have left their rooms; their sessions still get
+        # what was sent there
+        if not self.suspended_rooms:
+            return
+        if room is None:
+            session_ids = {buffer.session_id for buffer in self.by_id.values() if buffer.suspended_at}
+        elif isinstance(room, str):
+            session_ids = self.suspended_rooms.get(room, ())
+        else:
+            session_ids = set().union(*(self.suspended_rooms.get(r, ()) for r in room))
+        for session_id in session_ids:
+            self.by_id[session_id].append(entry)
+
+    # Sessions
+
+    def open(self, sid, user_id):
+        """Start numbering a new socket's events; None when resume is off."""
+        if not self.enabled:
+            return None
+        self._sweep()
+        buffer = ReplayBuffer(secrets.token_urlsafe(16), user_id, sid, self.buffer_size)
+        self.by_sid[sid] = buffer
+        self.by_id[buffer.session_id] = buffer
+        return buffer
+
+    def suspend(self, sid, rooms):
+        buffer = self.by_sid.pop(sid, None)
+        if buffer is None:
+            return
+        buffer.rooms = tuple(room for room in rooms if room != sid)
+        buffer.suspended_at = time.monotonic()
+        for room in buffer.rooms:
+            self.suspended_rooms.setdefault(room, set()).add(buffer.session_id)
+        self.stats['sessions_suspended'] += 1
+
+    def claim(self, sid, user_id, session_id, seq):
+        """The session a reconnecting client asks for, if every event after seq is still buffered."""
+        if not self.enabled:
+            raise ResyncRequired('resume is not available')
+        buffer = self.by_id.get(session_id)
+        if buffer is None or buffer.user_id != user_id or self._expired(buffer):
+            raise ResyncRequired('unknown session')
+        if buffer.sid == sid:
+            raise ResyncRequired('session is this socket')
+        if seq < buffer.lost_through or seq > self.seq:
+            if buffer.suspended_at is not None:
+                self.discard(buffer)  # no later resume can succeed either
+            raise ResyncRequired('too far behind')
+        if buffer.suspended_at is None:
+            # The old socket has not timed out yet
+            old_sid = buffer.sid
+            self.suspend(old_sid, self.socketio.server.rooms(old_sid, namespace='/'))
+            self.socketio.server.disconnect(old_sid, namespace='/')
+        return buffer
+
+    def resume(self, sid, buffer, seq):
+        """Move a claimed session onto this socket, rejoin its rooms and replay what it missed."""
+        fresh = self.by_sid.get(sid)
+        self._unsuspend(buffer)
+        if fresh is not None:
+            # Anything sent to the new socket before it resumed stays in order
+            del self.by_id[fresh.session_id]
+            merged = sorted(list(buffer.events) + list(fresh.events), key=lambda entry: entry[0])
+            if len(merged) > self.buffer_size:
+                buffer.lost_through = max(buffer.lost_through, merged[-self.buffer_size - 1][0])
+            buffer.events = deque(merged[-self.buffer_size:], maxlen=self.buffer_size)
+        buffer.sid = sid
+        self.by_sid[sid] = buffer
+
+        server = self.socketio.server
+        for room in buffer.rooms:
+            server.enter_room(sid, room, namespace='/')
+        buffer.rooms = ()
+
+        # Replayed payloads keep the seq they were first sent with, and go
+        # to this process's socket directly, never through a message queue
+        missed = [entry for entry in buffer.events if entry[0] > seq]
+        self._replaying = True
+        try:
+            for _, event, payload in missed:
+                EncodeOnceManager.emit(server.manager, event, payload, '/', room=sid)
+        finally:
+            self._replaying = False
+        self.stats['resumes'] += 1
+        self.stats['events_replayed'] += len(missed)
+        return len(missed)
+
+    def discard(self, buffer):
+        self._unsuspend(buffer)
+        self.by_id.pop(buffer.session_id, None)
+
+    def _unsuspend(self, buffer):
+        for room in buffer.rooms:
+            session_ids = self.suspended_rooms.get(room)
+            if session_ids is not None:
+                session_ids.discard(buffer.session_id)
+                if not session_ids:
+                    del self.suspended_rooms[room]
+        buffer.suspended_at = None
+
+    def _expired(self, buffer, now=None):
+        return buffer.suspended_at is not None and \
+            (now or time.monotonic()) - buffer.suspended_at >= self.window
+
+    def _sweep(self):
+        now = time.monotonic()
+        for buffer in [buffer for buffer in self.by_id.values() if self._expired(buffer, now)]:
+            self.discard(buffer)
+
+session_resume = SessionResume()
@@ -0,0 +1,60 @@
+import time
+from sqlalchemy import event
+from models import User
+
+# Authenticated socket state, keyed by request.sid. The JWT is decoded once
+# in the connect handler; every later event reads the record from here.
+
+class SocketSession:
+    __slots__ = ('sid', 'user_id', 'username', 'avatar_url', 'expires_at')
+
+    def __init__(self, sid, user, expires_at):
+        self.sid = sid
+        self.user_id = user.id
+        self.username = user.username
+        self.avatar_url = user.avatar_url
+        self.expires_at = expires_at
+
+    # Lets a session stand in for a User when serializing an author
+    @property
+    def id(self):
+        return self.user_id
+
+    def expired(self, now=None):
+        return (now or time.time()) >= self.expires_at
+
+sessions = {}
+sids_by_user = {}
+
+def open_session(sid, user, expires_at):
+    session = SocketSession(sid, user, expires_at)
+    sessions[sid] = session
+    sids_by_user.setdefault(user.id, set()).add(sid)
+    return session
+
+def get_session(sid):
+    return sessions.get(sid)
+
+def close_session(sid):
+    session = sessions.pop(sid, None)
+    if session is None:
+        return None
+    sids = sids_by_user.get(session.user_id)
+    if sids is not None:
+        sids.discard(sid)
+        if not sids:
+            del sids_by_user[session.user_id]
+    return session
+
+def user_sids(user_id):
+    return set(sids_by_user.get(user_id, ()))
+
+def refresh_user(user):
+    for sid in sids_by_user.get(user.id, ()):
+        session = sessions[sid]
+        session.username = user.username
+        session.avatar_url = user.avatar_url
+
+@event.listens_for(User, 'after_update')
+def _refresh_sessions_on_profile_change(mapper, connection, target):
+    refresh_user(target)
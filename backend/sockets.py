@@ -1,17 +1,45 @@
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect, rooms
 from flask import request
 import jwt
-from models import db, User, Message, Channel, Server
-from datetime import datetime
+from models import db, User, Channel
+from serializers import serialize_author
+from message_pipeline import pipeline
+from socket_sessions import open_session, get_session, close_session, user_sids
+from membership import is_member, get_channel_info, can_access_channel
+from presence import presence, SELECTABLE_STATUSES
+from typing_indicators import typing_tracker
+from message_cache import message_cache
+from member_lists import member_lists, ORDERS
+from wire import use_binary
+from threads import get_parent
+from uploads import blob_store
+from read_state import read_states
+from voice_state import voice_rosters
+from session_resume import session_resume, ResyncRequired
 
 socketio = SocketIO()
 
+# Rooms a resumed session rejoins. Member-list and voice subscriptions hold
+# state of their own, so clients set those up again after resuming.
+RESUMABLE_ROOMS = ('server_', 'channel_', 'thread_')
+
 def get_user_from_token(token):
     try:
         payload = jwt.decode(token, 'your-secret-key', algorithms=['HS256'])
-        return User.query.get(payload['user_id'])
+        return User.query.get(payload['user_id']), payload['exp']
     except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        return None, None
+
+def current_session():
+    # The session record replaces the per-event token check. An expired
+    # token ends the connection the same way a bad token would at connect.
+    session = get_session(request.sid)
+    if session is None:
+        return None
+    if session.expired():
+        disconnect()
         return None
+    return session
 
 @socketio.on('connect')
 def handle_connect():
@@ -19,215 +47,363 @@ def handle_connect():
     if not token:
         return False
     
-    user = get_user_from_token(token)
+    user, expires_at = get_user_from_token(token)
     if not user:
         return False
     
-    user.status = 'online'
-    db.session.commit()
+    open_session(request.sid, user, expires_at)
+    
+    # Opt-in MessagePack: every event argument arrives as one binary attachment
+    use_binary(request.sid, request.args.get('encoding') == 'msgpack')
+    
+    # Status changes are batched into presence_update by the presence engine
+    presence.connect(user.id, stored_status=user.status)
     
-    # Broadcast user's online status to relevant servers
-    for server in user.servers:
-        emit('user_status_change', {
-            'user_id': user.id,
-            'status': 'online'
-        }, room=f'server_{server.id}')
+    # Events are numbered from here on; the session id and the last seq
+    # seen let a reconnecting client resume instead of refetching. Without
+    # a session id the client knows not to try.
+    replay = session_resume.open(request.sid, user.id)
+    if replay is not None:
+        emit('ready', {'session_id': replay.session_id, 'seq': session_resume.seq})
+    else:
+        emit('ready', {'session_id': None, 'seq': None})
     
     return True
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    token = request.args.get('token')
-    if token:
-        user = get_user_from_token(token)
-        if user:
-            user.status = 'offline'
-            db.session.commit()
-            
-            # Broadcast user's offline status
-            for server in user.servers:
-                emit('user_status_change', {
-                    'user_id': user.id,
-                    'status': 'offline'
-                }, room=f'server_{server.id}')
+    session_resume.suspend(request.sid, [room for room in rooms() if room.startswith(RESUMABLE_ROOMS)])
+    member_lists.unsubscribe(request.sid)
+    voice_rosters.leave(request.sid)
+    use_binary(request.sid, False)
+    session = close_session(request.sid)
+    if session:
+        presence.disconnect(session.user_id)
+
+def can_rejoin(user_id, room):
+    kind, _, key = room.partition('_')
+    if not key.isdigit():
+        return False
+    if kind == 'server':
+        return is_member(user_id, int(key))
+    if kind == 'channel':
+        return can_access_channel(user_id, int(key))
+    if kind == 'thread':
+        parent = get_parent(int(key))
+        return parent is not None and can_access_channel(user_id, parent.channel_id)
+    return False
+
+def leave_server_rooms(user_id, server_id):
+    """Take a user's sockets out of the rooms of a server they have left.
+
+    Covers the server's room and its channel and thread rooms, and the
+    member-list ranges they were viewing. Only reaches sockets connected
+    to this process.
+    """
+    channel_ids = {channel_id for (channel_id,) in db.session.query(Channel.id).filter_by(server_id=server_id)}
+
+    def in_server(room):
+        kind, _, key = room.partition('_')
+        if not key.isdigit():
+            return False
+        if kind == 'server':
+            return int(key) == server_id
+        if kind == 'channel':
+            return int(key) in channel_ids
+        if kind == 'thread':
+            parent = get_parent(int(key))
+            return parent is not None and parent.channel_id in channel_ids
+        return False
+
+    server = socketio.server
+    for sid in user_sids(user_id):
+        for room in server.rooms(sid, namespace='/'):
+            if in_server(room):
+                server.leave_room(sid, room, namespace='/')
+        member_lists.leave_server(sid, server_id)
+
+@socketio.on('resume')
+def handle_resume(data):
+    session_id = data.get('session_id')
+    seq = data.get('seq')
+    
+    if not isinstance(session_id, str) or not isinstance(seq, int):
+        return
+    
+    session = current_session()
+    if not session:
+        return
+    
+    # The old session's rooms are only rejoined if they are all still
+    # allowed; otherwise the client starts over
+    try:
+        replay = session_resume.claim(request.sid, session.user_id, session_id, seq)
+        if not all(can_rejoin(session.user_id, room) for room in replay.rooms):
+            session_resume.discard(replay)
+            raise ResyncRequired('membership changed')
+    except ResyncRequired as e:
+        session_resume.stats['resyncs'] += 1
+        emit('resync_required', {'reason': str(e)}, room=request.sid)
+        return
+    
+    replayed = session_resume.resume(request.sid, replay, seq)
+    emit('resumed', {'session_id': replay.session_id, 'replayed': replayed}, room=request.sid)
+
+@socketio.on('set_status')
+def handle_set_status(data):
+    status = data.get('status')
+    
+    session = current_session()
+    if not session:
+        return
+    
+    if status not in SELECTABLE_STATUSES:
+        emit('error', {'message': 'Invalid status'}, room=request.sid)
+        return
+    
+    presence.set_status(session.user_id, status)
 
 @socketio.on('join_server')
 def handle_join_server(data):
-    token = data.get('token')
     server_id = data.get('server_id')
     
-    if not token or not server_id:
+    if not server_id:
         return
     
-    user = get_user_from_token(token)
-    if not user:
+    session = current_session()
+    if not session:
         return
     
-    server = Server.query.get(server_id)
-    if not server or user not in server.members:
+    if not is_member(session.user_id, server_id):
         return
     
     join_room(f'server_{server_id}')
     
     # Join all channel rooms in the server
-    for channel in server.channels:
-        join_room(f'channel_{channel.id}')
+    for (channel_id,) in db.session.query(Channel.id).filter_by(server_id=server_id):
+        join_room(f'channel_{channel_id}')
 
 @socketio.on('join_channel')
 def handle_join_channel(data):
-    token = data.get('token')
     channel_id = data.get('channel_id')
     
-    if not token or not channel_id:
-        return
-    
-    user = get_user_from_token(token)
-    if not user:
+    if not channel_id:
         return
     
-    channel = Channel.query.get(channel_id)
-    if not channel:
+    session = current_session()
+    if not session:
         return
     
-    server = Server.query.get(channel.server_id)
-    if not server or user not in server.members:
+    channel = get_channel_info(channel_id)
+    if not channel or not is_member(session.user_id, channel.server_id):
         return
     
     join_room(f'channel_{channel_id}')
     
-    # For voice channels, broadcast user joined
+    # Joining a voice channel sends this socket voice_roster and the room
+    # voice_user_joined
     if channel.type == 'voice':
-        emit('voice_user_joined', {
-            'channel_id': channel_id,
-            'user': {
-                'id': user.id,
-                'username': user.username,
-                'avatar_url': user.avatar_url
-            }
-        }, room=f'channel_{channel_id}')
+        voice_rosters.join(channel, session, request.sid)
 
 @socketio.on('leave_channel')
 def handle_leave_channel(data):
-    token = data.get('token')
     channel_id = data.get('channel_id')
     
-    if not token or not channel_id:
+    if not channel_id:
         return
     
-    user = get_user_from_token(token)
-    if not user:
+    session = current_session()
+    if not session:
         return
     
-    channel = Channel.query.get(channel_id)
+    channel = get_channel_info(channel_id)
     if not channel:
         return
     
     leave_room(f'channel_{channel_id}')
     
-    # For voice channels, broadcast user left
+    # Leaving a voice channel broadcasts voice_user_left
     if channel.type == 'voice':
-        emit('voice_user_left', {
-            'channel_id': channel_id,
-            'user_id': user.id
-        }, room=f'channel_{channel_id}')
+        voice_rosters.leave(request.sid, channel_id)
 
 @socketio.on('message')
 def handle_message(data):
-    token = data.get('token')
     channel_id = data.get('channel_id')
     content = data.get('content')
+    parent_id = data.get('parent_id')
+    upload_ids = data.get('attachments') or []
     
-    if not all([token, channel_id, content]):
+    if not channel_id or not (content or upload_ids) or not isinstance(upload_ids, list):
         return
     
-    user = get_user_from_token(token)
-    if not user:
+    session = current_session()
+    if not session:
         return
     
-    channel = Channel.query.get(channel_id)
+    channel = get_channel_info(channel_id)
     if not channel or channel.type != 'text':
         return
     
-    server = Server.query.get(channel.server_id)
-    if not server or user not in server.members:
+    if not is_member(session.user_id, channel.server_id):
         return
     
-    # Create and save the message
+    # A reply must hang off a top-level message of the same channel
+    if parent_id is not None:
+        parent = get_parent(parent_id)
+        if not parent or parent.channel_id != channel_id:
+            emit('error', {'message': 'Thread not found'}, room=request.sid)
+            return
+    
     try:
-        new_message = Message(
-            content=content,
-            channel_id=channel_id,
-            user_id=user.id
-        )
-        db.session.add(new_message)
-        db.session.commit()
-        
-        # Broadcast the message to the channel
-        emit('new_message', {
-            'message': {
-                'id': new_message.id,
-                'content': new_message.content,
-                'created_at': new_message.created_at.isoformat(),
-                'channel_id': channel_id,
-                'author': {
-                    'id': user.id,
-                    'username': user.username,
-                    'avatar_url': user.avatar_url
-                }
-            }
-        }, room=f'channel_{channel_id}')
-        
-    except Exception as e:
-        db.session.rollback()
+        attachments = blob_store.claim(session.user_id, upload_ids)
+    except ValueError as e:
         emit('error', {'message': str(e)}, room=request.sid)
+        return
+    
+    # Queue the message; the pipeline broadcasts new_message (or
+    # thread_message for a reply) once the batch it lands in is committed,
+    # or reports an error back to this sid
+    pipeline.submit(channel_id, session.user_id, content or '',
+                    serialize_author(session), sid=request.sid, parent_id=parent_id,
+                    attachments=attachments)
+
+@socketio.on('ack')
+def handle_ack(data):
+    channel_id = data.get('channel_id')
+    message_id = data.get('message_id')
+    
+    if not channel_id or not isinstance(message_id, int):
+        return
+    
+    session = current_session()
+    if not session:
+        return
+    
+    channel = get_channel_info(channel_id)
+    if not channel or not is_member(session.user_id, channel.server_id):
+        return
+    
+    # Coalesced in memory and written in the next read-state flush
+    read_states.ack(session.user_id, channel_id, message_id)
+
+@socketio.on('subscribe_thread')
+def handle_subscribe_thread(data):
+    message_id = data.get('message_id')
+    
+    if not message_id:
+        return
+    
+    session = current_session()
+    if not session:
+        return
+    
+    parent = get_parent(message_id)
+    if not parent:
+        return
+    
+    channel = get_channel_info(parent.channel_id)
+    if not channel or not is_member(session.user_id, channel.server_id):
+        return
+    
+    # thread_message for this thread reaches only the sockets in this room
+    join_room(f'thread_{message_id}')
+
+@socketio.on('unsubscribe_thread')
+def handle_unsubscribe_thread(data):
+    message_id = data.get('message_id')
+    
+    if not message_id:
+        return
+    
+    leave_room(f'thread_{message_id}')
 
 @socketio.on('typing')
 def handle_typing(data):
-    token = data.get('token')
     channel_id = data.get('channel_id')
     
-    if not token or not channel_id:
+    if not channel_id:
         return
     
-    user = get_user_from_token(token)
-    if not user:
+    session = current_session()
+    if not session:
         return
     
-    channel = Channel.query.get(channel_id)
-    if not channel or channel.type != 'text':
+    channel = get_channel_info(channel_id)
+    if not channel or channel.type != 'text' or not is_member(session.user_id, channel.server_id):
+        return
+    
+    # Typing state is aggregated and sent as periodic typing_update snapshots
+    typing_tracker.typing(channel_id, session.user_id, session.username)
+
+@socketio.on('subscribe_members')
+def handle_subscribe_members(data):
+    server_id = data.get('server_id')
+    order = data.get('order', 'status')
+    offsets = data.get('offsets', [0])
+    
+    if not server_id or order not in ORDERS or not isinstance(offsets, list):
+        return
+    
+    session = current_session()
+    if not session or not is_member(session.user_id, server_id):
         return
     
-    # Broadcast typing status to channel
-    emit('user_typing', {
-        'channel_id': channel_id,
-        'user': {
-            'id': user.id,
-            'username': user.username
-        }
-    }, room=f'channel_{channel_id}')
+    # Replaces whatever ranges this socket was viewing before
+    offsets = [offset for offset in offsets if isinstance(offset, int)]
+    for payload in member_lists.subscribe(request.sid, server_id, order, offsets):
+        emit('member_list_update', payload)
+
+@socketio.on('unsubscribe_members')
+def handle_unsubscribe_members(data=None):
+    member_lists.unsubscribe(request.sid)
+
+@presence.on_change
+def refresh_member_lists(server_id, user_ids):
+    member_lists.refresh(server_id, user_ids)
+
+@pipeline.on_commit
+def clear_typing(message):
+    # Sending a message ends the author's typing indicator
+    typing_tracker.stop(message['channel_id'], message['author']['id'])
+
+@pipeline.on_commit
+def mark_read_by_author(message):
+    # Nobody has unread messages of their own
+    if message['parent_id'] is None:
+        read_states.ack(message['author']['id'], message['channel_id'], message['id'])
+
+@pipeline.on_commit
+def cache_message(message):
+    message_cache.append(message)
 
 # Voice chat signaling
 @socketio.on('voice_signal')
 def handle_voice_signal(data):
-    token = data.get('token')
     channel_id = data.get('channel_id')
     signal_data = data.get('signal')
     target_user_id = data.get('target_user_id')
     
-    if not all([token, channel_id, signal_data, target_user_id]):
+    if not all([channel_id, signal_data, target_user_id]):
         return
     
-    user = get_user_from_token(token)
-    if not user:
+    session = current_session()
+    if not session:
+        return
+    
+    # Both ends must be in the channel's voice roster, which was checked
+    # against membership when they joined
+    voice_rosters.signal(request.sid, channel_id, target_user_id, signal_data)
+
+@socketio.on('voice_state')
+def handle_voice_state(data):
+    muted = data.get('muted')
+    deafened = data.get('deafened')
+    
+    if not isinstance(muted, (bool, type(None))) or not isinstance(deafened, (bool, type(None))):
         return
     
-    channel = Channel.query.get(channel_id)
-    if not channel or channel.type != 'voice':
+    session = current_session()
+    if not session:
         return
     
-    # Forward the WebRTC signal to the target user
-    emit('voice_signal', {
-        'channel_id': channel_id,
-        'from_user_id': user.id,
-        'signal': signal_data
-    }, room=f'user_{target_user_id}')
+    voice_rosters.set_state(request.sid, muted=muted, deafened=deafened)
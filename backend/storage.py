@@ -0,0 +1,90 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.schema import CreateTable
+
+# Applies the SQLITE_PRAGMAS from config to every connection the engine
+# opens. journal_mode=WAL is stored in the database file, the rest are
+# per-connection and have to be set each time.
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+    finally:
+        cursor.close()
+
+def install_pragmas(engine, pragmas):
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
+
+def init_storage(app, db):
+    with app.app_context():
+        install_pragmas(db.engine, app.config.get('SQLITE_PRAGMAS', {}))
+
+# Columns added to existing tables after their first release. create_all()
+# only creates missing tables, so older databases get these here.
+ADDED_COLUMNS = {
+    'servers': {'structure_version': 'INTEGER NOT NULL DEFAULT 1'},
+    'messages': {'reply_count': 'INTEGER NOT NULL DEFAULT 0',
+                 'last_reply_at': 'DATETIME'},
+    'attachments': {'content_hash': 'VARCHAR(64)',
+                    'size': 'INTEGER',
+                    'content_type': 'VARCHAR(100)'}
+}
+
+# Tables whose ids must never be handed out again, with the tables that
+# hold ids they gave out before. Archived messages leave messages but keep
+# their ids in archive_entries and the search index (see archive.py). Older
+# databases created these without AUTOINCREMENT, which SQLite can only add
+# by rebuilding the table.
+AUTOINCREMENT_TABLES = {'messages': ('archive_entries',)}
+
+def _rebuild_with_autoincrement(connection, table, id_holders):
+    ddl = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+    ).scalar()
+    if ddl is None or 'AUTOINCREMENT' in ddl.upper():
+        return False
+    rebuilt = f'{table.name}_rebuild'
+    create = str(CreateTable(table).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(create.replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {rebuilt} ', 1))
+    columns = ', '.join(column.name for column in table.columns)
+    connection.exec_driver_sql(f'INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table.name}')
+    # Takes the table's indexes and triggers with it; the indexes are made
+    # again below, the search triggers by install_search_index()
+    connection.exec_driver_sql(f'DROP TABLE {table.name}')
+    connection.exec_driver_sql(f'ALTER TABLE {rebuilt} RENAME TO {table.name}')
+    highest = max(connection.exec_driver_sql(f'SELECT coalesce(max(id), 0) FROM {name}').scalar()
+                  for name in (table.name,) + id_holders)
+    connection.exec_driver_sql('DELETE FROM sqlite_sequence WHERE name = ?', (table.name,))
+    connection.exec_driver_sql('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table.name, highest))
+    return True
+
+def upgrade_schema(engine, metadata):
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {column['name'] for column in inspector.get_columns(table)}
+            for name, definition in columns.items():
+                if name not in existing:
+                    connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+        if engine.dialect.name == 'sqlite':
+            for name, id_holders in AUTOINCREMENT_TABLES.items():
+                _rebuild_with_autoincrement(connection, metadata.tables[name], id_holders)
+        # Likewise for indexes added to tables that already existed
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+def describe_storage(engine):
+    # Current values as SQLite reports them, for logs and benchmarks
+    with engine.connect() as connection:
+        return {
+            name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+            for name in ('journal_mode', 'synchronous', 'busy_timeout',
+                         'mmap_size', 'cache_size')
+        }
@@ -0,0 +1,145 @@
+import os
+import sys
+
+# app.py reads its config at import, so the environment is set first
+os.environ['COMMI8_ENV'] = 'testing'
+os.environ.pop('COMMI8_SETTINGS', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from app import app as flask_app
+from models import db
+from sockets import socketio
+from uploads import blob_store
+from archive import archive
+from message_cache import message_cache
+from presence import presence
+from typing_indicators import typing_tracker
+from session_resume import session_resume
+from flow_control import rate_limiter
+from read_state import read_states
+from voice_state import voice_rosters
+import membership
+import search
+import server_tree
+
+class Api:
+    """Thin helpers over the REST API, for setting up test state."""
+
+    def __init__(self, client):
+        self.client = client
+        self.user_ids = {}  # username -> id of the users registered here
+
+    @staticmethod
+    def headers(token):
+        return {'Authorization': f'Bearer {token}'}
+
+    def register(self, username):
+        response = self.client.post('/api/auth/register', json={
+            'username': username,
+            'email': f'{username}@example.com',
+            'password': 'password'
+        })
+        assert response.status_code == 201, response.json
+        self.user_ids[username] = response.json['user']['id']
+        return response.json['token']
+
+    def create_server(self, token, name='server'):
+        response = self.client.post('/api/servers/', json={'name': name}, headers=self.headers(token))
+        assert response.status_code == 201, response.json
+        return response.json['server']
+
+    def invite(self, token, server_id, username):
+        response = self.client.post(f'/api/servers/{server_id}/invite', json={'username': username},
+                                    headers=self.headers(token))
+        assert response.status_code == 200, response.json
+
+    def send(self, token, channel_id, content):
+        response = self.client.post(f'/api/channels/{channel_id}/messages', json={'content': content},
+                                    headers=self.headers(token))
+        assert response.status_code == 201, response.json
+        return response.json['message']
+
+    def history(self, token, channel_id, **params):
+        return self.client.get(f'/api/channels/{channel_id}', query_string=params,
+                               headers=self.headers(token))
+
+def _reset(tmp_path):
+    # Everything lives in one in-memory database and module-level state, so
+    # each test starts from empty tables and empty caches
+    with flask_app.app_context():
+        with db.engine.begin() as connection:
+            for table in reversed(db.metadata.sorted_tables):
+                connection.execute(table.delete())
+            # Archived messages are indexed without a row in messages
+            if search.enabled:
+                connection.exec_driver_sql(
+                    f"INSERT INTO {search.FTS_TABLE}({search.FTS_TABLE}) VALUES ('delete-all')")
+        db.session.remove()
+    membership.clear()
+    server_tree.clear()
+    message_cache.clear()
+    presence.connections.clear()
+    presence.disconnected_at.clear()
+    presence.chosen.clear()
+    presence.published.clear()
+    presence.dirty.clear()
+    typing_tracker.channels.clear()
+    typing_tracker.changed.clear()
+    rate_limiter.socket_buckets.clear()
+    rate_limiter.user_buckets.clear()
+    rate_limiter.notified.clear()
+    read_states.pending.clear()
+    session_resume.by_sid.clear()
+    session_resume.by_id.clear()
+    session_resume.suspended_rooms.clear()
+    for state in (voice_rosters.channels, voice_rosters.channel_servers, voice_rosters.by_sid,
+                  voice_rosters.by_user, voice_rosters.pending):
+        state.clear()
+
+    blob_store.root = str(tmp_path / 'uploads')
+    os.makedirs(os.path.join(blob_store.root, 'blobs'))
+    os.makedirs(os.path.join(blob_store.root, 'partial'))
+    archive.root = str(tmp_path / 'archive')
+    archive._indexes.clear()
+    archive._maps.clear()
+    archive._blocks.clear()
+
+@pytest.fixture
+def app(tmp_path):
+    _reset(tmp_path)
+    yield flask_app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def api(client):
+    return Api(client)
+
+@pytest.fixture
+def connect(app):
+    """Open Socket.IO test clients; all of them are disconnected afterwards."""
+    clients = []
+
+    def connect(token, **query):
+        query_string = '&'.join(f'{key}={value}' for key, value in dict(query, token=token).items())
+        socket = socketio.test_client(app, query_string=query_string)
+        clients.append(socket)
+        return socket
+
+    yield connect
+    for socket in clients:
+        if socket.is_connected():
+            socket.disconnect()
+
+def received(socket, name=None):
+    """(event, first argument) pairs a test client got since the last call."""
+    events = [(packet['name'], packet['args'][0] if packet['args'] else None)
+              for packet in socket.get_received()]
+    return [event for event in events if name is None or event[0] == name]
+
+@pytest.fixture
+def events():
+    return received
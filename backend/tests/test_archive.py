@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.schema import CreateTable
+from archive import archive, MessageArchive
+from models import db, Message
+from sockets import socketio
+from storage import upgrade_schema
+import search
+
+@pytest.fixture
+def archived(app, api):
+    # Three old messages moved to the archive, one newer one left in the table
+    token = api.register('alice')
+    server = api.create_server(token)
+    channel_id = server['channels'][0]['id']
+    old = [api.send(token, channel_id, f'ancient walrus {i}') for i in range(3)]
+    new = api.send(token, channel_id, 'recent walrus')
+    with app.app_context():
+        long_ago = datetime.utcnow() - timedelta(days=30)
+        for i, message in enumerate(old):
+            db.session.get(Message, message['id']).created_at = long_ago + timedelta(seconds=i)
+        db.session.commit()
+        assert archive.run(after_days=7) == 3
+        assert db.session.query(Message.id).count() == 1
+    return token, server['id'], channel_id, old, new
+
+def _search(api, token, server_id, q, **params):
+    response = api.client.get('/api/search', query_string=dict(params, q=q, server_id=server_id),
+                              headers=api.headers(token))
+    assert response.status_code == 200, response.json
+    return response.json['results']
+
+def test_search_finds_archived_messages(api, archived):
+    token, server_id, _, old, new = archived
+    results = _search(api, token, server_id, 'walrus', sort='recent')
+    assert [r['id'] for r in results] == [new['id']] + [m['id'] for m in reversed(old)]
+    assert results[-1]['content'] == 'ancient walrus 0'
+    assert results[-1]['snippet'] == 'ancient [walrus] 0'
+    assert results[-1]['author']['username'] == 'alice'
+
+    assert [r['id'] for r in _search(api, token, server_id, 'ancient', author_id=999)] == []
+    before = (datetime.utcnow() - timedelta(days=7)).isoformat()
+    assert len(_search(api, token, server_id, 'walrus', before=before)) == 3
+
+def test_archived_message_can_start_a_thread(app, api, archived):
+    token, server_id, channel_id, old, new = archived
+    parent_id = old[1]['id']
+    response = api.client.get(f'/api/threads/{parent_id}', headers=api.headers(token))
+    assert response.status_code == 200
+    assert response.json['thread']['parent']['content'] == 'ancient walrus 1'
+
+    response = api.client.post(f'/api/threads/{parent_id}/messages', json={'content': 'reply'},
+                               headers=api.headers(token))
+    assert response.status_code == 201, response.json
+
+    # Back in the table with its count, and listed once in history
+    history = api.history(token, channel_id, cursor='true', limit=10).json['channel']
+    assert [m['id'] for m in history['messages']].count(parent_id) == 1
+    parent, = [m for m in history['messages'] if m['id'] == parent_id]
+    assert parent['reply_count'] == 1
+    assert history['pagination']['total'] == 4
+    history = api.history(token, channel_id, before=new['id'], limit=10).json['channel']
+    assert [m['id'] for m in history['messages']] == [m['id'] for m in reversed(old)]
+
+    # and still found by search, once
+    results = _search(api, token, server_id, 'ancient')
+    assert sorted(r['id'] for r in results) == sorted(m['id'] for m in old)
+
+def test_rebuilt_index_keeps_archived_messages(app, api, archived):
+    token, server_id, _, old, _ = archived
+    with app.app_context():
+        search.rebuild_search_index(db.engine)
+        assert _search(api, token, server_id, 'ancient') == []
+        assert archive.reindex() == 3
+    assert len(_search(api, token, server_id, 'ancient')) == 3
+
+def test_new_messages_never_take_an_archived_id(app, api):
+    token = api.register('alice')
+    server = api.create_server(token)
+    channel_id = server['channels'][0]['id']
+    old = [api.send(token, channel_id, f'old {i}') for i in range(3)]
+    with app.app_context():
+        long_ago = datetime.utcnow() - timedelta(days=30)
+        for message in old:
+            db.session.get(Message, message['id']).created_at = long_ago
+        db.session.commit()
+        # Every message of the table, the newest ids included
+        assert archive.run(after_days=7) == 3
+
+    new = api.send(token, channel_id, 'new one')
+    assert new['id'] > old[-1]['id']
+    history = api.history(token, channel_id, cursor='true', limit=10).json['channel']
+    assert [m['content'] for m in history['messages']] == ['new one', 'old 2', 'old 1', 'old 0']
+    assert [r['content'] for r in _search(api, token, server['id'], 'old')] == ['old 0', 'old 1', 'old 2']
+
+def test_upgrade_stops_older_databases_reusing_ids():
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+    messages = db.metadata.tables['messages']
+    with engine.begin() as connection:
+        # messages as it was created before ids had to stay unique
+        connection.exec_driver_sql('DROP TABLE messages')
+        create = str(CreateTable(messages).compile(dialect=engine.dialect))
+        connection.exec_driver_sql(create.replace('AUTOINCREMENT', ''))
+        connection.exec_driver_sql("INSERT INTO messages (id, content, user_id, channel_id) VALUES (5, 'kept', 1, 1)")
+        connection.exec_driver_sql("INSERT INTO archive_entries (id, channel_id, user_id, created_at) "
+                                   "VALUES (9, 1, 1, '2020-01-01 00:00:00')")
+
+    upgrade_schema(engine, db.metadata)
+    upgrade_schema(engine, db.metadata)
+    with engine.begin() as connection:
+        assert connection.exec_driver_sql('SELECT content FROM messages').scalars().all() == ['kept']
+        connection.exec_driver_sql("INSERT INTO messages (content, user_id, channel_id) VALUES ('next', 1, 1)")
+        assert connection.exec_driver_sql("SELECT id FROM messages WHERE content = 'next'").scalar() == 10
+        indexes = connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'messages'").scalars().all()
+        assert 'ix_messages_channel_created_id' in indexes
+
+def test_archive_runs_start_with_the_app(app, monkeypatch):
+    started = []
+    monkeypatch.setattr(socketio, 'start_background_task', lambda task: started.append(task))
+    monkeypatch.setitem(app.config, 'ARCHIVE_AFTER_DAYS', 30)
+    MessageArchive().init_app(app, socketio)
+    assert len(started) == 1
+
+    monkeypatch.setitem(app.config, 'ARCHIVE_INTERVAL', None)
+    MessageArchive().init_app(app, socketio)
+    assert len(started) == 1
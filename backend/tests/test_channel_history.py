@@ -0,0 +1,77 @@
+import pytest
+from sqlalchemy import event
+from models import db, Attachment
+
+@pytest.fixture
+def channel(api):
+    token = api.register('alice')
+    server = api.create_server(token)
+    return token, server['channels'][0]['id']
+
+def test_default_is_offset_pagination(api, channel):
+    token, channel_id = channel
+    for i in range(5):
+        api.send(token, channel_id, f'message {i}')
+
+    response = api.history(token, channel_id, per_page=2)
+    assert response.status_code == 200
+    body = response.json['channel']
+    assert [m['content'] for m in body['messages']] == ['message 4', 'message 3']
+    assert body['pagination'] == {'total': 5, 'pages': 3, 'current_page': 1, 'per_page': 2}
+
+    body = api.history(token, channel_id, page=3, per_page=2).json['channel']
+    assert [m['content'] for m in body['messages']] == ['message 0']
+    assert body['pagination']['current_page'] == 3
+
+def test_cursor_pagination_is_opt_in(api, channel):
+    token, channel_id = channel
+    sent = [api.send(token, channel_id, f'message {i}') for i in range(5)]
+
+    body = api.history(token, channel_id, cursor='true', limit=2).json['channel']
+    assert [m['id'] for m in body['messages']] == [sent[4]['id'], sent[3]['id']]
+    assert body['pagination'] == {'per_page': 2, 'has_more': True, 'before': sent[3]['id'],
+                                  'after': sent[4]['id'], 'total': 5}
+
+    body = api.history(token, channel_id, before=sent[3]['id'], limit=2).json['channel']
+    assert [m['id'] for m in body['messages']] == [sent[2]['id'], sent[1]['id']]
+
+    body = api.history(token, channel_id, after=sent[1]['id'], limit=10).json['channel']
+    assert [m['id'] for m in body['messages']] == [sent[4]['id'], sent[3]['id'], sent[2]['id']]
+    assert body['pagination']['has_more'] is False
+
+def test_unknown_cursor(api, channel):
+    token, channel_id = channel
+    assert api.history(token, channel_id, before=12345).status_code == 404
+    assert api.history(token, channel_id, before=1, after=2).status_code == 400
+
+def test_page_query_count_does_not_grow_with_page_size(app, api, channel):
+    token, channel_id = channel
+    other = api.register('bob')
+    server_id = api.history(token, channel_id).json['channel']['server_id']
+    api.invite(token, server_id, 'bob')
+    sent = [api.send(token if i % 2 else other, channel_id, f'message {i}') for i in range(60)]
+    with app.app_context():
+        db.session.add_all([Attachment(filename=f'{i}.txt', file_url=f'/files/{i}.txt', message_id=message['id'])
+                            for i, message in enumerate(sent) if i % 3 == 0])
+        db.session.commit()
+        engine = db.engine
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    newest = sent[-1]['id']
+    api.history(token, channel_id, before=newest, limit=1)  # warms the membership cache
+    counts = {}
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        for limit in (1, 10, 50):
+            del statements[:]
+            body = api.history(token, channel_id, before=newest, limit=limit, count='false').json['channel']
+            assert len(body['messages']) == limit
+            counts[limit] = len(statements)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    assert counts[1] == counts[10] == counts[50], counts
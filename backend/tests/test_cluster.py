@@ -0,0 +1,143 @@
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from benchmarks.harness import start_server, connect_client
+from cluster import make_relay, read_frame, write_frame
+from wire import dumps
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+@pytest.fixture
+def relay_url():
+    url = f'local://127.0.0.1:{_free_port()}'
+    relay = make_relay(url, write_timeout=1)
+    threading.Thread(target=relay.serve_forever, daemon=True).start()
+    yield url
+    relay.shutdown()
+    relay.server_close()
+
+def _relay_connection(url, subscribe):
+    sock = socket.create_connection(('127.0.0.1', int(url.rsplit(':', 1)[1])))
+    write_frame(sock, dumps({'channel': 'test', 'subscribe': subscribe}).encode())
+    return sock
+
+def test_relay_never_writes_to_publishers(relay_url):
+    subscriber = _relay_connection(relay_url, subscribe=True)
+    publisher = _relay_connection(relay_url, subscribe=False)
+    time.sleep(0.1)
+
+    received = []
+
+    def read():
+        while len(received) < 3000:
+            received.append(read_frame(subscriber))
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    # Far more than fits in the socket buffers of a publisher nobody reads
+    frame = b'x' * 4096
+    for _ in range(3000):
+        write_frame(publisher, frame)
+    reader.join(10)
+    assert len(received) == 3000
+
+    publisher.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        publisher.recv(1)
+
+def test_relay_drops_a_subscriber_that_stopped_reading(relay_url):
+    stuck = _relay_connection(relay_url, subscribe=True)
+    live = _relay_connection(relay_url, subscribe=True)
+    publisher = _relay_connection(relay_url, subscribe=False)
+    time.sleep(0.1)
+
+    received = []
+
+    def read():
+        while len(received) < 3000:
+            received.append(read_frame(live))
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    for _ in range(3000):
+        write_frame(publisher, b'x' * 4096)
+    reader.join(15)
+    assert len(received) == 3000
+    stuck.close()
+
+@pytest.fixture
+def workers(relay_url, tmp_path):
+    settings = tmp_path / 'settings.py'
+    settings.write_text('BCRYPT_ROUNDS = 4\n')
+    environ = {'SOCKETIO_MESSAGE_QUEUE': relay_url}
+    processes = []
+    urls = []
+    try:
+        # One after the other, so only the first creates the tables
+        for index in range(2):
+            log = open(tmp_path / f'worker{index}.log', 'w')
+            process, url = start_server(tmp_path / 'cluster.db', _free_port(), log, settings=str(settings),
+                                        profile='cluster', environ=environ)
+            processes.append(process)
+            urls.append(url)
+        yield urls
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(10)
+
+def _register(base_url, username):
+    response = requests.post(f'{base_url}/api/auth/register', json={
+        'username': username, 'email': f'{username}@example.com', 'password': 'password'})
+    assert response.status_code == 201, response.text
+    return response.json()['token']
+
+def test_messages_reach_sockets_on_another_worker(workers):
+    first, second = workers
+    alice = _register(first, 'alice')
+    bob = _register(second, 'bob')
+    headers = {'Authorization': f'Bearer {alice}'}
+    server = requests.post(f'{first}/api/servers/', json={'name': 'cluster'}, headers=headers).json()['server']
+    channel_id = server['channels'][0]['id']
+    requests.post(f'{first}/api/servers/{server["id"]}/invite', json={'username': 'bob'}, headers=headers)
+
+    received = []
+    done = threading.Event()
+    senders, per_sender = 8, 50  # about 6.5 MB through the relay, past where a stuck buffer would fill
+
+    def on_message(data):
+        received.append(data['message']['content'])
+        if len(received) == senders * per_sender:
+            done.set()
+
+    def send(sender):
+        session = requests.Session()
+        padding = 'x' * 16384
+        for i in range(per_sender):
+            response = session.post(f'{first}/api/channels/{channel_id}/messages',
+                                    json={'content': f'{sender} {i} {padding}'}, headers=headers)
+            assert response.status_code == 201, response.text
+
+    client = connect_client(second, bob, new_message=on_message)
+    try:
+        client.call('join_server', {'server_id': server['id']}, timeout=5)
+        threads = [threading.Thread(target=send, args=(sender,)) for sender in range(senders)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert done.wait(30), f'{len(received)} of {senders * per_sender} messages arrived'
+    finally:
+        client.disconnect()
+
+    # Each sender waited for its commit, so its messages arrive in order
+    for sender in range(senders):
+        sent = [int(content.split()[1]) for content in received if content.split()[0] == str(sender)]
+        assert sent == list(range(per_sender))
@@ -0,0 +1,119 @@
+import pytest
+import flow_control
+from flow_control import RateLimiter, OutboundGuard, rate_limiter
+from models import Message
+from sockets import socketio
+
+def _limiter(limits):
+    limiter = RateLimiter()
+    limiter.limits = limits
+    return limiter
+
+def test_bucket_allows_a_burst_then_refills():
+    limiter = _limiter({'*': {'socket': (2, 3)}})
+    assert [limiter.check('a', None, 'typing', now=100) for _ in range(3)] == [0, 0, 0]
+    assert limiter.check('a', None, 'typing', now=100) == pytest.approx(0.5)
+    assert limiter.check('a', None, 'typing', now=100.5) == 0
+    assert limiter.check('b', None, 'typing', now=100.5) == 0  # buckets are per socket
+
+def test_event_takes_from_both_buckets_or_neither():
+    limiter = _limiter({'*': {'socket': (1, 5), 'user': (1, 2)}})
+    assert limiter.check('a', 7, 'typing', now=100) == 0
+    assert limiter.check('b', 7, 'typing', now=100) == 0
+    assert limiter.check('c', 7, 'typing', now=100) == pytest.approx(1)
+    # The refused event did not charge socket c
+    assert limiter.socket_buckets[('c', '*')][0] == 5
+
+def test_unknown_events_share_the_default_bucket():
+    limiter = _limiter({'message': {'socket': (1, 1)}, '*': {'socket': (1, 2)}})
+    assert limiter.check('a', None, 'one', now=100) == 0
+    assert limiter.check('a', None, 'two', now=100) == 0
+    assert limiter.check('a', None, 'three', now=100) > 0
+    assert limiter.check('a', None, 'message', now=100) == 0
+
+@pytest.fixture
+def frozen(monkeypatch):
+    # No refill while a test sends its burst
+    monkeypatch.setattr(flow_control.time, 'monotonic', lambda: 1000.0)
+
+@pytest.fixture
+def channel(api):
+    token = api.register('alice')
+    server = api.create_server(token)
+    return token, server['id'], server['channels'][0]['id']
+
+def _join(connect, token, server_id):
+    socket = connect(token)
+    socket.emit('join_server', {'server_id': server_id})
+    socket.get_received()
+    return socket
+
+def test_socket_flood_is_dropped_and_told_once(app, connect, events, channel, frozen):
+    token, server_id, channel_id = channel
+    socket = _join(connect, token, server_id)
+    burst = rate_limiter.limits['message']['socket'][1]
+    for i in range(burst + 5):
+        socket.emit('message', {'channel_id': channel_id, 'content': f'flood {i}'})
+
+    with app.app_context():
+        assert Message.query.count() == burst
+    notices = events(socket, 'rate_limited')
+    assert [payload['event'] for _, payload in notices] == ['message']
+    assert notices[0][1]['retry_after'] > 0
+
+def test_user_bucket_is_shared_by_their_sockets(app, connect, channel, frozen):
+    token, server_id, channel_id = channel
+    socket_burst = rate_limiter.limits['message']['socket'][1]
+    user_burst = rate_limiter.limits['message']['user'][1]
+    sockets = [_join(connect, token, server_id) for _ in range(user_burst // socket_burst + 1)]
+    for socket in sockets:
+        for i in range(socket_burst):
+            socket.emit('message', {'channel_id': channel_id, 'content': f'message {i}'})
+
+    with app.app_context():
+        assert Message.query.count() == user_burst
+
+class _Queue:
+    def __init__(self, size):
+        self.size = size
+
+    def qsize(self):
+        return self.size
+
+class _Socket:
+    def __init__(self, queued):
+        self.queue = _Queue(queued)
+        self.closing = self.closed = False
+
+@pytest.fixture
+def guard(app, monkeypatch):
+    guard = OutboundGuard()
+    guard.app = app
+    guard.socketio = socketio
+    guard.queue_limit = 10
+    guard.policy = 'drop'
+    sockets = {}
+    monkeypatch.setattr(socketio.server.eio, 'sockets', sockets)
+    return guard, sockets
+
+def test_full_queue_drops_packets_and_their_attachments(guard):
+    guard, sockets = guard
+    sockets['slow'] = _Socket(queued=10)
+    assert not guard.admit('slow', '451-["new_message"]')
+    assert not guard.admit('slow', b'attachment')
+
+    sockets['slow'].queue.size = 3
+    assert guard.admit('slow', '42["new_message"]')
+    assert guard.admit('slow', b'attachment')
+    assert guard.stats['packets_dropped'] == 2
+
+def test_full_queue_evicts_under_the_disconnect_policy(guard, monkeypatch):
+    guard, sockets = guard
+    guard.policy = 'disconnect'
+    evicted = []
+    monkeypatch.setattr(guard.socketio, 'start_background_task', lambda task, sid: evicted.append(sid))
+    sockets['slow'] = _Socket(queued=10)
+    assert not guard.admit('slow', '42["new_message"]')
+    assert not guard.admit('slow', '42["new_message"]')
+    assert evicted == ['slow']
+    assert guard.stats['connections_evicted'] == 1
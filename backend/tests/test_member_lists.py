@@ -0,0 +1,45 @@
+import pytest
+from search import encode_cursor
+
+@pytest.fixture
+def server(api):
+    owner = api.register('alice')
+    server = api.create_server(owner)
+    for name in ('bob', 'carol', 'dave', 'erin'):
+        api.register(name)
+        api.invite(owner, server['id'], name)
+    return owner, server['id']
+
+def _page(api, token, server_id, **params):
+    return api.client.get(f'/api/servers/{server_id}/members', query_string=params,
+                          headers=api.headers(token))
+
+@pytest.mark.parametrize('order', ['username', 'status'])
+def test_cursor_walks_every_member_once(api, server, order):
+    token, server_id = server
+    names, cursor = [], None
+    while True:
+        params = {'order': order, 'limit': 2}
+        if cursor:
+            params['cursor'] = cursor
+        response = _page(api, token, server_id, **params)
+        assert response.status_code == 200, response.json
+        names += [member['username'] for member in response.json['members']]
+        cursor = response.json['cursor']
+        if cursor is None:
+            break
+    assert names == ['alice', 'bob', 'carol', 'dave', 'erin']
+
+@pytest.mark.parametrize('order, values', [
+    ('username', {}),
+    ('username', ['bob']),
+    ('username', [1, 2]),
+    ('username', ['bob', 'x']),
+    ('status', ['bob', 1]),
+    ('status', [0, 'bob', None]),
+])
+def test_bad_cursor_is_a_400(api, server, order, values):
+    token, server_id = server
+    response = _page(api, token, server_id, order=order, cursor=encode_cursor(values))
+    assert response.status_code == 400
+    assert response.json['error'] == 'Invalid cursor'
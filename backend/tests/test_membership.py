@@ -0,0 +1,92 @@
+import pytest
+from sqlalchemy import event
+import membership
+from models import db, server_members
+
+@pytest.fixture
+def tokens(api):
+    return api.register('alice'), api.register('bob')
+
+@pytest.fixture
+def server(api, tokens):
+    return api.create_server(tokens[0])
+
+def test_not_a_member_is_not_cached(app, api, server):
+    bob = api.user_ids['bob']
+    with app.app_context():
+        assert not membership.is_member(bob, server['id'])
+        # Added behind the cache's back, as an import or another worker would
+        db.session.execute(server_members.insert().values(user_id=bob, server_id=server['id']))
+        db.session.commit()
+        assert membership.is_member(bob, server['id'])
+
+def test_cached_answers_expire(app, api, server, monkeypatch):
+    bob = api.user_ids['bob']
+    channel_id = server['channels'][0]['id']
+    with app.app_context():
+        db.session.execute(server_members.insert().values(user_id=bob, server_id=server['id']))
+        db.session.commit()
+        assert membership.is_member(bob, server['id'])
+        assert membership.get_channel_info(channel_id).name == 'general'
+
+        db.session.execute(server_members.delete().where(server_members.c.user_id == bob))
+        db.session.execute(db.text('UPDATE channels SET name = :name WHERE id = :id'),
+                           {'name': 'renamed', 'id': channel_id})
+        db.session.commit()
+        assert membership.is_member(bob, server['id'])
+        assert membership.get_channel_info(channel_id).name == 'general'
+
+        now = membership.time.monotonic()
+        monkeypatch.setattr(membership.time, 'monotonic', lambda: now + membership.cache_ttl)
+        assert not membership.is_member(bob, server['id'])
+        assert membership.get_channel_info(channel_id).name == 'renamed'
+
+def test_invite_and_leave_invalidate(api, tokens, server):
+    owner_token, bob_token = tokens
+    channel_id = server['channels'][0]['id']
+    assert api.history(bob_token, channel_id).status_code == 403
+
+    api.invite(owner_token, server['id'], 'bob')
+    assert api.history(bob_token, channel_id).status_code == 200
+
+    response = api.client.post(f'/api/servers/{server["id"]}/leave', headers=api.headers(bob_token))
+    assert response.status_code == 200
+    assert api.history(bob_token, channel_id).status_code == 403
+
+def test_leaving_stops_the_servers_broadcasts(api, connect, events, tokens, server):
+    alice, bob = tokens
+    api.invite(alice, server['id'], 'bob')
+    channel_id = server['channels'][0]['id']
+    parent = api.send(alice, channel_id, 'thread parent')
+
+    socket = connect(bob)
+    socket.emit('join_server', {'server_id': server['id']})
+    socket.emit('subscribe_thread', {'message_id': parent['id']})
+    socket.emit('subscribe_members', {'server_id': server['id'], 'offsets': [0]})
+    events(socket)
+
+    response = api.client.post(f"/api/servers/{server['id']}/leave", headers=api.headers(bob))
+    assert response.status_code == 200
+    events(socket)
+    api.send(alice, channel_id, 'after bob left')
+    api.client.post(f"/api/threads/{parent['id']}/messages", json={'content': 'reply'},
+                    headers=api.headers(alice))
+    api.register('carol')
+    api.invite(alice, server['id'], 'carol')  # pushes member-list ranges
+    assert events(socket) == []
+
+def test_invite_does_not_load_the_member_list(app, api, tokens, server):
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        api.invite(tokens[0], server['id'], 'bob')
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert not [s for s in statements if s.startswith('SELECT') and 'FROM users, server_members' in s]
+    assert any(s.startswith('INSERT INTO server_members') for s in statements)
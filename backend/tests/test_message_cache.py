@@ -0,0 +1,117 @@
+import pytest
+import message_cache as message_cache_module
+from message_cache import message_cache
+from models import db, User
+
+@pytest.fixture
+def channel(api):
+    token = api.register('alice')
+    server = api.create_server(token)
+    return token, server['channels'][0]['id']
+
+def _newest(api, token, channel_id, limit=3):
+    body = api.history(token, channel_id, cursor='true', limit=limit).json['channel']
+    return [m['content'] for m in body['messages']], body['pagination']
+
+def test_sends_keep_a_cached_page_current(api, channel):
+    token, channel_id = channel
+    for i in range(3):
+        api.send(token, channel_id, f'message {i}')
+
+    hits = message_cache.stats['hits']
+    assert _newest(api, token, channel_id)[0] == ['message 2', 'message 1', 'message 0']
+    assert message_cache.stats['hits'] == hits  # the first read fills the window
+
+    api.send(token, channel_id, 'message 3')
+    contents, pagination = _newest(api, token, channel_id)
+    assert message_cache.stats['hits'] == hits + 1
+    assert contents == ['message 3', 'message 2', 'message 1']
+    assert pagination['total'] == 4 and pagination['has_more']
+
+def test_fill_is_skipped_when_a_message_lands_during_the_read(api, channel):
+    token, channel_id = channel
+    first = api.send(token, channel_id, 'message 0')
+    fill_token = message_cache.fill_token()  # taken before the page is read
+    api.send(token, channel_id, 'message 1')  # committed while it is being read
+
+    message_cache.fill(channel_id, fill_token, [first], has_more=False, total=1)
+    assert channel_id not in message_cache.channels
+    assert _newest(api, token, channel_id)[0] == ['message 1', 'message 0']
+
+def test_thread_replies_update_the_cached_parent(api, channel):
+    token, channel_id = channel
+    parent = api.send(token, channel_id, 'parent')
+    _newest(api, token, channel_id)
+
+    response = api.client.post(f'/api/threads/{parent["id"]}/messages', json={'content': 'reply'},
+                               headers=api.headers(token))
+    assert response.status_code == 201
+    body = api.history(token, channel_id, cursor='true').json['channel']
+    assert [(m['content'], m['reply_count']) for m in body['messages']] == [('parent', 1)]
+
+def test_renamed_author_clears_the_cache(app, api, channel):
+    token, channel_id = channel
+    api.send(token, channel_id, 'hello')
+    _newest(api, token, channel_id)
+    assert channel_id in message_cache.channels
+
+    with app.app_context():
+        user = User.query.filter_by(username='alice').one()
+        user.username = 'alicia'
+        db.session.commit()
+    assert channel_id not in message_cache.channels
+    body = api.history(token, channel_id, cursor='true').json['channel']
+    assert body['messages'][0]['author']['username'] == 'alicia'
+
+def test_deleted_channel_is_dropped(api, channel):
+    token, channel_id = channel
+    _newest(api, token, channel_id)
+    assert channel_id in message_cache.channels
+
+    response = api.client.delete(f'/api/channels/{channel_id}', headers=api.headers(token))
+    assert response.status_code == 200, response.json
+    assert channel_id not in message_cache.channels
+
+def test_invalidated_channel_forgets_its_last_append(api, channel):
+    token, channel_id = channel
+    api.send(token, channel_id, 'sent')
+    _newest(api, token, channel_id)
+    assert channel_id in message_cache._appended
+
+    message_cache.invalidate(channel_id)
+    assert channel_id not in message_cache.channels
+    assert channel_id not in message_cache._appended
+
+def test_windows_are_evicted_past_the_byte_budget(api, channel, monkeypatch):
+    token, channel_id = channel
+    server_id = api.history(token, channel_id).json['channel']['server_id']
+    other = api.client.post(f'/api/channels/{server_id}/create', json={'name': 'other', 'type': 'text'},
+                            headers=api.headers(token)).json['channel']['id']
+    api.send(token, channel_id, 'a' * 1000)
+    api.send(token, other, 'b' * 1000)
+    monkeypatch.setattr(message_cache, 'max_bytes', 2000)
+
+    evictions = message_cache.stats['evictions']
+    _newest(api, token, channel_id)
+    _newest(api, token, other)
+    assert list(message_cache.channels) == [other]
+    assert message_cache.stats['evictions'] == evictions + 1
+    assert list(message_cache._appended) == [other]
+
+def test_forgotten_channels_still_guard_fills(api, channel, monkeypatch):
+    monkeypatch.setattr(message_cache_module, 'MAX_TRACKED_CHANNELS', 1)
+    token, channel_id = channel
+    server_id = api.history(token, channel_id).json['channel']['server_id']
+    other = api.client.post(f'/api/channels/{server_id}/create', json={'name': 'other', 'type': 'text'},
+                            headers=api.headers(token)).json['channel']['id']
+    message_cache.invalidate(channel_id)  # filled by the read above
+    first = api.send(token, channel_id, 'message 0')
+    fill_token = message_cache.fill_token()
+    api.send(token, channel_id, 'message 1')
+    api.send(token, other, 'elsewhere')
+    assert len(message_cache._appended) <= 1
+
+    # The read started before message 1, so its page is not cached
+    message_cache.fill(channel_id, fill_token, [first], has_more=False, total=1)
+    assert channel_id not in message_cache.channels
+    assert _newest(api, token, channel_id)[0] == ['message 1', 'message 0']
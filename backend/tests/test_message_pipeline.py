@@ -0,0 +1,72 @@
+import pytest
+from message_pipeline import pipeline
+from models import db, Message
+from sockets import socketio
+
+@pytest.fixture
+def room(api, connect, events):
+    token = api.register('alice')
+    server = api.create_server(token)
+    socket = connect(token)
+    socket.emit('join_server', {'server_id': server['id']})
+    events(socket)
+    return token, server['channels'][0]['id'], socket
+
+@pytest.fixture
+def batched(app, monkeypatch):
+    # Queued messages are committed by flush() in the test's own context
+    # instead of by the background worker
+    monkeypatch.setattr(pipeline, 'mode', 'batched')
+    monkeypatch.setattr(pipeline, '_ensure_worker', lambda: None)
+    queue = socketio.server.eio.create_queue()
+    monkeypatch.setattr(pipeline, '_queue', queue)
+    monkeypatch.setattr(pipeline, '_empty', socketio.server.eio.get_queue_empty_exception())
+    return queue
+
+def _author(user_id):
+    return {'id': user_id, 'username': 'alice', 'avatar_url': None}
+
+def test_rest_send_is_broadcast_after_commit(app, api, room, events):
+    token, channel_id, socket = room
+    message = api.send(token, channel_id, 'hello')
+
+    broadcasts = events(socket, 'new_message')
+    assert [payload['message'] for _, payload in broadcasts] == [message]
+    with app.app_context():
+        assert db.session.get(Message, message['id']).content == 'hello'
+
+def test_queued_messages_commit_as_one_batch(app, api, room, events, batched):
+    _, channel_id, socket = room
+    user_id = api.user_ids['alice']
+    with app.app_context():
+        batches = pipeline.stats['batches']
+        for i in range(5):
+            assert pipeline.submit(channel_id, user_id, f'message {i}', _author(user_id)) is None
+        assert batched.qsize() == 5
+        assert events(socket, 'new_message') == []
+
+        pipeline.flush()
+        assert pipeline.stats['batches'] == batches + 1
+        assert Message.query.filter_by(channel_id=channel_id).count() == 5
+
+    broadcasts = [payload['message'] for _, payload in events(socket, 'new_message')]
+    assert [m['content'] for m in broadcasts] == [f'message {i}' for i in range(5)]
+    assert [m['id'] for m in broadcasts] == sorted(m['id'] for m in broadcasts)
+
+def test_bad_row_fails_alone(app, api, room, events, batched):
+    _, channel_id, socket = room
+    user_id = api.user_ids['alice']
+    sid = socketio.server.manager.sid_from_eio_sid(socket.eio_sid, '/')
+    with app.app_context():
+        failed = pipeline.stats['failed']
+        pipeline.submit(channel_id, user_id, 'before', _author(user_id))
+        pipeline.submit(channel_id, user_id, None, _author(user_id), sid=sid)  # content is NOT NULL
+        pipeline.submit(channel_id, user_id, 'after', _author(user_id))
+        pipeline.flush()
+        assert pipeline.stats['failed'] == failed + 1
+        assert [m.content for m in Message.query.order_by(Message.id)] == ['before', 'after']
+
+    received = events(socket)
+    assert [payload['message']['content'] for name, payload in received if name == 'new_message'] == \
+        ['before', 'after']
+    assert [name for name, _ in received if name == 'error'] == ['error']
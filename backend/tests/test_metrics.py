@@ -0,0 +1,23 @@
+import pytest
+from metrics import metrics
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics, 'enabled', True)
+
+def test_off_by_default(client):
+    assert client.get('/metrics').status_code == 404
+
+def test_loopback_only_without_a_token(client, enabled):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert b'commi8_http_request_duration_seconds' in response.data
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.5'}).status_code == 401
+
+def test_token_required_when_set(client, enabled, monkeypatch):
+    monkeypatch.setattr(metrics, 'token', 's3cret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'},
+                          environ_base={'REMOTE_ADDR': '203.0.113.5'})
+    assert response.status_code == 200
@@ -0,0 +1,122 @@
+import pytest
+import presence as presence_module
+from models import db, User
+from presence import PresenceEngine, presence
+
+class _Recorder:
+    """Stands in for the SocketIO object, keeping what was emitted."""
+    server = object()
+
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, room=None):
+        self.emitted.append((event, room, data))
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(presence_module.time, 'monotonic', lambda: now[0])
+    return now
+
+@pytest.fixture
+def engine(app, clock, monkeypatch):
+    engine = PresenceEngine()
+    engine.init_app(app, _Recorder())
+    monkeypatch.setattr(engine, '_ensure_worker', lambda: None)  # flushed by hand
+    return engine
+
+@pytest.fixture
+def members(api):
+    alice = api.register('alice')
+    api.register('bob')
+    server = api.create_server(alice)
+    api.invite(alice, server['id'], 'bob')
+    return server['id'], api.user_ids['alice'], api.user_ids['bob']
+
+def _stored(app, user_id):
+    with app.app_context():
+        db.session.remove()
+        return db.session.get(User, user_id).status
+
+def _flush(app, engine):
+    with app.app_context():
+        return engine.flush()
+
+def test_second_socket_closing_keeps_the_user_online(app, engine, members):
+    _, alice, _ = members
+    engine.connect(alice, stored_status='offline')
+    engine.connect(alice)
+    assert _flush(app, engine) == {alice: 'online'}
+
+    engine.disconnect(alice)
+    assert engine.current_status(alice) == 'online'
+    assert _flush(app, engine) == {}
+    assert _stored(app, alice) == 'online'
+
+def test_offline_only_after_the_grace_period(app, engine, clock, members):
+    server_id, alice, _ = members
+    engine.connect(alice, stored_status='offline')
+    _flush(app, engine)
+    engine.socketio.emitted.clear()
+
+    engine.disconnect(alice)
+    clock[0] += engine.offline_grace - 1
+    assert engine.current_status(alice) is None
+    assert _flush(app, engine) == {}
+
+    # A reconnect inside the grace period is never seen
+    engine.connect(alice)
+    assert _flush(app, engine) == {}
+    engine.disconnect(alice)
+
+    clock[0] += engine.offline_grace
+    assert _flush(app, engine) == {alice: 'offline'}
+    assert _stored(app, alice) == 'offline'
+    assert engine.socketio.emitted == [('presence_update', f'server_{server_id}', {
+        'server_id': server_id, 'updates': [{'user_id': alice, 'status': 'offline'}]})]
+    assert alice not in engine.published and alice not in engine.disconnected_at
+
+def test_changes_are_flushed_as_one_update_per_server(app, engine, members):
+    server_id, alice, bob = members
+    engine.connect(alice, stored_status='offline')
+    engine.connect(bob, stored_status='offline')
+    engine.set_status(bob, 'dnd')
+    assert engine.socketio.emitted == []
+
+    assert _flush(app, engine) == {alice: 'online', bob: 'dnd'}
+    (event, room, payload), = engine.socketio.emitted
+    assert (event, room) == ('presence_update', f'server_{server_id}')
+    assert sorted((u['user_id'], u['status']) for u in payload['updates']) == [(alice, 'online'), (bob, 'dnd')]
+    assert (_stored(app, alice), _stored(app, bob)) == ('online', 'dnd')
+
+def test_large_servers_get_no_room_broadcast(app, engine, members):
+    _, alice, _ = members
+    engine.broadcast_max_members = 1
+    changed = []
+    engine.on_change(lambda server_id, user_ids: changed.append(user_ids))
+    engine.connect(alice, stored_status='offline')
+    _flush(app, engine)
+    assert engine.socketio.emitted == []
+    assert changed == [[alice]]
+
+def test_logout_without_other_sockets_is_offline_at_once(app, engine, members):
+    _, alice, bob = members
+    engine.logout(alice, stored_status='online')
+    assert _flush(app, engine) == {alice: 'offline'}
+
+    engine.connect(bob, stored_status='offline')
+    engine.logout(bob, stored_status='online')
+    assert engine.current_status(bob) == 'online'
+
+def test_logout_route_goes_through_presence(app, api, connect):
+    closed = api.register('carol')
+    still_open = api.register('dave')
+    connect(still_open)  # another tab of dave's
+    for token in (closed, still_open):
+        assert api.client.post('/api/auth/logout', headers=api.headers(token)).status_code == 200
+
+    with app.app_context():
+        presence.flush()
+    assert _stored(app, api.user_ids['carol']) == 'offline'
+    assert _stored(app, api.user_ids['dave']) == 'online'
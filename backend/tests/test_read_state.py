@@ -0,0 +1,54 @@
+import pytest
+from read_state import read_states
+
+@pytest.fixture
+def channel(api, monkeypatch):
+    monkeypatch.setattr(read_states, 'unread_cap', 3)
+    alice = api.register('alice')
+    bob = api.register('bob')
+    server = api.create_server(alice)
+    api.invite(alice, server['id'], 'bob')
+    return alice, bob, server['channels'][0]['id']
+
+def _state(api, token, channel_id):
+    response = api.client.get('/api/read-states', headers=api.headers(token))
+    assert response.status_code == 200
+    assert response.json['unread_cap'] == 3
+    state, = [s for s in response.json['read_states'] if s['channel_id'] == channel_id]
+    return state
+
+def test_counts_up_to_the_cap_are_exact(api, channel):
+    alice, bob, channel_id = channel
+    for i in range(3):
+        api.send(alice, channel_id, f'@bob {i}')
+    state = _state(api, bob, channel_id)
+    assert (state['unread_count'], state['unread_capped']) == (3, False)
+    assert (state['mention_count'], state['mention_capped']) == (3, False)
+
+def test_counts_past_the_cap_are_flagged(api, channel):
+    alice, bob, channel_id = channel
+    for i in range(5):
+        api.send(alice, channel_id, f'@bob {i}')
+    api.send(alice, channel_id, 'no mention')
+    state = _state(api, bob, channel_id)
+    assert (state['unread_count'], state['unread_capped']) == (3, True)
+    assert (state['mention_count'], state['mention_capped']) == (3, True)
+
+def test_unflushed_ack_lowers_the_counts(api, channel):
+    alice, bob, channel_id = channel
+    messages = [api.send(alice, channel_id, f'@bob {i}') for i in range(6)]
+    read_states.ack(api.user_ids['bob'], channel_id, messages[3]['id'])
+    state = _state(api, bob, channel_id)
+    assert state['last_read_id'] == messages[3]['id']
+    assert (state['unread_count'], state['unread_capped']) == (2, False)
+    assert (state['mention_count'], state['mention_capped']) == (2, False)
+
+def test_mentions_in_thread_replies_are_not_counted(api, channel):
+    alice, bob, channel_id = channel
+    parent = api.send(alice, channel_id, 'parent')
+    read_states.ack(api.user_ids['bob'], channel_id, parent['id'])
+    response = api.client.post(f"/api/threads/{parent['id']}/messages", json={'content': '@bob in a thread'},
+                               headers=api.headers(alice))
+    assert response.status_code == 201
+    state = _state(api, bob, channel_id)
+    assert (state['unread_count'], state['mention_count']) == (0, 0)
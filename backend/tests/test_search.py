@@ -0,0 +1,85 @@
+from datetime import datetime
+import pytest
+from archive import archive
+from models import db, Message
+
+@pytest.fixture
+def channel(api):
+    token = api.register('alice')
+    server = api.create_server(token)
+    return token, server['id'], server['channels'][0]['id']
+
+def _search(api, token, server_id, q, **params):
+    return api.client.get('/api/search', query_string=dict(params, q=q, server_id=server_id),
+                          headers=api.headers(token))
+
+def test_date_offsets_are_converted_to_utc(app, api, channel):
+    token, server_id, channel_id = channel
+    message = api.send(token, channel_id, 'timed')
+    with app.app_context():
+        db.session.get(Message, message['id']).created_at = datetime(2024, 1, 1, 9, 0)
+        db.session.commit()
+
+    # 10:00+02:00 is 08:00 UTC, before the message
+    response = _search(api, token, server_id, 'timed', before='2024-01-01T10:00:00+02:00')
+    assert response.json['results'] == []
+    response = _search(api, token, server_id, 'timed', before='2024-01-01T10:00:00Z')
+    assert [r['id'] for r in response.json['results']] == [message['id']]
+    response = _search(api, token, server_id, 'timed', after='2024-01-01T10:30:00+02:00')
+    assert [r['id'] for r in response.json['results']] == [message['id']]
+
+def _ids(response):
+    assert response.status_code == 200, response.json
+    return [r['id'] for r in response.json['results']]
+
+@pytest.mark.parametrize('q', ['"unbalanced', 'walrus OR', 'NEAR(walrus', 'content:walrus', '-walrus', '*'])
+def test_query_syntax_in_input_is_taken_literally(api, channel, q):
+    token, server_id, channel_id = channel
+    api.send(token, channel_id, 'walrus')
+    assert _search(api, token, server_id, q).status_code == 200
+
+def test_terms_and_prefixes(api, channel):
+    token, server_id, channel_id = channel
+    walrus = api.send(token, channel_id, 'a walrus appears')
+    walruses = api.send(token, channel_id, 'walruses, "quoted" OR not')
+    assert _ids(_search(api, token, server_id, 'walrus')) == [walrus['id']]
+    assert sorted(_ids(_search(api, token, server_id, 'walrus*'))) == [walrus['id'], walruses['id']]
+    assert _ids(_search(api, token, server_id, '"quoted" OR')) == [walruses['id']]
+
+@pytest.mark.parametrize('sort', ['relevance', 'recent'])
+def test_cursor_walks_every_hit_once(api, channel, sort):
+    token, server_id, channel_id = channel
+    sent = [api.send(token, channel_id, f'page walrus {i}') for i in range(7)]
+    seen, cursor = [], None
+    while True:
+        params = {'sort': sort, 'limit': 3}
+        if cursor:
+            params['cursor'] = cursor
+        response = _search(api, token, server_id, 'walrus', **params)
+        seen += _ids(response)
+        cursor = response.json['cursor']
+        if cursor is None:
+            break
+    assert sorted(seen) == sorted(m['id'] for m in sent)
+    if sort == 'recent':
+        assert seen == sorted(seen, reverse=True)
+
+@pytest.mark.parametrize('cursor', ['e30=', 'WyJhIiwgImIiXQ==', 'W10=', 'WzEsIDIsIDNd', 'bm90IGpzb24=', '%%%'])
+@pytest.mark.parametrize('sort', ['relevance', 'recent'])
+def test_bad_cursor_is_a_400(api, channel, cursor, sort):
+    token, server_id, channel_id = channel
+    api.send(token, channel_id, 'walrus')
+    response = _search(api, token, server_id, 'walrus', sort=sort, cursor=cursor)
+    assert response.status_code == 400
+    assert response.json['error'] == 'Invalid cursor'
+
+def test_archived_hits_are_returned_with_a_snippet(app, api, channel):
+    token, server_id, channel_id = channel
+    old = api.send(token, channel_id, 'an archived walrus')
+    with app.app_context():
+        db.session.get(Message, old['id']).created_at = datetime(2020, 1, 1)
+        db.session.commit()
+        assert archive.run(after_days=7) == 1
+    result, = _search(api, token, server_id, 'walrus').json['results']
+    assert (result['id'], result['content']) == (old['id'], 'an archived walrus')
+    assert result['snippet'] == 'an archived [walrus]'
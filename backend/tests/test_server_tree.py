@@ -0,0 +1,64 @@
+import pytest
+
+@pytest.fixture
+def owner(api):
+    token = api.register('alice')
+    return token, api.create_server(token)['id']
+
+def _list(api, token, etag=None):
+    headers = api.headers(token)
+    if etag is not None:
+        headers['If-None-Match'] = f'"{etag}"'
+    return api.client.get('/api/servers/', headers=headers)
+
+def _etag(api, token):
+    response = _list(api, token)
+    assert response.status_code == 200
+    etag, weak = response.get_etag()
+    assert etag and not weak
+    return etag
+
+def test_unchanged_list_is_a_304(api, owner):
+    token, _ = owner
+    etag = _etag(api, token)
+    response = _list(api, token, etag)
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.get_etag()[0] == etag
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+
+    assert _list(api, token, 'something else').status_code == 200
+
+def _changes_etag(api, token, change):
+    before = _etag(api, token)
+    response = change()
+    assert response.status_code in (200, 201), response.json
+    after = _etag(api, token)
+    assert after != before
+    assert _list(api, token, before).status_code == 200
+    return response
+
+def test_channel_changes_change_the_etag(api, owner):
+    token, server_id = owner
+    response = _changes_etag(api, token, lambda: api.client.post(
+        f'/api/channels/{server_id}/create', json={'name': 'news', 'type': 'text'}, headers=api.headers(token)))
+    channel_id = response.json['channel']['id']
+    _changes_etag(api, token, lambda: api.client.delete(f'/api/channels/{channel_id}', headers=api.headers(token)))
+
+    servers = _list(api, token).json['servers']
+    assert 'news' not in [c['name'] for c in servers[0]['channels']]
+
+def test_server_edit_changes_the_etag(api, owner):
+    token, server_id = owner
+    _changes_etag(api, token, lambda: api.client.patch(
+        f'/api/servers/{server_id}', json={'name': 'renamed'}, headers=api.headers(token)))
+    assert _list(api, token).json['servers'][0]['name'] == 'renamed'
+
+def test_joining_and_leaving_change_the_members_etag(api, owner):
+    token, server_id = owner
+    bob = api.register('bob')
+    _changes_etag(api, bob, lambda: api.client.post(
+        f'/api/servers/{server_id}/invite', json={'username': 'bob'}, headers=api.headers(token)))
+    assert [s['id'] for s in _list(api, bob).json['servers']] == [server_id]
+    _changes_etag(api, bob, lambda: api.client.post(f'/api/servers/{server_id}/leave', headers=api.headers(bob)))
+    assert _list(api, bob).json['servers'] == []
@@ -0,0 +1,132 @@
+import pytest
+from socketio import BaseManager, PubSubManager
+from cluster import SequencedKombuManager, SequencedRedisManager
+from session_resume import SessionResume, ResyncRequired, session_resume
+from wire import EncodeOnceManager
+
+@pytest.fixture
+def room(api):
+    alice = api.register('alice')
+    bob = api.register('bob')
+    server = api.create_server(alice)
+    api.invite(alice, server['id'], 'bob')
+    return alice, bob, server['id'], server['channels'][0]['id']
+
+def _connect(connect, events, token, server_id):
+    socket = connect(token)
+    ready, = [payload for name, payload in events(socket) if name == 'ready']
+    socket.emit('join_server', {'server_id': server_id})
+    return socket, ready
+
+def _messages(received):
+    return [(payload['seq'], payload['message']['content']) for name, payload in received
+            if name == 'new_message']
+
+def test_resume_replays_what_was_missed(api, connect, events, room):
+    alice, bob, server_id, channel_id = room
+    socket, ready = _connect(connect, events, alice, server_id)
+    api.send(bob, channel_id, 'seen')
+    seen = _messages(events(socket))
+    assert [content for _, content in seen] == ['seen']
+
+    socket.disconnect()
+    for content in ('missed 1', 'missed 2'):
+        api.send(bob, channel_id, content)
+
+    again = connect(alice)
+    events(again)
+    again.emit('resume', {'session_id': ready['session_id'], 'seq': seen[-1][0]})
+    received = events(again)
+    replayed = _messages(received)
+    assert [content for _, content in replayed] == ['missed 1', 'missed 2']
+    assert [seq for seq, _ in replayed] == sorted(seq for seq, _ in replayed)
+    assert received[-1] == ('resumed', {'session_id': ready['session_id'], 'replayed': 2})
+
+    # Back in the old rooms without joining them again
+    api.send(bob, channel_id, 'live')
+    assert [content for _, content in _messages(events(again))] == ['live']
+
+def test_overflowed_buffer_asks_for_a_resync(api, connect, events, room, monkeypatch):
+    monkeypatch.setattr(session_resume, 'buffer_size', 3)
+    alice, bob, server_id, channel_id = room
+    socket, ready = _connect(connect, events, alice, server_id)
+    seq = session_resume.seq
+    socket.disconnect()
+    for i in range(5):
+        api.send(bob, channel_id, f'missed {i}')
+
+    again = connect(alice)
+    events(again)
+    again.emit('resume', {'session_id': ready['session_id'], 'seq': seq})
+    assert events(again) == [('resync_required', {'reason': 'too far behind'})]
+
+    # and the session is gone for good
+    again.emit('resume', {'session_id': ready['session_id'], 'seq': seq})
+    assert events(again) == [('resync_required', {'reason': 'unknown session'})]
+
+def test_resume_of_someone_elses_session_is_refused(api, connect, events, room):
+    alice, bob, server_id, _ = room
+    socket, ready = _connect(connect, events, alice, server_id)
+    socket.disconnect()
+
+    intruder = connect(bob)
+    events(intruder)
+    intruder.emit('resume', {'session_id': ready['session_id'], 'seq': 0})
+    assert events(intruder) == [('resync_required', {'reason': 'unknown session'})]
+
+def test_resume_needs_the_rooms_to_still_be_allowed(api, connect, events, room):
+    alice, bob, server_id, _ = room
+    socket, ready = _connect(connect, events, bob, server_id)
+    socket.disconnect()
+    api.client.post(f'/api/servers/{server_id}/leave', headers=api.headers(bob))
+
+    again = connect(bob)
+    events(again)
+    again.emit('resume', {'session_id': ready['session_id'], 'seq': session_resume.seq})
+    assert events(again) == [('resync_required', {'reason': 'membership changed'})]
+
+def test_resume_takes_over_a_socket_that_has_not_dropped_yet(api, connect, events, room):
+    alice, bob, server_id, channel_id = room
+    old, ready = _connect(connect, events, alice, server_id)
+
+    new = connect(alice)
+    events(new)
+    new.emit('resume', {'session_id': ready['session_id'], 'seq': session_resume.seq})
+    assert events(new)[-1] == ('resumed', {'session_id': ready['session_id'], 'replayed': 0})
+    assert not old.is_connected()
+
+    api.send(bob, channel_id, 'after takeover')
+    assert [content for _, content in _messages(events(new))] == ['after takeover']
+
+def test_resume_is_off_when_the_manager_cannot_number_events(app, api, connect, events, room, monkeypatch):
+    monkeypatch.setattr(session_resume, 'enabled', False)
+    alice, _, _, _ = room
+    socket = connect(alice)
+    assert events(socket, 'ready') == [('ready', {'session_id': None, 'seq': None})]
+    socket.emit('resume', {'session_id': 'anything', 'seq': 0})
+    assert events(socket) == [('resync_required', {'reason': 'resume is not available'})]
+
+class _Server:
+    def __init__(self, manager):
+        self.manager = manager
+
+class _SocketIO:
+    def __init__(self, manager):
+        self.server = _Server(manager)
+
+def test_only_encode_once_managers_enable_resume(app):
+    resume = SessionResume()
+    resume.init_app(app, _SocketIO(BaseManager()))
+    assert not resume.enabled
+    assert resume.open('sid', 1) is None
+    with pytest.raises(ResyncRequired):
+        resume.claim('sid', 1, 'session', 0)
+
+    manager = EncodeOnceManager()
+    resume.init_app(app, _SocketIO(manager))
+    assert resume.enabled and manager.sequencer is resume
+
+def test_queue_managers_deliver_through_encode_once():
+    # A pub/sub manager hands each received emit to the next manager in line
+    for manager in (SequencedRedisManager, SequencedKombuManager):
+        assert super(PubSubManager, manager).emit is EncodeOnceManager.emit
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+import pytest
+from archive import archive
+from models import db, Message
+from search import encode_cursor
+
+@pytest.fixture
+def channel(api):
+    token = api.register('alice')
+    server = api.create_server(token)
+    return token, server['id'], server['channels'][0]['id']
+
+def _reply(api, token, parent_id, content):
+    response = api.client.post(f'/api/threads/{parent_id}/messages', json={'content': content},
+                               headers=api.headers(token))
+    assert response.status_code == 201, response.json
+    return response.json['message']
+
+def _thread(api, token, parent_id, **params):
+    return api.client.get(f'/api/threads/{parent_id}', query_string=params, headers=api.headers(token))
+
+def test_thread_pages_oldest_first(api, channel):
+    token, _, channel_id = channel
+    parent = api.send(token, channel_id, 'parent')
+    replies = [_reply(api, token, parent['id'], f'reply {i}') for i in range(5)]
+
+    seen, cursor = [], None
+    while True:
+        params = {'limit': 2}
+        if cursor:
+            params['cursor'] = cursor
+        response = _thread(api, token, parent['id'], **params)
+        assert response.status_code == 200, response.json
+        thread = response.json['thread']
+        assert thread['parent']['id'] == parent['id']
+        seen += [m['id'] for m in thread['messages']]
+        cursor = thread['cursor']
+        if cursor is None:
+            break
+    assert seen == [m['id'] for m in replies]
+
+    assert thread['parent']['reply_count'] == 5
+    assert thread['parent']['last_reply_at'] == replies[-1]['created_at']
+
+@pytest.mark.parametrize('values', [{}, [], ['not a date', 1], [1, 2]])
+def test_bad_thread_cursor_is_a_400(api, channel, values):
+    token, _, channel_id = channel
+    parent = api.send(token, channel_id, 'parent')
+    assert _thread(api, token, parent['id'], cursor=encode_cursor(values)).status_code == 400
+
+def test_replies_stay_out_of_channel_history(api, channel):
+    token, _, channel_id = channel
+    parent = api.send(token, channel_id, 'parent')
+    reply = _reply(api, token, parent['id'], 'reply')
+    after = api.send(token, channel_id, 'after')
+
+    body = api.history(token, channel_id).json['channel']
+    assert [m['id'] for m in body['messages']] == [after['id'], parent['id']]
+    assert body['pagination']['total'] == 2
+    body = api.history(token, channel_id, cursor='true').json['channel']
+    assert [m['id'] for m in body['messages']] == [after['id'], parent['id']]
+    body = api.history(token, channel_id, after=parent['id']).json['channel']
+    assert [m['id'] for m in body['messages']] == [after['id']]
+
+    # A reply cannot start a thread of its own
+    response = api.client.post(f"/api/threads/{reply['id']}/messages", json={'content': 'nested'},
+                               headers=api.headers(token))
+    assert response.status_code == 404
+
+def test_reply_reaches_thread_subscribers_only(api, connect, events, channel):
+    token, server_id, channel_id = channel
+    parent = api.send(token, channel_id, 'parent')
+    watching, browsing = connect(token), connect(token)
+    for socket in (watching, browsing):
+        socket.emit('join_server', {'server_id': server_id})
+    watching.emit('subscribe_thread', {'message_id': parent['id']})
+    events(watching)
+    events(browsing)
+
+    reply = _reply(api, token, parent['id'], 'reply')
+    assert [payload['message']['id'] for _, payload in events(watching, 'thread_message')] == [reply['id']]
+    assert events(browsing, 'thread_message') == []
+    assert events(browsing, 'new_message') == []
+
+def test_reply_to_an_archived_parent_restores_it(app, api, channel):
+    token, _, channel_id = channel
+    parent = api.send(token, channel_id, 'archived parent')
+    with app.app_context():
+        db.session.get(Message, parent['id']).created_at = datetime.utcnow() - timedelta(days=30)
+        db.session.commit()
+        assert archive.run(after_days=7) == 1
+        assert db.session.get(Message, parent['id']) is None
+
+    reply = _reply(api, token, parent['id'], 'reply')
+    with app.app_context():
+        restored = db.session.get(Message, parent['id'])
+        assert (restored.content, restored.reply_count) == ('archived parent', 1)
+    thread = _thread(api, token, parent['id']).json['thread']
+    assert thread['parent']['reply_count'] == 1
+    assert [m['id'] for m in thread['messages']] == [reply['id']]
+    history = api.history(token, channel_id, cursor='true').json['channel']['messages']
+    assert [m['id'] for m in history] == [parent['id']]
@@ -0,0 +1,85 @@
+import io
+from datetime import datetime, timedelta
+import pytest
+from archive import archive
+from models import db, Message, User, server_members
+from transfer import InvalidExport, export_server, import_server
+from wire import dumps, loads
+
+@pytest.fixture
+def exported(app, api):
+    alice = api.register('alice')
+    bob = api.register('bob')
+    server = api.create_server(alice, 'exported')
+    api.invite(alice, server['id'], 'bob')
+    channel_id = server['channels'][0]['id']
+    api.send(alice, channel_id, 'from alice')
+    api.send(bob, channel_id, 'from bob')
+    out = io.StringIO()
+    with app.app_context():
+        export_server(server['id'], out)
+        db.session.remove()
+    return [loads(line) for line in out.getvalue().splitlines()]
+
+def _import(app, records):
+    with app.app_context():
+        return import_server(dumps(record) + '\n' for record in records)
+
+def _authors(app, server_id):
+    with app.app_context():
+        return {row.content: row.username for row in db.session.query(Message.content, User.username)
+                .join(User, User.id == Message.user_id)
+                .join(server_members, server_members.c.user_id == User.id)
+                .filter(server_members.c.server_id == server_id)}
+
+def test_same_accounts_are_matched(app, exported):
+    counts = _import(app, exported)
+    assert (counts['users_matched'], counts['users_created']) == (2, 0)
+    assert _authors(app, counts['server_id']) == {'from alice': 'alice', 'from bob': 'bob'}
+
+def test_namesake_gets_an_account_of_their_own(app, exported):
+    # Another bob exported from another instance
+    for record in exported:
+        if record['record'] == 'user' and record['username'] == 'bob':
+            record['email'] = 'other-bob@example.com'
+    counts = _import(app, exported)
+    assert (counts['users_matched'], counts['users_created'], counts['users_renamed']) == (1, 1, 1)
+    assert _authors(app, counts['server_id']) == {'from alice': 'alice', 'from bob': 'bob-2'}
+
+    with app.app_context():
+        created = User.query.filter_by(username='bob-2').one()
+        assert created.email.endswith('@invalid')
+        assert created.password_hash == '!'
+
+def test_namesakes_in_two_imports_get_distinct_names(app, exported):
+    for record in exported:
+        if record['record'] == 'user' and record['username'] == 'bob':
+            record['email'] = 'other-bob@example.com'
+    _import(app, exported)
+    counts = _import(app, exported)
+    assert _authors(app, counts['server_id'])['from bob'] == 'bob-3'
+
+def test_integrity_error_names_the_record(app, exported):
+    member = next(record for record in exported if record['record'] == 'member')
+    position = exported.index(member)
+    exported.insert(position, dict(member))
+    with pytest.raises(InvalidExport, match=f'Line {position + 2}'):
+        _import(app, exported)
+    with app.app_context():
+        assert db.session.query(User).count() == 2
+
+def test_import_after_archiving_keeps_ids_apart(app, exported):
+    with app.app_context():
+        for message in Message.query:
+            message.created_at = datetime.utcnow() - timedelta(days=30)
+        db.session.commit()
+        assert archive.run(after_days=7) == 2
+        archived = {message.id: message.content for channel_id in archive.channel_ids()
+                    for message in archive.scan(channel_id)}
+
+    counts = _import(app, exported)
+    with app.app_context():
+        imported = [row.id for row in db.session.query(Message.id)]
+        assert len(imported) == 2 and min(imported) > max(archived)
+        assert {message_id: archive.find_by_id(message_id).content for message_id in archived} == archived
+    assert _authors(app, counts['server_id']) == {'from alice': 'alice', 'from bob': 'bob'}
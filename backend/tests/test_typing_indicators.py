@@ -0,0 +1,87 @@
+import pytest
+import typing_indicators
+from typing_indicators import TypingTracker, typing_tracker
+
+class _Recorder:
+    """Stands in for the SocketIO object, keeping what was emitted."""
+    server = object()
+
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, room=None):
+        self.emitted.append((room, [user['username'] for user in data['users']]))
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(typing_indicators.time, 'monotonic', lambda: now[0])
+    return now
+
+@pytest.fixture
+def tracker(app, clock, monkeypatch):
+    tracker = TypingTracker()
+    tracker.init_app(app, _Recorder())
+    monkeypatch.setattr(tracker, '_ensure_worker', lambda: None)  # flushed by hand
+    return tracker
+
+def test_events_inside_the_throttle_are_dropped(tracker, clock):
+    assert tracker.typing(1, 7, 'alice')
+    clock[0] += tracker.throttle - 0.1
+    assert not tracker.typing(1, 7, 'alice')
+    assert tracker.typing(2, 7, 'alice')  # per channel
+    clock[0] += 0.1
+    assert tracker.typing(1, 7, 'alice')
+    assert tracker.stats['events_throttled'] == 1
+
+def test_one_snapshot_per_changed_channel(tracker, clock):
+    tracker.typing(1, 7, 'alice')
+    tracker.typing(1, 8, 'bob')
+    tracker.typing(2, 8, 'bob')
+    assert tracker.socketio.emitted == []
+
+    tracker.flush()
+    assert sorted(tracker.socketio.emitted) == [('channel_1', ['alice', 'bob']), ('channel_2', ['bob'])]
+
+    # Renewing an entry changes nothing anyone sees
+    clock[0] += tracker.throttle
+    tracker.typing(1, 7, 'alice')
+    tracker.socketio.emitted.clear()
+    tracker.flush()
+    assert tracker.socketio.emitted == []
+
+def test_entries_expire_after_the_ttl(tracker, clock):
+    tracker.typing(1, 7, 'alice')
+    clock[0] += tracker.throttle
+    tracker.typing(1, 8, 'bob')
+    tracker.flush()
+    tracker.socketio.emitted.clear()
+
+    # alice's last event was one TTL ago; bob's is more recent
+    clock[0] += tracker.ttl - tracker.throttle
+    tracker.flush()
+    assert tracker.socketio.emitted == [('channel_1', ['bob'])]
+
+    clock[0] += tracker.throttle
+    tracker.flush()
+    assert tracker.socketio.emitted[-1] == ('channel_1', [])
+    assert tracker.channels == {}
+
+def test_stop_clears_the_entry(tracker):
+    tracker.typing(1, 7, 'alice')
+    tracker.flush()
+    tracker.stop(1, 7)
+    tracker.stop(1, 7)
+    tracker.flush()
+    assert tracker.socketio.emitted == [('channel_1', ['alice']), ('channel_1', [])]
+
+def test_sending_a_message_ends_typing(api, connect):
+    token = api.register('alice')
+    server = api.create_server(token)
+    channel_id = server['channels'][0]['id']
+    socket = connect(token)
+    socket.emit('typing', {'channel_id': channel_id})
+    assert [user['username'] for user in typing_tracker.snapshot(channel_id)] == ['alice']
+
+    api.send(token, channel_id, 'done typing')
+    assert typing_tracker.snapshot(channel_id) == []
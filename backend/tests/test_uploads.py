@@ -0,0 +1,117 @@
+import fcntl
+import pytest
+import message_pipeline
+from uploads import blob_store, sign_attachment_url
+
+def _upload(api, token, filename, data):
+    response = api.client.post('/api/uploads', json={'filename': filename, 'size': len(data)},
+                               headers=api.headers(token))
+    assert response.status_code == 201, response.json
+    upload_id = response.json['upload']['upload_id']
+    response = api.client.patch(f'/api/uploads/{upload_id}', data=data,
+                                headers=dict(api.headers(token), **{'Upload-Offset': '0'}))
+    assert response.status_code == 200, response.json
+    assert response.json['upload']['complete']
+    return upload_id
+
+def _send(api, token, channel_id, upload_ids):
+    return api.client.post(f'/api/channels/{channel_id}/messages',
+                           json={'content': 'file', 'attachments': upload_ids}, headers=api.headers(token))
+
+@pytest.fixture
+def channel(api):
+    token = api.register('alice')
+    server = api.create_server(token)
+    return token, server['channels'][0]['id']
+
+def test_upload_can_be_attached_again_after_a_failed_commit(api, channel, monkeypatch):
+    token, channel_id = channel
+    upload_id = _upload(api, token, 'notes.txt', b'hello')
+
+    def fail(*args):
+        raise RuntimeError('mentions are down')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(message_pipeline, 'record_mentions', fail)
+        assert _send(api, token, channel_id, [upload_id]).status_code == 500
+
+    response = _send(api, token, channel_id, [upload_id])
+    assert response.status_code == 201, response.json
+    assert [a['filename'] for a in response.json['message']['attachments']] == ['notes.txt']
+
+def test_upload_is_attached_once(api, channel):
+    token, channel_id = channel
+    upload_id = _upload(api, token, 'notes.txt', b'hello')
+    assert _send(api, token, channel_id, [upload_id]).status_code == 201
+    assert _send(api, token, channel_id, [upload_id]).status_code == 400
+
+def test_listing_an_upload_twice_claims_nothing(api, channel):
+    token, channel_id = channel
+    upload_id = _upload(api, token, 'notes.txt', b'hello')
+    assert _send(api, token, channel_id, [upload_id, upload_id]).status_code == 400
+    assert _send(api, token, channel_id, [upload_id]).status_code == 201
+
+def test_chunk_racing_another_gets_409(api, channel):
+    token, _ = channel
+    response = api.client.post('/api/uploads', json={'filename': 'big.bin', 'size': 10},
+                               headers=api.headers(token))
+    upload_id = response.json['upload']['upload_id']
+
+    # Another request is writing this upload
+    with open(blob_store._partial_path(upload_id), 'ab') as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        response = api.client.patch(f'/api/uploads/{upload_id}', data=b'01234',
+                                    headers=dict(api.headers(token), **{'Upload-Offset': '0'}))
+    assert response.status_code == 409
+    assert response.json['offset'] == 0
+
+    response = api.client.patch(f'/api/uploads/{upload_id}', data=b'01234',
+                                headers=dict(api.headers(token), **{'Upload-Offset': '0'}))
+    assert response.json['upload']['offset'] == 5
+
+@pytest.fixture
+def attachment(api, channel):
+    token, channel_id = channel
+    upload_id = _upload(api, token, 'photo.png', b'not really a png')
+    message = _send(api, token, channel_id, [upload_id]).json['message']
+    return token, message['attachments'][0]['file_url']
+
+def test_signed_url_downloads_without_a_token(app, api, attachment):
+    token, url = attachment
+    assert api.client.get(url).status_code == 401
+
+    response = api.client.post('/api/attachments/sign', json={'urls': [url]}, headers=api.headers(token))
+    assert response.status_code == 200
+    signed, = response.json['urls']
+    response = api.client.get(signed)
+    assert response.status_code == 200
+    assert response.data == b'not really a png'
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+
+    tampered = signed.replace(f'user={api.user_ids["alice"]}', 'user=999')
+    assert api.client.get(tampered).status_code == 403
+
+def test_expired_signed_url_is_refused(app, api, attachment):
+    _, url = attachment
+    content_hash, filename = url.split('/')[-2:]
+    expired = sign_attachment_url(app.config['SECRET_KEY'], 60, api.user_ids['alice'],
+                                  content_hash, filename, now=1000)
+    assert api.client.get(expired).status_code == 403
+
+def test_signed_url_still_needs_membership(app, api, attachment):
+    _, url = attachment
+    api.register('mallory')
+    content_hash, filename = url.split('/')[-2:]
+    signed = sign_attachment_url(app.config['SECRET_KEY'], 60, api.user_ids['mallory'], content_hash, filename)
+    assert api.client.get(signed).status_code == 404
+
+def test_svg_is_never_served_inline(api, channel):
+    token, channel_id = channel
+    upload_id = _upload(api, token, 'logo.svg', b'<svg xmlns="http://www.w3.org/2000/svg"><script/></svg>')
+    url = _send(api, token, channel_id, [upload_id]).json['message']['attachments'][0]['file_url']
+
+    response = api.client.get(url, headers=api.headers(token))
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'].startswith('attachment')
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+    assert 'sandbox' in response.headers['Content-Security-Policy']
@@ -0,0 +1,138 @@
+import pytest
+from voice_state import voice_rosters
+
+@pytest.fixture
+def voice(api):
+    alice = api.register('alice')
+    bob = api.register('bob')
+    server = api.create_server(alice)
+    api.invite(alice, server['id'], 'bob')
+    voice_id, = [c['id'] for c in server['channels'] if c['type'] == 'voice']
+    return alice, bob, server['id'], voice_id
+
+def _payloads(received):
+    # Without the seq numbers session resume adds
+    return [{key: value for key, value in payload.items() if key != 'seq'} for _, payload in received]
+
+def _join(connect, events, token, channel_id):
+    socket = connect(token)
+    events(socket)
+    socket.emit('join_channel', {'channel_id': channel_id})
+    return socket
+
+def test_join_sends_the_roster_and_tells_the_channel(api, connect, events, voice):
+    alice, bob, _, voice_id = voice
+    first = _join(connect, events, alice, voice_id)
+    assert _payloads(events(first, 'voice_roster')) == [{
+        'channel_id': voice_id,
+        'users': [{'id': api.user_ids['alice'], 'username': 'alice', 'avatar_url': None,
+                   'muted': False, 'deafened': False}]
+    }]
+    events(first)
+
+    second = _join(connect, events, bob, voice_id)
+    (_, roster), = events(second, 'voice_roster')
+    assert [user['username'] for user in roster['users']] == ['alice', 'bob']
+    (_, joined), = events(first, 'voice_user_joined')
+    assert joined['user']['id'] == api.user_ids['bob']
+
+    response = api.client.get(f'/api/servers/{voice[2]}/voice-states', headers=api.headers(alice))
+    assert [[u['username'] for u in state['users']] for state in response.json['voice_states']] == [['alice', 'bob']]
+
+def test_signals_only_reach_roster_members(api, connect, events, voice):
+    alice, bob, _, voice_id = voice
+    sender = _join(connect, events, alice, voice_id)
+    outsider = connect(bob)
+    events(sender)
+    events(outsider)
+
+    rejected = voice_rosters.stats['signals_rejected']
+    sender.emit('voice_signal', {'channel_id': voice_id, 'target_user_id': api.user_ids['bob'],
+                                 'signal': {'type': 'offer', 'sdp': 'x'}})
+    assert events(outsider) == []
+    assert voice_rosters.stats['signals_rejected'] == rejected + 1
+
+    outsider.emit('join_channel', {'channel_id': voice_id})
+    events(outsider)
+    signal = {'type': 'offer', 'sdp': 'x'}
+    sender.emit('voice_signal', {'channel_id': voice_id, 'target_user_id': api.user_ids['bob'], 'signal': signal})
+    assert _payloads(events(outsider, 'voice_signal')) == [{
+        'channel_id': voice_id, 'from_user_id': api.user_ids['alice'], 'signal': signal
+    }]
+
+def test_candidates_are_batched_behind_other_signals(api, connect, events, voice, monkeypatch):
+    monkeypatch.setattr(voice_rosters, 'batch_interval', 0.1)
+    monkeypatch.setattr(voice_rosters, '_ensure_worker', lambda: None)
+    alice, bob, _, voice_id = voice
+    sender = _join(connect, events, alice, voice_id)
+    target = _join(connect, events, bob, voice_id)
+    events(target)
+
+    def send(signal):
+        sender.emit('voice_signal', {'channel_id': voice_id, 'target_user_id': api.user_ids['bob'],
+                                     'signal': signal})
+
+    send({'type': 'candidate', 'candidate': {'candidate': 'a'}})
+    send({'candidate': 'b'})
+    assert events(target) == []
+    send({'type': 'answer', 'sdp': 'y'})
+    assert [(name, payload.get('signals') or payload['signal']) for name, payload in events(target)] == [
+        ('voice_signals', [{'type': 'candidate', 'candidate': {'candidate': 'a'}}, {'candidate': 'b'}]),
+        ('voice_signal', {'type': 'answer', 'sdp': 'y'}),
+    ]
+
+    send({'candidate': 'c'})
+    voice_rosters.flush()
+    assert _payloads(events(target, 'voice_signals')) == [{
+        'channel_id': voice_id, 'from_user_id': api.user_ids['alice'], 'signals': [{'candidate': 'c'}]
+    }]
+
+def test_mute_and_deafen_are_broadcast(api, connect, events, voice):
+    alice, bob, _, voice_id = voice
+    speaker = _join(connect, events, alice, voice_id)
+    listener = _join(connect, events, bob, voice_id)
+    events(speaker)
+    events(listener)
+
+    speaker.emit('voice_state', {'muted': True})
+    speaker.emit('voice_state', {'deafened': True})
+    updates = [payload['user'] for _, payload in events(listener, 'voice_state_update')]
+    assert [(u['id'], u['muted'], u['deafened']) for u in updates] == [
+        (api.user_ids['alice'], True, False), (api.user_ids['alice'], True, True)]
+    assert voice_rosters.roster(voice_id)[0]['muted'] is True
+
+def test_disconnect_leaves_the_roster(api, connect, events, voice):
+    alice, bob, _, voice_id = voice
+    leaving = _join(connect, events, alice, voice_id)
+    staying = _join(connect, events, bob, voice_id)
+    events(staying)
+
+    leaving.disconnect()
+    assert _payloads(events(staying, 'voice_user_left')) == [{
+        'channel_id': voice_id, 'user_id': api.user_ids['alice']}]
+    assert [u['username'] for u in voice_rosters.roster(voice_id)] == ['bob']
+
+def test_leaving_the_server_leaves_its_voice_channel(api, connect, events, voice):
+    alice, bob, server_id, voice_id = voice
+    staying = _join(connect, events, alice, voice_id)
+    _join(connect, events, bob, voice_id)
+    events(staying)
+
+    api.client.post(f'/api/servers/{server_id}/leave', headers=api.headers(bob))
+    assert _payloads(events(staying, 'voice_user_left')) == [{
+        'channel_id': voice_id, 'user_id': api.user_ids['bob']}]
+    assert api.user_ids['bob'] not in voice_rosters.by_user
+
+def test_deleting_the_channel_drops_its_roster(api, connect, events, voice):
+    alice, bob, _, voice_id = voice
+    socket = _join(connect, events, alice, voice_id)
+    leaves = voice_rosters.stats['leaves']
+    response = api.client.delete(f'/api/channels/{voice_id}', headers=api.headers(alice))
+    assert response.status_code == 200, response.json
+    assert voice_rosters.roster(voice_id) == []
+    assert voice_id not in voice_rosters.channel_servers
+    assert voice_rosters.by_sid == {} and voice_rosters.by_user == {}
+
+    # The socket's later disconnect finds nothing to remove
+    socket.disconnect()
+    assert voice_rosters.stats['leaves'] == leaves
@@ -0,0 +1,52 @@
+import msgpack
+import pytest
+from wire import EncodeOnceManager
+
+@pytest.fixture
+def room(api):
+    alice = api.register('alice')
+    bob = api.register('bob')
+    server = api.create_server(alice)
+    api.invite(alice, server['id'], 'bob')
+    return alice, bob, server['id'], server['channels'][0]['id']
+
+def _join(connect, token, server_id, **query):
+    socket = connect(token, **query)
+    socket.emit('join_server', {'server_id': server_id})
+    socket.get_received()
+    return socket
+
+def test_broadcast_is_encoded_once_per_encoding(api, connect, events, room, monkeypatch):
+    alice, bob, server_id, channel_id = room
+    encodings = []
+    encode = EncodeOnceManager._encode
+
+    def counted(manager, event, data, namespace, binary):
+        encodings.append((event, binary))
+        return encode(manager, event, data, namespace, binary)
+
+    monkeypatch.setattr(EncodeOnceManager, '_encode', counted)
+    json_sockets = [_join(connect, token, server_id) for token in (alice, bob)]
+    binary_socket = _join(connect, bob, server_id, encoding='msgpack')
+    encodings.clear()
+
+    message = api.send(alice, channel_id, 'hello')
+    assert sorted(encodings) == [('new_message', False), ('new_message', True)]
+
+    for socket in json_sockets:
+        (_, payload), = events(socket, 'new_message')
+        assert payload['message'] == message
+    (_, payload), = events(binary_socket, 'new_message')
+    assert isinstance(payload, bytes)
+    assert msgpack.unpackb(payload)['message'] == message
+
+def test_rest_answers_in_msgpack_when_preferred(api, room):
+    alice = room[0]
+    response = api.client.get('/api/servers/', headers=api.headers(alice))
+    assert response.mimetype == 'application/json'
+    assert 'Accept' in response.headers['Vary']
+
+    packed = api.client.get('/api/servers/', headers=dict(api.headers(alice), Accept='application/msgpack'))
+    assert packed.mimetype == 'application/msgpack'
+    assert 'Accept' in packed.headers['Vary']
+    assert msgpack.unpackb(packed.data) == response.json
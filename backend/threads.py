@@ -0,0 +1,55 @@
+from datetime import datetime
+from sqlalchemy import tuple_
+from models import db, Message
+from archive import archive
+from search import encode_cursor, decode_cursor
+
+# Thread replies are messages whose parent_id points at a top-level message
+# of the same channel. They stay out of channel history and reach clients as
+# thread_message, only in the thread_{parent_id} room. The parent row keeps
+# reply_count and last_reply_at, raised in the same transaction that inserts
+# the replies, so no read ever counts a thread. An archived message can
+# start a thread too: the first reply restores it to the table.
+
+def get_parent(message_id):
+    """The top-level message a thread hangs off, from the table or the archive, or None."""
+    parent = Message.query.filter(Message.id == message_id, Message.parent_id.is_(None)).first()
+    return parent if parent is not None else archive.find_by_id(message_id)
+
+def record_replies(replies):
+    """Raise the counters of the parents of just-flushed replies.
+
+    ``replies`` maps parent id -> list of reply messages. Returns parent id ->
+    (reply_count, last_reply_at) as stored after the update.
+    """
+    for parent_id, messages in replies.items():
+        update = db.update(Message)\
+            .where(Message.id == parent_id)\
+            .values(reply_count=Message.reply_count + len(messages),
+                    last_reply_at=max(message.created_at for message in messages))\
+            .execution_options(synchronize_session=False)
+        if db.session.execute(update).rowcount == 0 and archive.restore(messages[0].channel_id, parent_id):
+            db.session.execute(update)
+    rows = db.session.query(Message.id, Message.reply_count, Message.last_reply_at)\
+        .filter(Message.id.in_(list(replies)))\
+        .all()
+    return {row.id: (row.reply_count, row.last_reply_at) for row in rows}
+
+def thread_page(parent_id, limit=50, cursor=None):
+    """Return (replies oldest first, next_cursor) for one page of a thread."""
+    position = tuple_(Message.created_at, Message.id)
+    query = Message.query.filter(Message.parent_id == parent_id)
+    if cursor:
+        after = decode_cursor(cursor)
+        try:
+            key = (datetime.fromisoformat(after[0]), int(after[1]))
+        except (TypeError, IndexError, KeyError):
+            raise ValueError('Invalid cursor')
+        query = query.filter(position > key)
+    rows = query.order_by(Message.created_at.asc(), Message.id.asc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].created_at.isoformat(), rows[-1].id])
+    return rows, next_cursor
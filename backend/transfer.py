@@ -0,0 +1,402 @@
+"""Export a server's history to NDJSON, or import one into this database.
+
+    python transfer.py export 1 server1.ndjson.gz
+    python transfer.py import server1.ndjson.gz
+
+An export holds one JSON record per line: the users it references, then the
+server, its members, its channels, every message (archived ones included)
+and the metadata of every attachment. Files ending in .gz are gzipped;
+imports detect gzip by content. '-' means stdout or stdin. Attachment blobs
+are not part of the export; copy UPLOAD_FOLDER/blobs alongside it.
+"""
+import argparse
+import gzip
+import secrets
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from models import db
+from archive import archive
+from wire import dumps, loads
+import search
+
+# Exports stream rows through a server-side cursor BATCH_SIZE at a time, and
+# write them as they come, so memory does not grow with the history. Values
+# are passed through as SQLite stores them: timestamps stay strings and are
+# never parsed.
+#
+# Imports run in one transaction, so a failed import leaves nothing behind,
+# and insert with executemany, BATCH_SIZE rows per call. Every import
+# creates a new server. A user is matched to an account here only when both
+# username and email are the same; anyone else gets a new account without a
+# usable password and with a placeholder email, under the exported username
+# or, when that is taken here, a numbered variant of it. Channel ids are
+# remapped one by one.
+# Message ids are shifted by one offset past the highest id the database has
+# given out, archived messages included, which keeps their order and lets replies and attachments find their
+# message without a lookup table. The search index is filled in one
+# statement at the end rather than by the insert trigger row by row.
+# Mentions and read positions are not carried over.
+
+FORMAT = 'commi8-server'
+VERSION = 1
+BATCH_SIZE = 10000
+GZIP_LEVEL = 6
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'  # how SQLAlchemy stores DateTime in SQLite
+
+# Accounts created by an import cannot log in: no password checks against it
+UNUSABLE_PASSWORD = '!'
+USERNAME_MAX_LENGTH = 80
+
+MESSAGE_COLUMNS = ('id', 'user_id', 'channel_id', 'content', 'created_at', 'edited_at',
+                   'parent_id', 'reply_count', 'last_reply_at')
+ATTACHMENT_COLUMNS = ('message_id', 'filename', 'file_url', 'created_at', 'content_hash',
+                      'size', 'content_type')
+
+class InvalidExport(ValueError):
+    pass
+
+def _timestamp(value):
+    return value.strftime(TIMESTAMP_FORMAT) if value is not None else None
+
+def _records(connection, sql, params, record):
+    result = connection.exec_driver_sql(sql, params)
+    for row in result:
+        yield dict(row._mapping, record=record)
+
+# Export
+
+def export_server(server_id, out):
+    """Write a server's history to the text stream ``out``; returns record counts."""
+    counts = {'users': 0, 'channels': 0, 'messages': 0, 'archived_messages': 0, 'attachments': 0}
+    users_written = set()
+
+    def write(record):
+        out.write(dumps(record))
+        out.write('\n')
+
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(yield_per=BATCH_SIZE)
+        server = connection.exec_driver_sql(
+            'SELECT id, name, description, icon_url, owner_id, created_at FROM servers WHERE id = ?',
+            (server_id,)).mappings().first()
+        if server is None:
+            raise ValueError(f'No server {server_id}')
+        channel_ids = [row[0] for row in connection.exec_driver_sql(
+            'SELECT id FROM channels WHERE server_id = ? ORDER BY id', (server_id,))]
+
+        # Authors who have left the server are written before their first message
+        def write_user(user_id):
+            user = connection.exec_driver_sql(
+                'SELECT id, username, email, avatar_url, created_at FROM users WHERE id = ?',
+                (user_id,)).mappings().first()
+            users_written.add(user_id)
+            if user is not None:
+                write(dict(user, record='user'))
+                counts['users'] += 1
+
+        # Lowest and highest message id, which the importer shifts all ids by
+        low = high = None
+        for channel_id in channel_ids:
+            ranges = [connection.exec_driver_sql(
+                'SELECT min(id), max(id) FROM messages WHERE channel_id = ?', (channel_id,)).one(),
+                archive.id_range(channel_id) or (None, None)]
+            for lo, hi in ranges:
+                if lo is not None:
+                    low = lo if low is None else min(low, lo)
+                    high = hi if high is None else max(high, hi)
+
+        write({'record': 'export', 'format': FORMAT, 'version': VERSION,
+               'exported_at': _timestamp(datetime.utcnow())})
+        for record in _records(connection,
+                               'SELECT users.id, username, email, avatar_url, created_at FROM users '
+                               'JOIN server_members ON server_members.user_id = users.id '
+                               'WHERE server_members.server_id = ? ORDER BY users.id',
+                               (server_id,), 'user'):
+            users_written.add(record['id'])
+            write(record)
+            counts['users'] += 1
+        if server['owner_id'] not in users_written:
+            write_user(server['owner_id'])
+        write(dict(server, record='server', message_ids=[low, high] if low is not None else None))
+        for record in _records(connection,
+                               'SELECT user_id, role FROM server_members WHERE server_id = ?',
+                               (server_id,), 'member'):
+            write(record)
+        for record in _records(connection,
+                               'SELECT id, name, type, created_at FROM channels WHERE server_id = ? ORDER BY id',
+                               (server_id,), 'channel'):
+            write(record)
+            counts['channels'] += 1
+
+        for channel_id in channel_ids:
+            # Archived messages are all older than the ones still in the table;
+            # the ones a reply restored to the table are written from there
+            restored = {row[0] for row in connection.exec_driver_sql(
+                'SELECT messages.id FROM archive_entries JOIN messages ON messages.id = archive_entries.id '
+                'WHERE archive_entries.channel_id = ?', (channel_id,))}
+            for message in archive.scan(channel_id):
+                if message.id in restored:
+                    continue
+                if message.user_id not in users_written:
+                    write_user(message.user_id)
+                write({
+                    'record': 'message', 'id': message.id, 'user_id': message.user_id,
+                    'channel_id': channel_id, 'content': message.content,
+                    'created_at': _timestamp(message.created_at),
+                    'edited_at': _timestamp(message.edited_at),
+                    'parent_id': None, 'reply_count': 0, 'last_reply_at': None
+                })
+                counts['archived_messages'] += 1
+            for record in _records(connection,
+                                   f'SELECT {", ".join(MESSAGE_COLUMNS)} FROM messages '
+                                   'WHERE channel_id = ? ORDER BY created_at, id',
+                                   (channel_id,), 'message'):
+                if record['user_id'] not in users_written:
+                    write_user(record['user_id'])
+                write(record)
+                counts['messages'] += 1
+
+        # One pass over attachments, each joined to its message by primary key
+        for record in _records(connection,
+                               f'SELECT {", ".join("attachments." + c for c in ATTACHMENT_COLUMNS)} '
+                               'FROM attachments JOIN messages ON messages.id = attachments.message_id '
+                               'JOIN channels ON channels.id = messages.channel_id '
+                               'WHERE channels.server_id = ?',
+                               (server_id,), 'attachment'):
+            write(record)
+            counts['attachments'] += 1
+    return counts
+
+# Import
+
+class ServerImport:
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.server_id = None
+        self.users = {}     # exported id -> id here
+        self.channels = {}  # exported id -> id here
+        self.offset = 0     # added to every exported message id
+        self.message_ids = (None, None)  # lowest and highest id given to an imported message
+        self.messages = []
+        self.attachments = []
+        self.counts = {'users_matched': 0, 'users_created': 0, 'users_renamed': 0, 'channels': 0,
+                       'messages': 0, 'attachments': 0}
+
+    def add(self, record):
+        kind = record.get('record')
+        handler = getattr(self, f'_{kind}', None) if kind else None
+        if handler is None:
+            raise InvalidExport(f'Unknown record {kind!r}')
+        if kind not in ('export', 'user', 'server') and self.server_id is None:
+            raise InvalidExport(f'{kind} record before the server record')
+        handler(record)
+
+    def _export(self, record):
+        if record.get('format') != FORMAT or record.get('version') != VERSION:
+            raise InvalidExport(f'Not a {FORMAT} v{VERSION} export')
+
+    def _user(self, record):
+        # The username alone may be someone else's here
+        row = self.cursor.execute('SELECT id FROM users WHERE username = ? AND email = ?',
+                                  (record['username'], record['email'])).fetchone()
+        if row is not None:
+            self.users[record['id']] = row[0]
+            self.counts['users_matched'] += 1
+            return
+        # The exported email is left out, so it stays free for its owner here
+        email = f'imported-{secrets.token_hex(8)}@invalid'
+        for attempt in range(1, 101):
+            suffix = f'-{attempt}' if attempt > 1 else ''
+            username = record['username'][:USERNAME_MAX_LENGTH - len(suffix)] + suffix
+            self.cursor.execute('SAVEPOINT import_user')
+            try:
+                self.cursor.execute(
+                    "INSERT INTO users (username, email, password_hash, avatar_url, status, created_at) "
+                    "VALUES (?, ?, ?, ?, 'offline', ?)",
+                    (username, email, UNUSABLE_PASSWORD, record['avatar_url'], record['created_at']))
+            except sqlite3.IntegrityError:
+                self.cursor.execute('ROLLBACK TO import_user')
+                continue
+            finally:
+                self.cursor.execute('RELEASE import_user')
+            self.users[record['id']] = self.cursor.lastrowid
+            self.counts['users_created'] += 1
+            if attempt > 1:
+                self.counts['users_renamed'] += 1
+            return
+        raise InvalidExport(f'No free username for user {record["id"]} ({record["username"]})')
+
+    def _server(self, record):
+        if self.server_id is not None:
+            raise InvalidExport('More than one server record')
+        self.cursor.execute(
+            'INSERT INTO servers (name, description, icon_url, owner_id, created_at) VALUES (?, ?, ?, ?, ?)',
+            (record['name'], record['description'], record['icon_url'],
+             self._user_id(record['owner_id']), record['created_at']))
+        self.server_id = self.cursor.lastrowid
+        if record['message_ids'] is not None:
+            # Every shifted id lands above every id ever given out here,
+            # archived messages' included
+            highest = self.cursor.execute(
+                'SELECT max((SELECT coalesce(max(id), 0) FROM messages), '
+                '(SELECT coalesce(max(id), 0) FROM archive_entries), '
+                "(SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = 'messages'))"
+            ).fetchone()[0]
+            self.offset = highest + 1 - record['message_ids'][0]
+            self.message_ids = tuple(message_id + self.offset for message_id in record['message_ids'])
+
+    def _member(self, record):
+        self.cursor.execute('INSERT INTO server_members (user_id, server_id, role) VALUES (?, ?, ?)',
+                            (self._user_id(record['user_id']), self.server_id, record['role']))
+
+    def _channel(self, record):
+        self.cursor.execute('INSERT INTO channels (name, type, server_id, created_at) VALUES (?, ?, ?, ?)',
+                            (record['name'], record['type'], self.server_id, record['created_at']))
+        self.channels[record['id']] = self.cursor.lastrowid
+        self.counts['channels'] += 1
+
+    def _message(self, record):
+        channel_id = self.channels.get(record['channel_id'])
+        if channel_id is None:
+            raise InvalidExport(f'Message {record["id"]} is in unknown channel {record["channel_id"]}')
+        parent_id = record['parent_id']
+        self.messages.append((
+            record['id'] + self.offset, record['content'], self._user_id(record['user_id']), channel_id,
+            record['created_at'], record['edited_at'],
+            parent_id + self.offset if parent_id is not None else None,
+            record['reply_count'], record['last_reply_at']
+        ))
+        if len(self.messages) >= BATCH_SIZE:
+            self._flush_messages()
+
+    def _attachment(self, record):
+        self.attachments.append((
+            record['message_id'] + self.offset, record['filename'], record['file_url'],
+            record['created_at'], record['content_hash'], record['size'], record['content_type']
+        ))
+        if len(self.attachments) >= BATCH_SIZE:
+            self._flush_attachments()
+
+    def _user_id(self, exported_id):
+        user_id = self.users.get(exported_id)
+        if user_id is None:
+            raise InvalidExport(f'Unknown user {exported_id}')
+        return user_id
+
+    def _flush_messages(self):
+        self.cursor.executemany(
+            'INSERT INTO messages (id, content, user_id, channel_id, created_at, edited_at, '
+            'parent_id, reply_count, last_reply_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            self.messages)
+        self.counts['messages'] += len(self.messages)
+        self.messages = []
+
+    def _flush_attachments(self):
+        self.cursor.executemany(
+            'INSERT INTO attachments (message_id, filename, file_url, created_at, content_hash, '
+            'size, content_type) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            self.attachments)
+        self.counts['attachments'] += len(self.attachments)
+        self.attachments = []
+
+    def finish(self):
+        if self.server_id is None:
+            raise InvalidExport('No server record')
+        self._flush_messages()
+        self._flush_attachments()
+        return dict(self.counts, server_id=self.server_id)
+
+def import_server(lines):
+    """Create a server from an export's lines, in one transaction; returns counts and the new server id."""
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        # Taken up front, so no other writer can use the ids being shifted into
+        cursor.execute('BEGIN IMMEDIATE')
+        reindex = search.pause_insert_indexing(cursor)
+        server_import = ServerImport(cursor)
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                server_import.add(loads(line))
+            except (KeyError, TypeError, ValueError, sqlite3.IntegrityError) as e:
+                raise InvalidExport(f'Line {number}: {e}') from e
+        try:
+            counts = server_import.finish()
+        except sqlite3.IntegrityError as e:
+            raise InvalidExport(str(e)) from e
+        if reindex:
+            search.resume_insert_indexing(cursor, *server_import.message_ids)
+        connection.commit()
+        return counts
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+# Files
+
+def open_output(path, compress=None):
+    if path == '-':
+        return sys.stdout
+    if compress is None:
+        compress = path.endswith('.gz')
+    if compress:
+        return gzip.open(path, 'wt', encoding='utf-8', compresslevel=GZIP_LEVEL)
+    return open(path, 'w', encoding='utf-8')
+
+def open_input(path):
+    if path == '-':
+        return sys.stdin
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="write a server's history")
+    export_parser.add_argument('server_id', type=int)
+    export_parser.add_argument('output', help="file to write, or '-' for stdout")
+    export_parser.add_argument('--gzip', action='store_true', default=None,
+                               help='compress even without a .gz name')
+    import_parser = commands.add_parser('import', help='create a server from an export')
+    import_parser.add_argument('input', help="file to read, or '-' for stdin")
+    args = parser.parse_args()
+
+    from app import app
+
+    started = time.perf_counter()
+    with app.app_context():
+        if args.command == 'export':
+            out = open_output(args.output, args.gzip)
+            try:
+                counts = export_server(args.server_id, out)
+            except ValueError as e:
+                sys.exit(str(e))
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+        else:
+            source = open_input(args.input)
+            try:
+                counts = import_server(source)
+            except InvalidExport as e:
+                sys.exit(f'Import failed: {e}')
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+    elapsed = time.perf_counter() - started
+    messages = counts.get('messages', 0) + counts.get('archived_messages', 0)
+    print(', '.join(f'{key} {value}' for key, value in counts.items()), file=sys.stderr)
+    print(f'{messages} messages in {elapsed:.1f}s ({messages / max(elapsed, 1e-9) * 60:,.0f}/min)',
+          file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import time
+
+# Server-side typing state. Each channel keeps the set of users typing in it,
+# each entry expiring TYPING_TTL seconds after the user's last accepted
+# event. A user's events are throttled to one per TYPING_THROTTLE seconds per
+# channel; extra ones are dropped before any work is done. Every
+# TYPING_FLUSH_INTERVAL the channels whose set changed get one typing_update
+# snapshot, instead of a broadcast per keystroke event.
+
+class TypingTracker:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.ttl = 6.0
+        self.throttle = 2.0
+        self.flush_interval = 0.5
+        self.channels = {}  # channel_id -> {user_id: [username, expires_at, accepted_at]}
+        self.changed = set()
+        self._worker = None
+        self.stats = {
+            'events_received': 0,
+            'events_throttled': 0,
+            'snapshots_sent': 0
+        }
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.ttl = app.config.get('TYPING_TTL', 6.0)
+        self.throttle = app.config.get('TYPING_THROTTLE', 2.0)
+        self.flush_interval = app.config.get('TYPING_FLUSH_INTERVAL', 0.5)
+
+    def typing(self, channel_id, user_id, username, now=None):
+        # Returns False when the event was throttled
+        now = now or time.monotonic()
+        self.stats['events_received'] += 1
+        typers = self.channels.setdefault(channel_id, {})
+        entry = typers.get(user_id)
+        if entry is not None and now - entry[2] < self.throttle:
+            self.stats['events_throttled'] += 1
+            return False
+
+        if entry is None:
+            typers[user_id] = [username, now + self.ttl, now]
+            self.changed.add(channel_id)
+        else:
+            entry[1] = now + self.ttl
+            entry[2] = now
+        self._ensure_worker()
+        return True
+
+    def stop(self, channel_id, user_id):
+        typers = self.channels.get(channel_id)
+        if typers and typers.pop(user_id, None) is not None:
+            self.changed.add(channel_id)
+            if not typers:
+                del self.channels[channel_id]
+
+    def snapshot(self, channel_id):
+        return [
+            {'id': user_id, 'username': entry[0]}
+            for user_id, entry in self.channels.get(channel_id, {}).items()
+        ]
+
+    def _expire(self, now):
+        for channel_id, typers in list(self.channels.items()):
+            expired = [user_id for user_id, entry in typers.items() if entry[1] <= now]
+            for user_id in expired:
+                del typers[user_id]
+            if expired:
+                self.changed.add(channel_id)
+            if not typers:
+                del self.channels[channel_id]
+
+    def flush(self, now=None):
+        self._expire(now or time.monotonic())
+        changed, self.changed = self.changed, set()
+        for channel_id in changed:
+            self.stats['snapshots_sent'] += 1
+            self.socketio.emit('typing_update', {
+                'channel_id': channel_id,
+                'users': self.snapshot(channel_id)
+            }, room=f'channel_{channel_id}')
+        return changed
+
+    def suppressed(self):
+        # Broadcasts saved compared with relaying every event
+        return self.stats['events_received'] - self.stats['snapshots_sent']
+
+    def _ensure_worker(self):
+        if self._worker is not None or self.socketio is None or self.socketio.server is None:
+            return
+        self._worker = self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Typing flush failed')
+
+typing_tracker = TypingTracker()
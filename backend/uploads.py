@@ -0,0 +1,305 @@
+import fcntl
+import hashlib
+import hmac
+import json
+import mimetypes
+import os
+import re
+import secrets
+import time
+from urllib.parse import quote, urlencode
+
+# Attachment uploads and the content-addressed blob store behind them, on the
+# local filesystem.
+#
+# An upload is started with its name and size, then sent as any number of
+# chunks, each written straight from the request stream to a partial file.
+# The partial file's length is the upload's offset, so a client that lost
+# its connection asks for the offset and carries on from there, even after a
+# restart. Once the last byte is in, the file moves to blobs/ under its
+# SHA-256. A blob that is already there is kept and the new copy dropped, so
+# the same file uploaded twice is stored once. Blobs are never rewritten,
+# which is what makes the hash a strong ETag.
+#
+# Chunks of one upload are written under an exclusive lock on its partial
+# file, so two requests at the same offset cannot both append. Attaching an
+# upload to a message claims it by renaming its record, which only one
+# request can do; the record is deleted once the message commits and put
+# back if it does not.
+#
+# Downloads need the user, but an <img src> cannot send a bearer token, so
+# attachment URLs can be signed for a user and carry an expiry instead.
+# Signatures are made for fixed windows, so the same user gets the same URL
+# for a while and browsers can cache it.
+#
+# Config:
+#   UPLOAD_FOLDER        root of the store (default <instance>/uploads)
+#   UPLOAD_MAX_SIZE      largest file accepted (default 100 MiB)
+#   UPLOAD_SESSION_TTL   seconds an unfinished or unused upload is kept
+#                        (default 1 day)
+#   ATTACHMENT_URL_TTL   seconds a signed attachment URL stays valid at least
+#                        (default 1 hour; at most twice that)
+
+READ_SIZE = 64 * 1024
+MAX_ATTACHMENTS = 10
+
+_upload_id = re.compile(r'^[0-9a-f]{32}$')
+_content_hash = re.compile(r'^[0-9a-f]{64}$')
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, offset):
+        super().__init__(f'Upload is at offset {offset}')
+        self.offset = offset
+
+def is_content_hash(value):
+    return bool(_content_hash.match(value))
+
+def attachment_url(content_hash, filename):
+    return f'/api/attachments/{content_hash}/{quote(filename)}'
+
+def _signature(secret, user_id, expires, url):
+    message = f'{user_id}:{expires}:{url}'.encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+def sign_attachment_url(secret, ttl, user_id, content_hash, filename, now=None):
+    now = int(now or time.time())
+    expires = (now // ttl + 2) * ttl
+    url = attachment_url(content_hash, filename)
+    return url + '?' + urlencode({'user': user_id, 'expires': expires,
+                                  'signature': _signature(secret, user_id, expires, url)})
+
+def verify_attachment_signature(secret, user_id, expires, signature, content_hash, filename, now=None):
+    if expires < (now or time.time()):
+        return False
+    expected = _signature(secret, user_id, expires, attachment_url(content_hash, filename))
+    return hmac.compare_digest(expected, signature)
+
+class BlobStore:
+    def __init__(self):
+        self.root = None
+        self.max_size = 100 * 1024 * 1024
+        self.session_ttl = 24 * 3600
+        self.url_ttl = 3600
+        self._hashers = {}  # upload_id -> (offset, sha256 object) for in-progress uploads
+        self._swept_at = 0
+        self.stats = {'uploads_started': 0, 'bytes_received': 0, 'blobs_stored': 0,
+                      'deduplicated': 0, 'rehashed': 0, 'expired': 0}
+
+    def init_app(self, app):
+        self.root = app.config.get('UPLOAD_FOLDER') or os.path.join(app.instance_path, 'uploads')
+        self.max_size = app.config.get('UPLOAD_MAX_SIZE', 100 * 1024 * 1024)
+        self.session_ttl = app.config.get('UPLOAD_SESSION_TTL', 24 * 3600)
+        self.url_ttl = app.config.get('ATTACHMENT_URL_TTL', 3600)
+        os.makedirs(os.path.join(self.root, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'partial'), exist_ok=True)
+
+    def blob_path(self, content_hash):
+        return os.path.join(self.root, 'blobs', content_hash[:2], content_hash[2:4], content_hash)
+
+    def _partial_path(self, upload_id):
+        return os.path.join(self.root, 'partial', upload_id)
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.root, 'partial', upload_id + '.json')
+
+    def _claimed_path(self, upload_id):
+        return os.path.join(self.root, 'partial', upload_id + '.claimed.json')
+
+    def _save(self, upload):
+        path = self._meta_path(upload['id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(upload, f)
+        os.replace(path + '.tmp', path)
+
+    def start(self, user_id, filename, size):
+        """Open an upload and return its record."""
+        self._sweep()
+        upload = {
+            'id': secrets.token_hex(16),
+            'user_id': user_id,
+            'filename': os.path.basename(filename)[:255] or 'file',
+            'size': size,
+            'content_type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            'content_hash': None,
+            'created_at': time.time()
+        }
+        open(self._partial_path(upload['id']), 'wb').close()
+        self._save(upload)
+        self.stats['uploads_started'] += 1
+        return upload
+
+    def load(self, upload_id):
+        if not _upload_id.match(upload_id):
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def offset(self, upload):
+        if upload['content_hash'] is not None:
+            return upload['size']
+        try:
+            return os.path.getsize(self._partial_path(upload['id']))
+        except FileNotFoundError:
+            return 0
+
+    def write_chunk(self, upload, offset, stream, length):
+        """Append ``length`` bytes from ``stream`` at ``offset``; returns the new offset.
+
+        Raises UploadOffsetMismatch unless ``offset`` is where the upload
+        stands, and ValueError if the chunk runs past the declared size.
+        Finishes the upload when its last byte arrives.
+        """
+        if upload['content_hash'] is not None:
+            raise UploadOffsetMismatch(upload['size'])
+        if offset + length > upload['size']:
+            raise ValueError('Chunk runs past the end of the file')
+
+        partial = self._partial_path(upload['id'])
+        try:
+            # No O_CREAT: a finished or cancelled upload has no partial file
+            f = os.fdopen(os.open(partial, os.O_WRONLY | os.O_APPEND), 'ab')
+        except FileNotFoundError:
+            raise UploadOffsetMismatch(self.offset(self.load(upload['id']) or upload))
+        with f:
+            # Not waited for: a chunk racing another one at the same offset
+            # is answered with 409 and the client asks where things stand
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadOffsetMismatch(self.offset(upload))
+            try:
+                # The last chunk may have finished the upload, moving this
+                # very file into the blob store, before the lock was ours
+                if os.stat(partial).st_ino != os.fstat(f.fileno()).st_ino:
+                    raise FileNotFoundError(partial)
+            except FileNotFoundError:
+                raise UploadOffsetMismatch(self.offset(self.load(upload['id']) or upload))
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                raise UploadOffsetMismatch(current)
+
+            known_offset, hasher = self._hashers.get(upload['id'], (0, hashlib.sha256()))
+            if known_offset != offset:
+                hasher = None  # written by another worker or before a restart
+            remaining = length
+            while remaining:
+                data = stream.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                f.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                remaining -= len(data)
+                offset += len(data)
+            f.flush()
+            self.stats['bytes_received'] += length - remaining
+            if hasher is not None:
+                self._hashers[upload['id']] = (offset, hasher)
+
+            if offset == upload['size']:
+                self._finish(upload, hasher)
+        return offset
+
+    def _finish(self, upload, hasher):
+        partial = self._partial_path(upload['id'])
+        self._hashers.pop(upload['id'], None)
+        if hasher is None:
+            self.stats['rehashed'] += 1
+            hasher = hashlib.sha256()
+            with open(partial, 'rb') as f:
+                for data in iter(lambda: f.read(READ_SIZE), b''):
+                    hasher.update(data)
+        content_hash = hasher.hexdigest()
+
+        path = self.blob_path(content_hash)
+        if os.path.exists(path):
+            os.unlink(partial)
+            self.stats['deduplicated'] += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(partial, path)
+            self.stats['blobs_stored'] += 1
+        upload['content_hash'] = content_hash
+        self._save(upload)
+
+    def claim(self, user_id, upload_ids):
+        """Turn finished uploads into attachment fields for a new message.
+
+        Each upload can be attached once. Raises ValueError if one is
+        missing, unfinished, someone else's or already claimed. The fields
+        carry the upload id; pass them to release() once the message is
+        committed, or to unclaim() if it is not.
+        """
+        if len(upload_ids) > MAX_ATTACHMENTS:
+            raise ValueError(f'At most {MAX_ATTACHMENTS} attachments per message')
+        uploads = [self.load(str(upload_id)) for upload_id in upload_ids]
+        for upload in uploads:
+            if upload is None or upload['user_id'] != user_id or upload['content_hash'] is None:
+                raise ValueError('Attachment upload not found or not finished')
+        claimed = []
+        for upload in uploads:
+            try:
+                os.rename(self._meta_path(upload['id']), self._claimed_path(upload['id']))
+            except FileNotFoundError:
+                # Claimed by a concurrent message, or listed twice
+                self.unclaim([{'upload_id': upload_id} for upload_id in claimed])
+                raise ValueError('Attachment upload not found or not finished')
+            claimed.append(upload['id'])
+            os.utime(self._claimed_path(upload['id']))  # not swept while its message commits
+        return [{
+            'upload_id': upload['id'],
+            'filename': upload['filename'],
+            'file_url': attachment_url(upload['content_hash'], upload['filename']),
+            'content_hash': upload['content_hash'],
+            'size': upload['size'],
+            'content_type': upload['content_type']
+        } for upload in uploads]
+
+    def release(self, attachments):
+        # The message holding these is committed; the uploads are used up
+        for attachment in attachments:
+            try:
+                os.unlink(self._claimed_path(attachment['upload_id']))
+            except FileNotFoundError:
+                pass
+
+    def unclaim(self, attachments):
+        # The message was not saved, so the uploads can be attached again
+        for attachment in attachments:
+            try:
+                os.rename(self._claimed_path(attachment['upload_id']), self._meta_path(attachment['upload_id']))
+            except FileNotFoundError:
+                pass
+
+    def discard(self, upload_id):
+        self._hashers.pop(upload_id, None)
+        for path in (self._partial_path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _sweep(self):
+        # Drop uploads older than the TTL, at most once per TTL/24
+        now = time.time()
+        if now - self._swept_at < self.session_ttl / 24:
+            return
+        self._swept_at = now
+        for name in os.listdir(os.path.join(self.root, 'partial')):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-len('.json')]
+            try:
+                touched = os.path.getmtime(os.path.join(self.root, 'partial', name))
+                if os.path.exists(self._partial_path(upload_id)):
+                    touched = max(touched, os.path.getmtime(self._partial_path(upload_id)))
+            except FileNotFoundError:
+                continue
+            if now - touched > self.session_ttl:
+                self.discard(upload_id)
+                self.stats['expired'] += 1
+
+blob_store = BlobStore()
@@ -0,0 +1,224 @@
+import time
+
+# Who is in which voice channel, kept in memory. A user is in at most one
+# voice channel, through one socket; joining from another socket or another
+# channel moves them. Entries are added when a socket joins a voice channel
+# and removed when it leaves, disconnects, or loses access to the server.
+#
+# WebRTC signals are relayed between members of the same roster straight to
+# the target's sid. Since both ends were checked when they joined, a signal
+# costs two dict lookups and no query. Signals from or to anyone outside the
+# roster are dropped.
+#
+# ICE trickle sends many small candidate signals per peer. With
+# VOICE_CANDIDATE_BATCH_INTERVAL set, candidates for one peer are held that
+# long and sent together as one voice_signals event; any other signal to
+# that peer sends the held candidates first, so order is kept.
+#
+# Rosters live in the process that holds the sockets. With several workers
+# each one only knows its own sockets, and peers on different workers
+# cannot signal each other.
+#
+# Config:
+#   VOICE_CANDIDATE_BATCH_INTERVAL  seconds to hold candidates (default None, send at once)
+
+class VoiceMember:
+    __slots__ = ('sid', 'user_id', 'username', 'avatar_url', 'muted', 'deafened', 'joined_at')
+
+    def __init__(self, sid, session):
+        self.sid = sid
+        self.user_id = session.user_id
+        self.username = session.username
+        self.avatar_url = session.avatar_url
+        self.muted = False
+        self.deafened = False
+        self.joined_at = time.time()
+
+    def serialize(self):
+        return {
+            'id': self.user_id,
+            'username': self.username,
+            'avatar_url': self.avatar_url,
+            'muted': self.muted,
+            'deafened': self.deafened
+        }
+
+def is_candidate(signal):
+    # simple-peer wraps candidates as {type: 'candidate', candidate: {...}};
+    # a bare RTCIceCandidate has a candidate string and no type
+    return isinstance(signal, dict) and (signal.get('type') == 'candidate' or
+                                         ('candidate' in signal and 'type' not in signal))
+
+class VoiceRosters:
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.batch_interval = None
+        self.channels = {}  # channel_id -> {user_id: VoiceMember}
+        self.channel_servers = {}  # channel_id -> server_id, for rosters with members
+        self.by_sid = {}  # sid -> (channel_id, user_id)
+        self.by_user = {}  # user_id -> channel_id
+        self.pending = {}  # (from sid, to sid) -> (channel_id, from user_id, [candidates])
+        self._worker = None
+        self.stats = {
+            'joins': 0,
+            'leaves': 0,
+            'signals_relayed': 0,
+            'signals_rejected': 0,
+            'candidates_batched': 0,
+            'batches_sent': 0
+        }
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.batch_interval = app.config.get('VOICE_CANDIDATE_BATCH_INTERVAL')
+
+    # Roster
+
+    def roster(self, channel_id):
+        members = self.channels.get(channel_id, {})
+        return [member.serialize() for member in sorted(members.values(), key=lambda m: m.joined_at)]
+
+    def server_rosters(self, server_id):
+        return [{'channel_id': channel_id, 'users': self.roster(channel_id)}
+                for channel_id, owner in sorted(self.channel_servers.items()) if owner == server_id]
+
+    def join(self, channel, session, sid):
+        """Add the socket's user to a voice channel and send it the roster."""
+        if self.by_sid.get(sid) == (channel.id, session.user_id):
+            self.socketio.emit('voice_roster', {'channel_id': channel.id, 'users': self.roster(channel.id)}, to=sid)
+            return
+        current = self.by_user.get(session.user_id)
+        if current is not None:
+            self._remove(current, session.user_id)
+
+        member = VoiceMember(sid, session)
+        self.channels.setdefault(channel.id, {})[session.user_id] = member
+        self.channel_servers[channel.id] = channel.server_id
+        self.by_sid[sid] = (channel.id, session.user_id)
+        self.by_user[session.user_id] = channel.id
+        self.stats['joins'] += 1
+
+        self.socketio.emit('voice_roster', {'channel_id': channel.id, 'users': self.roster(channel.id)}, to=sid)
+        self.socketio.emit('voice_user_joined', {
+            'channel_id': channel.id,
+            'user': member.serialize()
+        }, room=f'channel_{channel.id}')
+
+    def leave(self, sid, channel_id=None):
+        # channel_id None: whatever voice channel the socket is in
+        entry = self.by_sid.get(sid)
+        if entry is None or (channel_id is not None and entry[0] != channel_id):
+            return False
+        self._remove(*entry)
+        return True
+
+    def remove_user(self, user_id, server_id=None):
+        channel_id = self.by_user.get(user_id)
+        if channel_id is not None and (server_id is None or self.channel_servers.get(channel_id) == server_id):
+            self._remove(channel_id, user_id)
+
+    def drop_channel(self, channel_id):
+        # For deleted channels; nobody is left to tell
+        for user_id, member in self.channels.pop(channel_id, {}).items():
+            self.by_sid.pop(member.sid, None)
+            self.by_user.pop(user_id, None)
+            self._drop_pending(member.sid)
+        self.channel_servers.pop(channel_id, None)
+
+    def set_state(self, sid, muted=None, deafened=None):
+        entry = self.by_sid.get(sid)
+        if entry is None:
+            return
+        channel_id, user_id = entry
+        member = self.channels[channel_id][user_id]
+        if muted is not None:
+            member.muted = muted
+        if deafened is not None:
+            member.deafened = deafened
+        self.socketio.emit('voice_state_update', {
+            'channel_id': channel_id,
+            'user': member.serialize()
+        }, room=f'channel_{channel_id}')
+
+    def _remove(self, channel_id, user_id):
+        members = self.channels.get(channel_id, {})
+        member = members.pop(user_id, None)
+        if member is None:
+            return
+        if not members:
+            self.channels.pop(channel_id, None)
+            self.channel_servers.pop(channel_id, None)
+        self.by_sid.pop(member.sid, None)
+        self.by_user.pop(user_id, None)
+        self._drop_pending(member.sid)
+        self.stats['leaves'] += 1
+        self.socketio.emit('voice_user_left', {
+            'channel_id': channel_id,
+            'user_id': user_id
+        }, room=f'channel_{channel_id}')
+
+    # Signaling
+
+    def signal(self, sid, channel_id, target_user_id, signal):
+        """Relay a WebRTC signal to another member of the sender's voice channel."""
+        entry = self.by_sid.get(sid)
+        target = self.channels.get(channel_id, {}).get(target_user_id)
+        if entry is None or entry[0] != channel_id or target is None or target.sid == sid:
+            self.stats['signals_rejected'] += 1
+            return False
+        from_user_id = entry[1]
+        key = (sid, target.sid)
+
+        if self.batch_interval and is_candidate(signal):
+            held = self.pending.get(key)
+            if held is None:
+                held = self.pending[key] = (channel_id, from_user_id, [])
+            held[2].append(signal)
+            self.stats['candidates_batched'] += 1
+            self._ensure_worker()
+        else:
+            self._send_pending(key)
+            self.socketio.emit('voice_signal', {
+                'channel_id': channel_id,
+                'from_user_id': from_user_id,
+                'signal': signal
+            }, to=target.sid)
+        self.stats['signals_relayed'] += 1
+        return True
+
+    def _send_pending(self, key):
+        held = self.pending.pop(key, None)
+        if held is None:
+            return
+        channel_id, from_user_id, signals = held
+        self.socketio.emit('voice_signals', {
+            'channel_id': channel_id,
+            'from_user_id': from_user_id,
+            'signals': signals
+        }, to=key[1])
+        self.stats['batches_sent'] += 1
+
+    def _drop_pending(self, sid):
+        for key in [key for key in self.pending if sid in key]:
+            del self.pending[key]
+
+    def _ensure_worker(self):
+        if self._worker is not None or self.socketio is None or self.socketio.server is None:
+            return
+        self._worker = self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.batch_interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Voice candidate flush failed')
+
+    def flush(self):
+        for key in list(self.pending):
+            self._send_pending(key)
+
+voice_rosters = VoiceRosters()
@@ -0,0 +1,162 @@
+import json
+from flask import request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from socketio import BaseManager, packet
+
+try:
+    import orjson
+except ImportError:  # the stdlib encoder is used instead
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is then never offered
+    msgpack = None
+
+# Wire encodings for REST responses and Socket.IO packets.
+#
+# REST: jsonify() goes through FastJSONProvider, which encodes with orjson
+# and answers in MessagePack instead when the client's Accept header prefers
+# application/msgpack.
+#
+# Socket.IO: packets are JSON-encoded with orjson. A client that connects
+# with ?encoding=msgpack gets each event argument as one MessagePack binary
+# attachment instead. EncodeOnceManager encodes a broadcast once per
+# encoding rather than once per recipient, as python-socketio's own manager
+# does.
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+binary_sids = set()  # sids of sockets that asked for MessagePack
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'))
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def packb(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+class SocketJSON:
+    """The part of the json module python-socketio and python-engineio call."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return dumps(obj)
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return loads(data)
+
+def wants_msgpack():
+    if msgpack is None or not has_request_context():
+        return False
+    best = request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+class FastJSONProvider(DefaultJSONProvider):
+    # Keys are not sorted; the output only has to be valid JSON
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if wants_msgpack():
+            response = self._app.response_class(packb(obj), mimetype='application/msgpack')
+        elif orjson is not None:
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+            if self.compact is False or (self.compact is None and self._app.debug):
+                option |= orjson.OPT_INDENT_2
+            body = orjson.dumps(obj, default=self.default, option=option)
+            response = self._app.response_class(body, mimetype=self.mimetype)
+        else:
+            response = super().response(obj)
+        if msgpack is not None:
+            response.vary.add('Accept')
+        return response
+
+def use_binary(sid, enabled=True):
+    if enabled and msgpack is not None:
+        binary_sids.add(sid)
+    else:
+        binary_sids.discard(sid)
+
+class EncodeOnceManager(BaseManager):
+    """A client manager that encodes each emit once per wire encoding.
+
+    Emits with a callback still go through BaseManager, since every
+    recipient then needs its own ack id in the packet. The encoded packet
+    goes out through the server's _send_packet, like any other, which is
+    also where Flask-SocketIO's test client picks packets up.
+
+    With a sequencer set (see session_resume.py), each emit is numbered
+    once and recorded for every recipient.
+    """
+    sequencer = None
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        # Sessions whose sockets dropped still get the event, even with
+        # nobody connected
+        entry = self.sequencer.stamp(event, data) if self.sequencer is not None else None
+        if entry is not None:
+            data = entry[2]
+            self.sequencer.record_suspended(room, entry)
+        if namespace not in self.rooms:
+            return
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        if callback is not None:
+            if entry is not None:
+                for sid, _ in self.get_participants(namespace, room):
+                    if sid not in skip_sid:
+                        self.sequencer.record(sid, entry)
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid,
+                                callback=callback, **kwargs)
+        encoded = {}  # binary? -> engine.io packets
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip_sid:
+                continue
+            if entry is not None:
+                self.sequencer.record(sid, entry)
+            binary = sid in binary_sids
+            pkt = encoded.get(binary)
+            if pkt is None:
+                pkt = encoded[binary] = self._encode(event, data, namespace, binary)
+            self.server._send_packet(eio_sid, pkt)
+
+    def _encode(self, event, data, namespace, binary):
+        # Same argument rules as Server._emit_internal: a tuple is several
+        # arguments, None is none
+        if isinstance(data, tuple):
+            args = list(data)
+        elif data is not None:
+            args = [data]
+        else:
+            args = []
+        if binary:
+            args = [packb(arg) for arg in args]
+        return EncodedPacket(self.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + args))
+
+class EncodedPacket:
+    """A packet encoded up front, so sending it to many sockets encodes it once."""
+    __slots__ = ('encoded',)
+
+    def __init__(self, pkt):
+        self.encoded = pkt.encode()
+
+    def encode(self):
+        return self.encoded